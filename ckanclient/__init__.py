@@ -8,8 +8,11 @@ and its search interface.
 __license__ = 'MIT'
 
 import os
+import sys
 import re
 import io
+import time
+import threading
 import ConfigParser
 import mimetypes, urlparse, hashlib
 from datetime import datetime
@@ -17,7 +20,7 @@ from StringIO import StringIO
 
 try:
     str = unicode
-    from urllib2 import (urlopen, build_opener, install_opener,
+    from urllib2 import (build_opener,
                          HTTPBasicAuthHandler,
                          HTTPPasswordMgrWithDefaultRealm,
                          Request,
@@ -27,7 +30,7 @@ except NameError:
     # Forward compatibility with Py3k
     from urllib.error import HTTPError, URLError
     from urllib.parse import urlencode
-    from urllib.request import (build_opener, install_opener, urlopen,
+    from urllib.request import (build_opener,
                                 HTTPPasswordMgrWithDefaultRealm,
                                 HTTPBasicAuthHandler,
                                 Request)
@@ -43,6 +46,17 @@ except ImportError:
                 import simplejson as json
         json = _json()
 
+from ckanclient.connection import (ConnectionPool, KeepAliveHandler,
+                                   ContentEncodingProcessor)
+from ckanclient.cache import CacheHandler
+from ckanclient.retry import IDEMPOTENT_METHODS
+from ckanclient.instrument import RequestRecord, call_hooks
+from ckanclient import workers, jsonstream, lazyjson
+from ckanclient.lazyjson import LazyObject
+from ckanclient.search import (SearchResults, PageSizeRejected,
+                               REJECTED_STATUSES, KeysetResults, KEYSET_SORT,
+                               keyset_filter, decode_cursor)
+
 import logging
 logger = logging.getLogger('ckanclient')
 
@@ -54,6 +68,16 @@ class CkanApiNotAuthorizedError(CkanApiError): pass
 class CkanApiConflictError(CkanApiError): pass
 class CkanApiActionError(Exception): pass
 
+# suffixes of the names of actions that only read, so are safe to retry
+READ_ACTION_SUFFIXES = ('_show', '_list', '_search', '_autocomplete')
+
+def is_read_action(action_name):
+    return action_name.endswith(READ_ACTION_SUFFIXES)
+
+# methods of the requests that may be coalesced when idempotent: reads,
+# including POSTs of read actions
+COALESCED_METHODS = ('GET', 'HEAD', 'POST')
+
 
 class ApiRequest(Request):
     def __init__(self, url, data=None, headers={}, method=None):
@@ -73,6 +97,56 @@ class ApiRequest(Request):
             return self._method
 
 
+class ApiResponse(object):
+    '''The outcome of one request made by CkanClient.
+
+    :ivar location: the URL requested
+    :ivar method: the HTTP method
+    :ivar status: HTTP status code (or errno for a URL error)
+    :ivar headers: response headers
+    :ivar body: the raw response body (None when streamed)
+    :ivar message: the body, decoded from JSON where it is JSON
+    :ivar elapsed: seconds taken to make the request and read the body
+    :ivar retries: number of times the request was retried
+    :ivar http_error: the HTTPError, if the server returned an error
+    :ivar url_error: the URLError, if the server could not be reached
+    :ivar help: Action API help text
+    :ivar result: Action API result
+    :ivar ckan_error: Action API error dict
+    :ivar fp: the file-like response the body was (or is to be) read from
+
+    '''
+    def __init__(self, location=None, method=None):
+        self.location = location
+        self.method = method
+        self.status = None
+        self.headers = None
+        self.body = None
+        self.message = None
+        self.elapsed = None
+        self.retries = 0
+        self.http_error = None
+        self.url_error = None
+        self.help = None # Action API only
+        self.result = None # Action API only
+        self.ckan_error = None # Action API only
+        self.fp = None
+
+
+def _last_response_attribute(name):
+    '''A CkanClient property for backwards compatibility that reads `name`
+    from the calling thread's last ApiResponse.'''
+    def fget(self):
+        response = self.last_response
+        if response is None:
+            return None
+        return getattr(response, name)
+    def fset(self, value):
+        if self.last_response is None:
+            self._local.response = ApiResponse()
+        setattr(self.last_response, name, value)
+    return property(fget, fset)
+
 
 class CkanClient(object):
     '''Client API implementation for CKAN.
@@ -83,6 +157,34 @@ class CkanClient(object):
     :param http_user: default *None*
     :param http_pass: default *None*
     :param user_agent: Identify your tool. Default *ckanclient*
+    :param keep_alive: reuse HTTP/1.1 connections between requests. Default
+        *True*
+    :param pool_maxsize: idle connections kept per host. Default *10*
+    :param pool_idle_timeout: seconds an idle connection is kept open.
+        Default *60*
+    :param compression: ask for gzip/deflate compressed responses, which are
+        decompressed as they are read. Default *True*
+    :param cache: a ckanclient.cache.ResponseCache (or DiskResponseCache) to
+        keep GET responses in and revalidate them with conditional requests.
+        Default *None*
+    :param retry: a ckanclient.retry.RetryPolicy for retrying idempotent
+        requests that fail with 429, 503 etc. Default *None*
+    :param rate_limiter: a ckanclient.retry.TokenBucket limiting the rate of
+        requests from all threads using the client. Default *None*
+    :param hooks: callables called with a ckanclient.instrument.RequestRecord
+        (timings and sizes) after every request, e.g. a TimingAggregator.
+        Default *None*
+    :param single_flight: a ckanclient.coalesce.SingleFlight through which
+        identical idempotent reads made by several threads at once share
+        one request. Default *None*
+
+    Connection reuse counters are available from
+    ``client.connection_pool.stats()``.
+
+    A client can be shared between threads. The last_* attributes (e.g.
+    ``last_status``, ``last_message``) give the outcome of the calling
+    thread's last request; ``last_response`` gives it as an ApiResponse,
+    which ``open_url()`` also returns.
 
     '''
     base_location = 'http://datahub.io/api'
@@ -96,11 +198,29 @@ class CkanClient(object):
         'Tag Entity': '/rest/tag',
         'Group Register': '/rest/group',
         'Group Entity': '/rest/group',
-        'Package Search': '/search/package'
+        'Revision Register': '/rest/revision',
+        'Revision Entity': '/rest/revision',
+        'Package Search': '/search/package',
+        'Revision Search': '/search/revision'
     }
 
+    last_location = _last_response_attribute('location')
+    last_status = _last_response_attribute('status')
+    last_body = _last_response_attribute('body')
+    last_headers = _last_response_attribute('headers')
+    last_message = _last_response_attribute('message')
+    last_http_error = _last_response_attribute('http_error')
+    last_url_error = _last_response_attribute('url_error')
+    last_help = _last_response_attribute('help') # Action API only
+    last_result = _last_response_attribute('result') # Action API only
+    last_ckan_error = _last_response_attribute('ckan_error') # Action API only
+    url_response = _last_response_attribute('fp')
+
     def __init__(self, base_location=None, api_key=None, is_verbose=False,
-                 http_user=None, http_pass=None, user_agent=None):
+                 http_user=None, http_pass=None, user_agent=None,
+                 keep_alive=True, pool_maxsize=10, pool_idle_timeout=60,
+                 compression=True, cache=None, retry=None,
+                 rate_limiter=None, hooks=None, single_flight=None):
         if base_location is not None:
             self.base_location = base_location
         if api_key:
@@ -108,28 +228,58 @@ class CkanClient(object):
         else:
             self.api_key = self._get_api_key_from_config()
         self.is_verbose = is_verbose
+        self._local = threading.local()
+        self.retry = retry
+        self.rate_limiter = rate_limiter
+        self.hooks = list(hooks or [])
+        self.single_flight = single_flight
+        handlers = []
+        if keep_alive:
+            self.connection_pool = ConnectionPool(pool_maxsize,
+                                                  pool_idle_timeout)
+            handlers.append(KeepAliveHandler(self.connection_pool))
+        else:
+            self.connection_pool = None
+        if compression:
+            handlers.append(ContentEncodingProcessor())
+        self.cache = cache
+        if cache is not None:
+            handlers.append(CacheHandler(cache))
         if http_user and http_pass:
             password_mgr = HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, base_location,
+            password_mgr.add_password(None, self.base_location,
                                       http_user, http_pass)
-            handler = HTTPBasicAuthHandler(password_mgr)
-            opener = build_opener(handler)
-            install_opener(opener)
+            handlers.append(HTTPBasicAuthHandler(password_mgr))
+        self._opener = build_opener(*handlers)
         self.user_agent = user_agent or 'ckanclient'
 
+    def close(self):
+        '''Close the idle connections kept for reuse.'''
+        if self.connection_pool:
+            self.connection_pool.clear()
+
     def reset(self):
-        self.last_location = None
-        self.last_status = None
-        self.last_body = None
-        self.last_headers = None
-        self.last_message = None
-        self.last_http_error = None
-        self.last_url_error = None
-        self.last_help = None # Action API only
-        self.last_result = None # Action API only
-        self.last_ckan_error = None # Action API only
-
-    def _open_url(self, location, data=None, headers=None, method=None):
+        '''Clear the last_* attributes for this thread.'''
+        self._local.response = None
+
+    @property
+    def last_response(self):
+        '''The ApiResponse of the last request made by this thread.'''
+        return getattr(self._local, 'response', None)
+
+    def _open_url(self, location, data=None, headers=None, method=None,
+                  stream=False, idempotent=None, decode=True):
+        '''Make a request and return its ApiResponse. HTTP and URL errors
+        are recorded in the response rather than raised.
+
+        With stream=True a successful response body is left unread in
+        response.fp, for the caller to decode as it is read. With
+        decode=False it is read but not decoded from JSON.
+
+        Requests are retried according to self.retry if they are
+        idempotent, which by default depends on the HTTP method. Idempotent
+        reads are coalesced through self.single_flight, if set.
+        '''
         if headers is None:
             headers = {}
         # automatically add auth headers into every request
@@ -139,39 +289,144 @@ class CkanClient(object):
             'User-Agent': self.user_agent,
         }
         _headers.update(headers)
-        self.last_location = location
+        if data != None:
+            data = urlencode({data: 1})
+        default_method = 'POST' if data is not None else 'GET'
+        if idempotent is None:
+            idempotent = (method or default_method) in IDEMPOTENT_METHODS
+        if self.single_flight is not None and idempotent and not stream \
+               and (method or default_method) in COALESCED_METHODS:
+            key = (method, location, data, decode,
+                   tuple(sorted(_headers.items())))
+            response, shared = self.single_flight.do(key, lambda:
+                self._attempt_request(location, data, _headers, method,
+                                      stream, idempotent, decode))
+            if shared:
+                response = self._copy_response(response)
+                self._local.response = response
+            return response
+        return self._attempt_request(location, data, _headers, method,
+                                     stream, idempotent, decode)
+
+    def _attempt_request(self, location, data, headers, method, stream,
+                         idempotent, decode):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            response = self._send_request(location, data, headers, method,
+                                          stream, attempt, decode)
+            if self.retry is None or \
+                   not self.retry.should_retry(response, attempt, idempotent):
+                break
+            self.retry.wait(attempt, response)
+            attempt += 1
+        response.retries = attempt
+        return response
+
+    def _copy_response(self, response):
+        '''A copy of a response shared by coalesced requests, with its own
+        decoded message, so that callers changing their results don't
+        affect each other.'''
+        copy = ApiResponse()
+        copy.__dict__.update(response.__dict__)
+        if response.body is not None and \
+               response.message is not response.body:
+            copy.message = self._loadstr(response.body)
+        # set by the Action API methods of the thread that made the request
+        copy.help = copy.result = copy.ckan_error = None
+        return copy
+
+    def _send_request(self, location, data, headers, method, stream,
+                      attempt=0, decode=True):
+        response = ApiResponse(location)
+        self._local.response = response
+        start = time.time()
+        opened = transfer = decode_time = None
+        req = ApiRequest(location, data, headers, method=method)
+        response.method = req.get_method()
         try:
-            if data != None:
-                data = urlencode({data: 1})
-            req = ApiRequest(location, data, _headers, method=method)
-            self.url_response = urlopen(req)
-            if data and self.url_response.geturl() != location:
-                redirection = '%s -> %s' % (location, self.url_response.geturl())
+            response.fp = self._opener.open(req)
+            opened = time.time()
+            if data and response.fp.geturl() != location:
+                redirection = '%s -> %s' % (location, response.fp.geturl())
                 raise URLError("Got redirected to another URL, which does not work with POSTS. Redirection: %s" % redirection)
         except HTTPError, inst:
-            self.last_http_error = inst
-            self.last_status = inst.code
-            self.last_message = inst.read()
+            response.http_error = inst
+            response.status = inst.code
+            response.headers = inst.hdrs
+            response.message = inst.read()
         except URLError, inst:
-            self.last_url_error = inst
+            response.url_error = inst
             if isinstance(inst.reason, tuple):
-                self.last_status,self.last_message = inst.reason
+                response.status, response.message = inst.reason
             else:
-                self.last_message = inst.reason
-                self.last_status = inst.errno
+                response.message = inst.reason
+                response.status = inst.errno
         else:
-            self.last_status = self.url_response.code
-            self.last_body = self.url_response.read()
-            self.last_headers = self.url_response.headers
-            content_type = self.last_headers['Content-Type']
-            is_json_response = False
-            if 'json' in content_type:
-                is_json_response = True
-            if is_json_response:
-                self.last_message = self._loadstr(self.last_body)
-            else:
-                self.last_message = self.last_body
-    
+            response.status = response.fp.code
+            response.headers = response.fp.headers
+            if not stream:
+                response.body = response.fp.read()
+                transfer = time.time() - opened
+                content_type = response.headers['Content-Type']
+                is_json_response = False
+                if 'json' in content_type:
+                    is_json_response = True
+                if is_json_response and decode:
+                    response.message = self._loadstr(response.body)
+                    decode_time = time.time() - opened - transfer
+                else:
+                    response.message = response.body
+        response.elapsed = time.time() - start
+        if self.hooks:
+            record = RequestRecord(response.method,
+                                   self._endpoint_name(location), location)
+            if response.url_error is None:
+                record.status = response.status
+            timings = getattr(req, 'timings', None)
+            if timings:
+                record.connect = timings['connect']
+                record.ttfb = timings['ttfb']
+            elif opened is not None:
+                record.ttfb = opened - start
+            record.transfer = transfer
+            record.decode = decode_time
+            record.total = response.elapsed
+            record.request_bytes = len(data) if data else 0
+            raw_reader = getattr(req, 'raw_reader', None)
+            if raw_reader is not None and not stream:
+                record.response_bytes = raw_reader.bytes_read
+            elif response.body is not None:
+                record.response_bytes = len(response.body)
+            record.attempt = attempt
+            call_hooks(self.hooks, record)
+        return response
+
+    def _endpoint_name(self, location):
+        '''The URL template that a location is for, e.g. 'Package Entity'
+        or 'action/package_show', for grouping requests by endpoint.'''
+        path = location
+        if path.startswith(self.base_location):
+            path = path[len(self.base_location):]
+        path = path.split('?')[0].rstrip('/')
+        if not path:
+            return 'Base'
+        if path.startswith('/action/'):
+            return path.lstrip('/')
+        for name, resource_path in self.resource_paths.items():
+            if not resource_path:
+                continue
+            if path == resource_path and not name.endswith('Entity'):
+                return name
+            if path.startswith(resource_path + '/') and \
+                   not name.endswith('Register'):
+                return name
+        for storage_path in ('/storage/metadata', '/storage/auth'):
+            if path.startswith(storage_path):
+                return storage_path.lstrip('/')
+        return path
+
     def get_location(self, resource_name, entity_id=None, subregister=None, entity2_id=None):
         base = self.base_location
         path = self.resource_paths[resource_name]
@@ -198,43 +453,73 @@ class CkanClient(object):
         return data
 
     def open_url(self, url, *args, **kwargs):
-        result = self._open_url(url, *args, **kwargs)
-        if self.last_status not in (200, 201):
-            if self.last_status == 404:
-                raise CkanApiNotFoundError(self.last_status)
-            elif self.last_status == 403:
-                raise CkanApiNotAuthorizedError(self.last_status)
-            elif self.last_status == 409:
-                raise CkanApiConflictError(self.last_status)
+        '''Make a request and return its ApiResponse, raising a
+        CkanApiError if it failed.'''
+        response = self._open_url(url, *args, **kwargs)
+        if response.status not in (200, 201):
+            if response.status == 404:
+                raise CkanApiNotFoundError(response.status)
+            elif response.status == 403:
+                raise CkanApiNotAuthorizedError(response.status)
+            elif response.status == 409:
+                raise CkanApiConflictError(response.status)
             else:
-                raise CkanApiError(self.last_message)
-        return result
+                raise CkanApiError(response.message)
+        return response
             
-    def open_action_url(self, url, data_dict):
+    def open_action_url(self, url, data_dict, stream=False, idempotent=False,
+                        fields=None, lazy=False):
+        '''Call an action and return its result. With `fields` a result
+        dict (or list of them) has only those fields, and with lazy=True
+        it is a ckanclient.lazyjson.LazyObject decoding its nested sections
+        when they are first accessed.'''
         data_json = self._dumpstr(data_dict)
-        result = self._open_url(url, data=data_json)
-        if self.last_status not in (200, 201):
-            if self.last_status == 404:
-                raise CkanApiNotFoundError(self.last_message)
-            elif self.last_status == 403:
-                raise CkanApiNotAuthorizedError(self.last_message)
-            elif self.last_status == 409:
-                raise CkanApiConflictError(self.last_message)
+        response = self._open_url(url, data=data_json, stream=stream,
+                                  idempotent=idempotent, decode=not lazy)
+        if response.status not in (200, 201):
+            if response.status == 404:
+                raise CkanApiNotFoundError(response.message)
+            elif response.status == 403:
+                raise CkanApiNotAuthorizedError(response.message)
+            elif response.status == 409:
+                raise CkanApiConflictError(response.message)
             else:
-                raise CkanApiError(self.last_message)
-        self.last_help = self.last_message['help']
-        if self.last_message['success']:
-            self.last_result = self.last_message['result']
+                raise CkanApiError(response.message)
+        if stream:
+            return self._iter_action_result(response.fp)
+        if lazy:
+            response.message = self._decode_lazily(response.body, 'result',
+                                                   fields)
+        response.help = response.message['help']
+        if response.message['success']:
+            response.result = response.message['result']
+            if fields is not None and not lazy:
+                response.result = lazyjson.project(response.result, fields)
         else:
-            self.last_ckan_error = self.last_message['error']
-            raise CkanApiActionError(self.last_ckan_error)
-        return self.last_result
+            response.ckan_error = response.message['error']
+            raise CkanApiActionError(response.ckan_error)
+        return response.result
+
+    def _decode_lazily(self, body, key, fields=None):
+        '''Decode the JSON object in `body`, except that its `key` member
+        is given as a LazyObject (or a list of them) with only `fields`.'''
+        message = LazyObject(body)
+        decoded = dict((name, message[name]) for name in message
+                       if name != key)
+        if key in message:
+            decoded[key] = message.get_lazy(key, fields)
+        return decoded
+
+    def _iter_action_result(self, response):
+        envelope = {}
+        for item in jsonstream.iter_array(response, 'result', envelope):
+            yield item
+        if 'error' in envelope:
+            raise CkanApiActionError(envelope['error'])
 
     def api_version_get(self):
-        self.reset()
         url = self.get_location('Base')
-        self.open_url(url)
-        version = self.last_message['version']
+        version = self.open_url(url).message['version']
         return version    
 
 
@@ -242,171 +527,275 @@ class CkanClient(object):
     # Model API
     #
 
-    def package_register_get(self):
-        self.reset()
+    def package_register_get(self, stream=False):
+        '''Returns the list of package names, or with stream=True a generator
+        that decodes them as the response is read.'''
         url = self.get_location('Package Register')
-        self.open_url(url)
-        return self.last_message
+        response = self.open_url(url, stream=stream)
+        if stream:
+            return jsonstream.iter_array(response.fp)
+        return response.message
 
     def package_register_post(self, package_dict):
-        self.reset()
         url = self.get_location('Package Register')
         data = self._dumpstr(package_dict)
-        self.open_url(url, data)
-        return self.last_message
+        return self.open_url(url, data).message
 
-    def package_entity_get(self, package_name):
-        self.reset()
+    def package_entity_get(self, package_name, fields=None, lazy=False):
+        '''Return a package dict.
+
+        :param fields: only return these fields. Default *None* (all
+            fields)
+        :param lazy: return a ckanclient.lazyjson.LazyObject, which decodes
+            nested sections (resources, extras ...) when first accessed.
+            Default *False*
+        '''
         url = self.get_location('Package Entity', package_name)
-        self.open_url(url)
-        return self.last_message
+        if lazy:
+            return LazyObject(self.open_url(url, decode=False).body,
+                              fields=fields)
+        package = self.open_url(url).message
+        if fields is not None:
+            package = lazyjson.project(package, fields)
+        return package
 
     def package_entity_put(self, package_dict, package_name=None):
         # You only need to specify the current package_name if you
         # are giving it a new package_name in the package_dict.
-        self.reset()
         if not package_name:
             package_name = package_dict['name']
         url = self.get_location('Package Entity', package_name)
         data = self._dumpstr(package_dict)
-        self.open_url(url, data, method='PUT')
-        return self.last_message
+        return self.open_url(url, data, method='PUT').message
 
     def package_entity_delete(self, package_name):
-        self.reset()
         url = self.get_location('Package Register', package_name)
-        self.open_url(url, method='DELETE')
-        return self.last_message
+        return self.open_url(url, method='DELETE').message
 
     def package_relationship_register_get(self, package_name,
                 relationship_type='relationships', 
                 relationship_with_package_name=None):
-        self.reset()
         url = self.get_location('Package Entity',
            entity_id=package_name,
            subregister=relationship_type,
            entity2_id=relationship_with_package_name)
-        self.open_url(url)
-        return self.last_message
+        return self.open_url(url).message
 
     def package_relationship_entity_post(self, subject_package_name,
                 relationship_type, object_package_name, comment=u''):
-        self.reset()
         url = self.get_location('Package Entity',
             entity_id=subject_package_name,
             subregister=relationship_type,
             entity2_id=object_package_name)
         data = self._dumpstr({'comment':comment})
-        self.open_url(url, data, method='POST')
-        return self.last_message
+        return self.open_url(url, data, method='POST').message
 
     def package_relationship_entity_put(self, subject_package_name,
                 relationship_type, object_package_name, comment=u''):
-        self.reset()
         url = self.get_location('Package Entity',
             entity_id=subject_package_name,
             subregister=relationship_type,
             entity2_id=object_package_name)
         data = self._dumpstr({'comment':comment})
-        self.open_url(url, data, method='PUT')
-        return self.last_message
+        return self.open_url(url, data, method='PUT').message
 
     def package_relationship_entity_delete(self, subject_package_name,
                 relationship_type, object_package_name):
-        self.reset()
         url = self.get_location('Package Entity',
             entity_id=subject_package_name,
             subregister=relationship_type,
             entity2_id=object_package_name)
-        self.open_url(url, method='DELETE')
-        return self.last_message
+        return self.open_url(url, method='DELETE').message
 
-    def tag_register_get(self):
-        self.reset()
+    def tag_register_get(self, stream=False):
+        '''Returns the list of tag names, or with stream=True a generator
+        that decodes them as the response is read.'''
         url = self.get_location('Tag Register')
-        self.open_url(url)
-        return self.last_message
+        response = self.open_url(url, stream=stream)
+        if stream:
+            return jsonstream.iter_array(response.fp)
+        return response.message
 
     def tag_entity_get(self, tag_name):
-        self.reset()
         url = self.get_location('Tag Entity', tag_name)
-        self.open_url(url)
-        return self.last_message
+        return self.open_url(url).message
 
     def group_register_post(self, group_dict):
-        self.reset()
         url = self.get_location('Group Register')
         data = self._dumpstr(group_dict)
-        self.open_url(url, data)
-        return self.last_message
+        return self.open_url(url, data).message
 
-    def group_register_get(self):
-        self.reset()
+    def group_register_get(self, stream=False):
+        '''Returns the list of group names, or with stream=True a generator
+        that decodes them as the response is read.'''
         url = self.get_location('Group Register')
-        self.open_url(url)
-        return self.last_message
+        response = self.open_url(url, stream=stream)
+        if stream:
+            return jsonstream.iter_array(response.fp)
+        return response.message
 
     def group_entity_delete(self, group_name):
-        self.reset()
         url = self.get_location('Group Register', group_name)
-        self.open_url(url, method='DELETE')
-        return self.last_message
+        return self.open_url(url, method='DELETE').message
 
 
     def group_entity_get(self, group_name):
-        self.reset()
         url = self.get_location('Group Entity', group_name)
-        self.open_url(url)
-        return self.last_message
+        return self.open_url(url).message
 
     def group_entity_put(self, group_dict, group_name=None):
         # You only need to specify the current group_name if you
         # are giving it a new group_name in the group_dict.
-        self.reset()
         if not group_name:
             group_name = group_dict['name']
         url = self.get_location('Group Entity', group_name)
         data = self._dumpstr(group_dict)
-        self.open_url(url, data, method='PUT')
-        return self.last_message
+        return self.open_url(url, data, method='PUT').message
+
+    def revision_entity_get(self, revision_id):
+        '''Return a revision dict, with its timestamp and the packages and
+        groups it changed.'''
+        url = self.get_location('Revision Entity', revision_id)
+        return self.open_url(url).message
 
     #
     # Search API
     #
 
-    def package_search(self, q, search_options=None):
-        self.reset()
+    def package_search(self, q, search_options=None, prefetch=0,
+                       num_workers=None, page_size=None, fields=None,
+                       lazy=False):
+        '''Search for packages. Unless an offset is given, the 'results' of
+        the returned dict is a ckanclient.search.SearchResults iterating
+        over all the pages of results, which also has the paging stats().
+
+        :param prefetch: number of pages to request in the background while
+            the caller works through the current one. Default *0* (each
+            page is requested when the previous one is used up)
+        :param num_workers: request all the remaining pages at once with
+            this many threads, still yielding the results in rank order.
+            Default *None*
+        :param page_size: a ckanclient.search.AdaptivePageSize to choose
+            the limit of each page, rather than the limit in search_options
+            or PAGE_SIZE. Default *None*
+        :param fields: with all_fields, only return these fields of each
+            package. They are asked of the server as 'fl' and any others it
+            sends are dropped as each page is decoded. Default *None*
+        :param lazy: with all_fields, return each package as a
+            ckanclient.lazyjson.LazyObject, which decodes nested sections
+            (resources, extras ...) when first accessed. Default *False*
+        '''
+        if num_workers and page_size is not None:
+            raise ValueError('An adaptive page_size needs each page to be '
+                             'fetched in turn, so not with num_workers')
         search_options = search_options.copy() if search_options else {}
         url = self.get_location('Package Search')
         search_options['q'] = q
         if not search_options.get('limit'):
             search_options['limit'] = PAGE_SIZE
-        data = self._dumpstr(search_options)
-        self.open_url(url, data)
-        result_dict = self.last_message
-        if not search_options.get('offset'):
-            result_dict['results'] = self._result_generator(result_dict['count'], result_dict['results'], self.package_search, q, search_options)
+        if fields is not None and search_options.get('all_fields'):
+            search_options.setdefault('fl', ' '.join(fields))
+
+        def fetch_page(offset, limit):
+            options = dict(search_options, limit=limit)
+            if offset:
+                options['offset'] = offset
+            try:
+                response = self.open_url(url, self._dumpstr(options),
+                                         idempotent=True, decode=not lazy)
+            except CkanApiError:
+                if page_size is not None and \
+                       self.last_status in REJECTED_STATUSES:
+                    raise PageSizeRejected(limit, sys.exc_info())
+                raise
+            if lazy:
+                result_dict = self._decode_lazily(response.body, 'results',
+                                                  fields)
+            else:
+                result_dict = response.message
+                if fields is not None:
+                    result_dict['results'] = lazyjson.project(
+                        result_dict['results'], fields)
+            return result_dict, len(response.body)
+
+        if search_options.get('offset'):
+            # a single page, so there is no size to adapt
+            page_size = None
+            return fetch_page(search_options['offset'],
+                              search_options['limit'])[0]
+        if page_size is not None:
+            result_dict, limit = page_size.fetch(fetch_page, 0)
+        else:
+            limit = search_options['limit']
+            result_dict = fetch_page(0, limit)[0]
+        result_dict['results'] = SearchResults(
+            result_dict['results'], fetch_page, result_dict['count'], limit,
+            prefetch, num_workers, page_size)
         return result_dict
 
-    def _result_generator(self, count, results, func, q, search_options):
-        '''Returns a generator that will make the necessary calls to page
-        through results.'''
-        page = 0
-        num_pages = (count + search_options['limit'] - 1) / search_options['limit']
-        while True:
-            for res in results:
-                yield res
-
-            # go to next page?
-            page += 1
-            if page >= num_pages:
-                break
+    def revision_search(self, since_id=None, since_time=None):
+        '''Return the ids of the revisions made after revision `since_id`,
+        or after `since_time` (an ISO timestamp), oldest first. Servers
+        return up to 50 at a time, so ask again after the last one for
+        more.'''
+        params = {}
+        if since_id is not None:
+            params['since_id'] = since_id
+        if since_time is not None:
+            params['since_time'] = since_time
+        url = '%s?%s' % (self.get_location('Revision Search'),
+                         urlencode(params))
+        return self.open_url(url).message
+
+    def package_search_keyset(self, q, search_options=None, cursor=None,
+                              prefetch=0):
+        '''Search for packages, paging by key rather than by offset.
+
+        The results (package dicts) are sorted by metadata_modified and id,
+        and each page is asked for as the packages after the last one of
+        the page before. Deep pages are as quick for the server as the
+        first, and packages changed during the scan are not skipped or
+        repeated in place: they sort after the others and come up again.
+
+        Returns a dict like package_search's, with 'results' a
+        ckanclient.search.KeysetResults whose `cursor` is a token for
+        resuming the scan after the last result the caller has had.
+
+        :param cursor: resume after the result this token was taken at.
+            Default *None* (from the start)
+        :param prefetch: number of pages to request in the background while
+            the caller works through the current one. Default *0*
+        '''
+        search_options = search_options.copy() if search_options else {}
+        if search_options.get('offset'):
+            raise ValueError('Keyset paging does not take an offset')
+        url = self.get_location('Package Search')
+        search_options['q'] = q
+        search_options['all_fields'] = 1
+        search_options['sort'] = KEYSET_SORT
+        if not search_options.get('limit'):
+            search_options['limit'] = PAGE_SIZE
+        filter_query = search_options.pop('fq', None)
+
+        def fetch_page(key, limit):
+            options = dict(search_options, limit=limit)
+            filters = [filter_query] if filter_query else []
+            if key is not None:
+                filters.append(keyset_filter(key))
+            if filters:
+                options['fq'] = ' AND '.join('(%s)' % f for f in filters)
+            response = self.open_url(url, self._dumpstr(options),
+                                     idempotent=True)
+            return response.message, len(response.body)
+
+        key = decode_cursor(cursor) if cursor else None
+        limit = search_options['limit']
+        result_dict = fetch_page(key, limit)[0]
+        result_dict['results'] = KeysetResults(
+            result_dict['results'], fetch_page, result_dict['count'], limit,
+            prefetch, cursor)
+        return result_dict
 
-            # retrieve next page
-            search_options['offset'] = page * search_options['limit']
-            result_dict = func(q, search_options)
-            results = result_dict['results']
-            
     #
     # Storage API
     #
@@ -430,20 +819,17 @@ class CkanClient(object):
 
         '''
         url = self._storage_metadata_url(label)
-        self.open_url(url)
-        return self.last_message
+        return self.open_url(url).message
 
     def storage_metadata_set(self, label, metadata):
         url = self._storage_metadata_url(label)
         payload = self._dumpstr(metadata)
-        self.open_url(url, payload, method="PUT")
-        return self.last_message
+        return self.open_url(url, payload, method="PUT").message
 
     def storage_metadata_update(self, label, metadata):
         url = self._storage_metadata_url(label)
         payload = self._dumpstr(metadata)
-        self.open_url(url, payload, method="POST")
-        return self.last_message
+        return self.open_url(url, payload, method="POST").message
 
     def _storage_auth_url(self, label):
         url = self.base_location
@@ -456,8 +842,7 @@ class CkanClient(object):
     def storage_auth_get(self, label, headers):
         url = self._storage_auth_url(label)
         payload = self._dumpstr(headers)
-        self.open_url(url, payload, method="POST")
-        return self.last_message
+        return self.open_url(url, payload, method="POST").message
 
     #
     # Action API
@@ -465,16 +850,25 @@ class CkanClient(object):
 
     # for any action
     def action(self, action_name, **kwargs):
-        self.reset()
         url = '%s/action/%s' % (self.base_location, action_name)
-        self.open_action_url(url, kwargs)
-        return self.last_result
-
-    def package_list(self):
+        return self.open_action_url(url, kwargs,
+                                    idempotent=is_read_action(action_name))
+
+    def package_list(self, stream=False):
+        '''Returns the list of package names, or with stream=True a generator
+        that decodes them as the response is read.'''
+        if stream:
+            url = '%s/action/package_list' % self.base_location
+            return self.open_action_url(url, {}, stream=True,
+                                        idempotent=True)
         return self.action('package_list')
         
-    def package_show(self, package_id):
-        return self.action('package_show', id=package_id)
+    def package_show(self, package_id, fields=None, lazy=False):
+        '''Return a package dict from the package_show action. `fields`
+        and `lazy` are as for package_entity_get.'''
+        url = '%s/action/package_show' % self.base_location
+        return self.open_action_url(url, {'id': package_id}, idempotent=True,
+                                    fields=fields, lazy=lazy)
 
     def status_show(self):
         return self.action('status_show')
@@ -482,6 +876,60 @@ class CkanClient(object):
     def ckan_version(self):
         return self.action('status_show')['ckan_version']
 
+    #
+    # Bulk fetch
+    #
+
+    def package_entity_get_many(self, package_names,
+                                num_workers=workers.DEFAULT_WORKERS,
+                                ordered=False):
+        '''Fetch many packages with the REST API at once.
+
+        Yields (package_name, package) tuples as the fetches complete. If a
+        fetch fails, the exception (e.g. CkanApiNotFoundError) is given in
+        place of the package, and the rest of the batch carries on.
+
+        :param package_names: iterable of package names or ids
+        :param num_workers: number of concurrent requests. Default *8*
+        :param ordered: yield in the order of package_names. Default *False*
+
+        '''
+        return self._get_many('package_entity_get', package_names,
+                              num_workers, ordered)
+
+    def package_show_many(self, package_ids,
+                          num_workers=workers.DEFAULT_WORKERS, ordered=False):
+        '''Like package_entity_get_many, but with the package_show action.'''
+        return self._get_many('package_show', package_ids, num_workers,
+                              ordered)
+
+    def action_batch(self, actions, num_workers=workers.DEFAULT_WORKERS):
+        '''Run several actions at once.
+
+        Returns a list with the result of each action, in the order given.
+        An action that fails has its exception (e.g. CkanApiActionError) in
+        place of its result, rather than it being raised.
+
+        >>> client.action_batch([('status_show', {}),
+                                 ('package_show', {'id': 'mypkg'})])
+
+        :param actions: iterable of (action_name, data_dict) pairs
+        :param num_workers: number of concurrent requests. Default *8*
+
+        '''
+        def run(action):
+            action_name, data_dict = action
+            return self.action(action_name, **(data_dict or {}))
+        return [error if error is not None else result
+                for action, result, error in workers.imap(
+                    run, actions, num_workers, ordered=True)]
+
+    def _get_many(self, method_name, ids, num_workers, ordered):
+        fetch = getattr(self, method_name)
+        for id_, result, error in workers.imap(fetch, ids, num_workers,
+                                               ordered):
+            yield id_, (error if error is not None else result)
+
     #
     # Private Helpers
     #
@@ -670,7 +1118,6 @@ class CkanClient(object):
 ## ======================================
 ## Command line interface
 
-import sys
 import inspect
 import optparse
 import pprint
@@ -0,0 +1,467 @@
+'''asyncio counterpart to CkanClient, for making many concurrent read calls
+from one process without a thread per call.
+
+Needs trollius, the asyncio port for Python 2 (``pip install trollius``).
+Coroutines are written in trollius style, so results are fetched with
+``yield From(...)``::
+
+    import trollius as asyncio
+    from trollius import From
+    from ckanclient.aio import AsyncCkanClient
+
+    @asyncio.coroutine
+    def fetch(client, names):
+        packages = yield From(asyncio.gather(
+            *[client.package_entity_get(name) for name in names]))
+        ...
+
+    client = AsyncCkanClient('http://datahub.io/api', concurrency=20)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(fetch(client, names))
+
+Errors are raised as the same CkanApiError classes CkanClient uses.
+'''
+# NB trollius has not been put in setup.py since most users don't need this
+# client and it saves them the hassle of installing a dependency.
+import trollius as asyncio
+from trollius import From, Return
+
+import urlparse
+from collections import deque
+from urllib import urlencode
+
+from ckanclient import (CkanClient, CkanApiError, CkanApiNotFoundError,
+                        CkanApiNotAuthorizedError, CkanApiConflictError,
+                        CkanApiActionError, PAGE_SIZE)
+from ckanclient.connection import Inflater
+from ckanclient.retry import IDEMPOTENT_METHODS
+
+import logging
+logger = logging.getLogger('ckanclient.aio')
+
+
+class _StaleConnection(Exception):
+    '''A pooled connection was closed by the server while it sat idle.'''
+
+
+_CONNECTION_ERRORS = (_StaleConnection, EnvironmentError,
+                      asyncio.IncompleteReadError)
+
+
+class AsyncResponse(object):
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers # dict with lower-cased names
+        self.body = body
+
+
+class AsyncConnectionPool(object):
+    '''Idle keep-alive stream connections, kept per (host, port, ssl).'''
+    def __init__(self, maxsize=10, loop=None):
+        self.maxsize = maxsize
+        self._loop = loop
+        self._idle = {}
+        self._stats = {'connects': 0, 'reuses': 0, 'stale': 0}
+
+    @asyncio.coroutine
+    def get(self, key):
+        '''Returns a (reader, writer, reused) tuple.'''
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if reader.at_eof():
+                writer.close()
+                continue
+            self._stats['reuses'] += 1
+            raise Return((reader, writer, True))
+        host, port, use_ssl = key
+        self._stats['connects'] += 1
+        reader, writer = yield From(asyncio.open_connection(
+            host, port, ssl=use_ssl or None, loop=self._loop))
+        raise Return((reader, writer, False))
+
+    def put(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def count_stale(self):
+        self._stats['stale'] += 1
+
+    def clear(self, key=None):
+        '''Close the idle connections for `key`, or all of them.'''
+        if key is None:
+            idle, self._idle = self._idle, {}
+        else:
+            idle = {key: self._idle.pop(key, [])}
+        for conns in idle.values():
+            for reader, writer in conns:
+                writer.close()
+
+    def stats(self):
+        return dict(self._stats)
+
+
+class AsyncSearchResults(object):
+    '''Pages through package_search results.
+
+    Call the ``next()`` coroutine until it returns None::
+
+        while True:
+            package = yield From(results.next())
+            if package is None:
+                break
+    '''
+    def __init__(self, client, q, search_options, count, results):
+        self._client = client
+        self._q = q
+        self._search_options = search_options
+        self._limit = search_options['limit']
+        self._num_pages = (count + self._limit - 1) // self._limit
+        self._page = 0
+        self._results = deque(results)
+
+    @asyncio.coroutine
+    def next(self):
+        while not self._results:
+            self._page += 1
+            if self._page >= self._num_pages:
+                raise Return(None)
+            search_options = dict(self._search_options,
+                                  offset=self._page * self._limit)
+            result_dict = yield From(self._client._search_page(
+                self._q, search_options))
+            self._results = deque(result_dict['results'])
+        raise Return(self._results.popleft())
+
+    @asyncio.coroutine
+    def all(self):
+        '''Fetch the remaining results into a list.'''
+        results = []
+        while True:
+            result = yield From(self.next())
+            if result is None:
+                raise Return(results)
+            results.append(result)
+
+
+class AsyncCkanClient(object):
+    '''asyncio client API implementation for CKAN.
+
+    :param base_location: default *http://datahub.io/api*
+    :param api_key: default *None*
+    :param user_agent: Identify your tool. Default *ckanclient*
+    :param concurrency: maximum number of requests in flight at once.
+        Default *10*
+    :param pool_maxsize: idle connections kept per host. Default *10*
+    :param compression: ask for gzip/deflate compressed responses.
+        Default *True*
+    :param timeout: seconds to wait for each request. Default *None*
+    :param loop: event loop to use. Default is the current event loop.
+
+    '''
+    base_location = CkanClient.base_location
+    resource_paths = CkanClient.resource_paths
+
+    # URL building, (de)serialisation and config are shared with CkanClient
+    get_location = CkanClient.__dict__['get_location']
+    _dumpstr = CkanClient.__dict__['_dumpstr']
+    _loadstr = CkanClient.__dict__['_loadstr']
+    _storage_metadata_url = CkanClient.__dict__['_storage_metadata_url']
+    _storage_auth_url = CkanClient.__dict__['_storage_auth_url']
+    _get_api_key_from_config = CkanClient.__dict__['_get_api_key_from_config']
+
+    def __init__(self, base_location=None, api_key=None, user_agent=None,
+                 concurrency=10, pool_maxsize=10, compression=True,
+                 timeout=None, loop=None):
+        if base_location is not None:
+            self.base_location = base_location
+        if api_key:
+            self.api_key = api_key
+        else:
+            self.api_key = self._get_api_key_from_config()
+        self.user_agent = user_agent or 'ckanclient'
+        self.compression = compression
+        self.timeout = timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._semaphore = asyncio.Semaphore(concurrency, loop=self._loop)
+        self.connection_pool = AsyncConnectionPool(pool_maxsize,
+                                                   loop=self._loop)
+
+    def close(self):
+        '''Close the idle connections kept for reuse.'''
+        self.connection_pool.clear()
+
+    #
+    # Transport
+    #
+
+    @asyncio.coroutine
+    def _open_url(self, location, data=None, method=None):
+        '''Make a request and return an AsyncResponse. `data` is sent the
+        same way CkanClient sends it.'''
+        if data is not None:
+            data = urlencode({data: 1})
+            method = method or 'POST'
+        else:
+            method = method or 'GET'
+        parsed = urlparse.urlsplit(location)
+        use_ssl = parsed.scheme == 'https'
+        port = parsed.port or (443 if use_ssl else 80)
+        key = (parsed.hostname, port, use_ssl)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        headers = [
+            ('Host', parsed.netloc),
+            ('Authorization', self.api_key),
+            ('X-CKAN-API-Key', self.api_key),
+            ('User-Agent', self.user_agent),
+        ]
+        if self.compression:
+            headers.append(('Accept-Encoding', 'gzip, deflate'))
+        if data is not None:
+            headers.append(('Content-Type',
+                            'application/x-www-form-urlencoded'))
+            headers.append(('Content-Length', str(len(data))))
+        request = '%s %s HTTP/1.1\r\n%s\r\n\r\n' % (method, path,
+            '\r\n'.join('%s: %s' % header for header in headers))
+        if data is not None:
+            request += data
+
+        with (yield From(self._semaphore)):
+            request_coro = self._send(key, method, request)
+            if self.timeout:
+                request_coro = asyncio.wait_for(request_coro, self.timeout,
+                                                loop=self._loop)
+            response = yield From(request_coro)
+        raise Return(response)
+
+    @asyncio.coroutine
+    def _send(self, key, method, request):
+        reader, writer, reused = yield From(self.connection_pool.get(key))
+        try:
+            response, keep_alive = yield From(
+                self._exchange(reader, writer, method, request))
+        except _CONNECTION_ERRORS, err:
+            writer.close()
+            if not reused or method not in IDEMPOTENT_METHODS:
+                # the server may have acted on the request before it closed
+                # the connection, so only idempotent ones are sent again
+                raise CkanApiError('Connection failed: %r' % err)
+            # the server closed the idle connection, so likely its others to
+            # the same host too - try a fresh one once
+            self.connection_pool.count_stale()
+            self.connection_pool.clear(key)
+            reader, writer, reused = yield From(self.connection_pool.get(key))
+            try:
+                response, keep_alive = yield From(
+                    self._exchange(reader, writer, method, request))
+            except _CONNECTION_ERRORS, err:
+                writer.close()
+                raise CkanApiError('Connection failed: %r' % err)
+        except:
+            writer.close()
+            raise
+        if keep_alive:
+            self.connection_pool.put(key, reader, writer)
+        else:
+            writer.close()
+        raise Return(response)
+
+    @asyncio.coroutine
+    def _exchange(self, reader, writer, method, request):
+        writer.write(request)
+        yield From(writer.drain())
+        status_line = yield From(reader.readline())
+        if not status_line:
+            raise _StaleConnection()
+        version, status, reason = (status_line.rstrip('\r\n').split(' ', 2)
+                                   + [''])[:3]
+        status = int(status)
+        headers = {}
+        while True:
+            line = yield From(reader.readline())
+            line = line.rstrip('\r\n')
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        encoding = headers.get('content-encoding', '').lower()
+        inflater = Inflater(encoding) if encoding in ('gzip', 'deflate') \
+                   else None
+        chunks = []
+        def add(chunk):
+            chunks.append(inflater.decompress(chunk) if inflater else chunk)
+
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            pass
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = yield From(reader.readline())
+                size = int(size_line.split(';')[0].strip(), 16)
+                if size == 0:
+                    # skip trailers
+                    while (yield From(reader.readline())) not in ('\r\n', ''):
+                        pass
+                    break
+                chunk = yield From(reader.readexactly(size + 2))
+                add(chunk[:-2])
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if length:
+                add((yield From(reader.readexactly(length))))
+        else:
+            keep_alive = False
+            while True:
+                chunk = yield From(reader.read(64 * 1024))
+                if not chunk:
+                    break
+                add(chunk)
+        if inflater:
+            chunks.append(inflater.flush())
+        response = AsyncResponse(status, reason, headers, ''.join(chunks))
+        raise Return((response, keep_alive))
+
+    def _decode(self, response):
+        if 'json' in response.headers.get('content-type', ''):
+            return self._loadstr(response.body)
+        return response.body
+
+    def _raise_for_status(self, response, error_arg):
+        if response.status in (200, 201):
+            return
+        if response.status == 404:
+            raise CkanApiNotFoundError(error_arg)
+        elif response.status == 403:
+            raise CkanApiNotAuthorizedError(error_arg)
+        elif response.status == 409:
+            raise CkanApiConflictError(error_arg)
+        else:
+            raise CkanApiError(self._decode(response))
+
+    @asyncio.coroutine
+    def open_url(self, url, data=None, method=None):
+        '''Request `url` and return the decoded response body.'''
+        response = yield From(self._open_url(url, data, method=method))
+        self._raise_for_status(response, response.status)
+        raise Return(self._decode(response))
+
+    @asyncio.coroutine
+    def open_action_url(self, url, data_dict):
+        response = yield From(self._open_url(url, self._dumpstr(data_dict)))
+        message = self._decode(response)
+        self._raise_for_status(response, message)
+        if not message['success']:
+            raise CkanApiActionError(message['error'])
+        raise Return(message['result'])
+
+    @asyncio.coroutine
+    def api_version_get(self):
+        message = yield From(self.open_url(self.get_location('Base')))
+        raise Return(message['version'])
+
+    #
+    # Model API
+    #
+
+    def package_register_get(self):
+        return self.open_url(self.get_location('Package Register'))
+
+    def package_entity_get(self, package_name):
+        return self.open_url(self.get_location('Package Entity',
+                                               package_name))
+
+    def package_relationship_register_get(self, package_name,
+                relationship_type='relationships',
+                relationship_with_package_name=None):
+        return self.open_url(self.get_location('Package Entity',
+            entity_id=package_name,
+            subregister=relationship_type,
+            entity2_id=relationship_with_package_name))
+
+    def tag_register_get(self):
+        return self.open_url(self.get_location('Tag Register'))
+
+    def tag_entity_get(self, tag_name):
+        return self.open_url(self.get_location('Tag Entity', tag_name))
+
+    def group_register_get(self):
+        return self.open_url(self.get_location('Group Register'))
+
+    def group_entity_get(self, group_name):
+        return self.open_url(self.get_location('Group Entity', group_name))
+
+    #
+    # Search API
+    #
+
+    @asyncio.coroutine
+    def _search_page(self, q, search_options):
+        url = self.get_location('Package Search')
+        search_options = dict(search_options, q=q)
+        result_dict = yield From(self.open_url(
+            url, self._dumpstr(search_options)))
+        raise Return(result_dict)
+
+    @asyncio.coroutine
+    def package_search(self, q, search_options=None):
+        '''Like CkanClient.package_search, except that unless an offset is
+        given, 'results' is an AsyncSearchResults paging through all the
+        results.'''
+        search_options = search_options.copy() if search_options else {}
+        if not search_options.get('limit'):
+            search_options['limit'] = PAGE_SIZE
+        result_dict = yield From(self._search_page(q, search_options))
+        if not search_options.get('offset'):
+            result_dict['results'] = AsyncSearchResults(
+                self, q, search_options, result_dict['count'],
+                result_dict['results'])
+        raise Return(result_dict)
+
+    #
+    # Storage API
+    #
+
+    def storage_metadata_get(self, label):
+        return self.open_url(self._storage_metadata_url(label))
+
+    def storage_metadata_set(self, label, metadata):
+        return self.open_url(self._storage_metadata_url(label),
+                             self._dumpstr(metadata), method='PUT')
+
+    def storage_metadata_update(self, label, metadata):
+        return self.open_url(self._storage_metadata_url(label),
+                             self._dumpstr(metadata), method='POST')
+
+    def storage_auth_get(self, label, headers):
+        return self.open_url(self._storage_auth_url(label),
+                             self._dumpstr(headers), method='POST')
+
+    #
+    # Action API
+    #
+
+    def action(self, action_name, **kwargs):
+        url = '%s/action/%s' % (self.base_location, action_name)
+        return self.open_action_url(url, kwargs)
+
+    def package_list(self):
+        return self.action('package_list')
+
+    def package_show(self, package_id):
+        return self.action('package_show', id=package_id)
+
+    def status_show(self):
+        return self.action('status_show')
+
+    @asyncio.coroutine
+    def ckan_version(self):
+        status = yield From(self.action('status_show'))
+        raise Return(status['ckan_version'])
@@ -0,0 +1,329 @@
+'''Batching of DataStore (ElasticSearch) _bulk loads.
+
+``DataStoreClient.upsert`` turns each document into a bulk entry (an
+action line and a source line) and sends the entries in batches, each
+closed when it reaches a byte and/or document budget, so request sizes
+stay even however wide the rows are::
+
+    stats = client.upsert(rows, max_bytes=5 * 1024 * 1024, max_docs=5000)
+    print stats['docs_per_sec'], stats['bytes_per_sec']
+
+With ``num_workers=N`` the batches are serialized in one thread and sent
+by N others, up to ``queue_size`` batches being queued or in flight at
+once, which caps the memory used.
+
+With ``stream=True`` each request body is written to the connection with
+chunked transfer encoding as the documents are serialized, so a batch is
+never built in memory.
+'''
+import json
+import time
+import threading
+
+from ckanclient import workers
+
+import logging
+logger = logging.getLogger('ckanclient.bulk')
+
+# bytes of bulk entries per request
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+# bytes per chunk of a streamed request body
+CHUNK_SIZE = 64 * 1024
+# the error of documents whose outcome the _bulk response doesn't give
+UNKNOWN_OUTCOME = 'unknown outcome: _bulk response has %s items for %s ' \
+                  'documents'
+
+
+def bulk_entry(dict_):
+    '''The action and source lines to index a document, its 'id' being the
+    document id if it has one.'''
+    bulkmeta = {'index': {}}
+    if 'id' in dict_:
+        bulkmeta['index']['_id'] = dict_['id']
+    return '%s\n%s\n' % (json.dumps(bulkmeta), json.dumps(dict_))
+
+
+def batches(dict_iterator, max_bytes=DEFAULT_MAX_BYTES, max_docs=None):
+    '''Yield (entries, size) for batches of the documents' bulk entries,
+    each of at most `max_bytes` (unless a single entry is bigger) and
+    `max_docs` entries. Either budget may be None, but not both.'''
+    if not max_bytes and not max_docs:
+        raise ValueError('A batch needs max_bytes or max_docs')
+    batch = []
+    size = 0
+    for dict_ in dict_iterator:
+        entry = bulk_entry(dict_)
+        if batch and ((max_bytes and size + len(entry) > max_bytes) or
+                      (max_docs and len(batch) >= max_docs)):
+            yield batch, size
+            batch = []
+            size = 0
+        batch.append(entry)
+        size += len(entry)
+    if batch:
+        yield batch, size
+
+
+class _Peekable(object):
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._next = None
+
+    def peek(self):
+        if self._next is None:
+            self._next = next(self._iter, None)
+        return self._next
+
+    def take(self):
+        item, self._next = self.peek(), None
+        return item
+
+
+class StreamedBatch(object):
+    '''Iterator over the bulk entries of one batch, serialized as they are
+    taken. `docs` and `size` count the entries taken so far, and with
+    `keep` `entries` lists them.'''
+    def __init__(self, entries, max_bytes, max_docs, keep=False):
+        self._entries = entries
+        self._max_bytes = max_bytes
+        self._max_docs = max_docs
+        self.docs = 0
+        self.size = 0
+        self.entries = [] if keep else None
+
+    def __iter__(self):
+        while True:
+            entry = self._entries.peek()
+            if entry is None:
+                return
+            if self.docs and (
+                    (self._max_bytes and
+                     self.size + len(entry) > self._max_bytes) or
+                    (self._max_docs and self.docs >= self._max_docs)):
+                return
+            self._entries.take()
+            self.docs += 1
+            self.size += len(entry)
+            if self.entries is not None:
+                self.entries.append(entry)
+            yield entry
+
+
+def stream_batches(dict_iterator, max_bytes=DEFAULT_MAX_BYTES,
+                   max_docs=None, keep=False):
+    '''Like batches(), but yield each batch as a StreamedBatch, which must
+    be used up before the next is taken. With `keep` the batches keep
+    their entries.'''
+    if not max_bytes and not max_docs:
+        raise ValueError('A batch needs max_bytes or max_docs')
+    entries = _Peekable(bulk_entry(dict_) for dict_ in dict_iterator)
+    while entries.peek() is not None:
+        batch = StreamedBatch(entries, max_bytes, max_docs, keep)
+        yield batch
+        if not batch.docs:
+            raise RuntimeError('StreamedBatch not used before the next')
+
+
+def chunks(entries, chunk_size=CHUNK_SIZE):
+    '''Join entries into chunks of about `chunk_size` bytes, to write
+    them with fewer calls.'''
+    buffered = []
+    size = 0
+    for entry in entries:
+        buffered.append(entry)
+        size += len(entry)
+        if size >= chunk_size:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+class BulkError(Exception):
+    '''Raised when _bulk requests of a load failed.
+
+    :ivar failures: (offset, docs, error) for each failed request in the
+        order of the documents, `offset` being the index of its first
+        document and `docs` the number of documents in it
+    :ivar summary: the load's summary, as upsert returns it
+
+    '''
+    def __init__(self, failures, summary=None):
+        offset, docs, error = failures[0]
+        Exception.__init__(self, '%s _bulk request(s) failed, the first '
+                           'with documents %s to %s: %s' % (
+                               len(failures), offset, offset + docs - 1,
+                               error))
+        self.failures = failures
+        self.summary = summary
+
+
+def send_concurrently(send, batches, num_workers, queue_size=None):
+    '''Call `send(offset, batch)` for each batch in `num_workers` threads,
+    `offset` being the index of its first document, while the batches are
+    taken from the iterator in another. At most
+    `queue_size` (default 2 x num_workers) batches are queued or in flight.
+
+    After a request fails no more batches are taken, and once those in
+    flight are done a BulkError is raised with the failures in order.
+    '''
+    failed = threading.Event()
+
+    def numbered():
+        offset = 0
+        for batch in batches:
+            if failed.is_set():
+                return
+            yield offset, batch
+            offset += len(batch[0])
+
+    failures = []
+    for (offset, batch), result, error in workers.imap(
+            lambda item: send(*item), numbered(), num_workers,
+            ordered=True, window=queue_size or 2 * num_workers):
+        if error is not None:
+            failed.set()
+            failures.append((offset, len(batch[0]), error))
+    if failures:
+        raise BulkError(failures)
+
+
+def item_errors(response):
+    '''Yield (status, error) for each item of a decoded _bulk response,
+    error being None for an item that succeeded.'''
+    for item in response.get('items') or []:
+        # {action: result}, e.g. {"index": {"_id": .., "status": 201}}
+        result = item.values()[0] if item else {}
+        status = result.get('status')
+        error = result.get('error')
+        if error is None and status is not None and status >= 300:
+            error = 'status %s' % status
+        yield status, error
+
+
+def is_rejected(status, error):
+    '''Whether an item was rejected because the server was busy (its
+    queues full), so may succeed if sent again.'''
+    if status == 429:
+        return True
+    # "EsRejectedExecutionException[...]" or {"type":
+    # "es_rejected_execution_exception", ...}
+    return 'rejectedexecution' in repr(error).lower().replace('_', '')
+
+
+class BulkStats(object):
+    '''Counters of a bulk load, which may be updated from several
+    threads.
+
+    :param max_errors: most document errors kept for the summary.
+        Default *100*
+
+    '''
+    def __init__(self, max_errors=100):
+        self.max_errors = max_errors
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._errors = []
+        self._stats = {
+            'docs': 0,       # documents sent
+            'bytes': 0,      # bytes of bulk entries sent, including retries
+            'requests': 0,   # _bulk requests made, including retries
+            'indexed': 0,    # documents indexed
+            'failed': 0,     # documents that failed, even after retries
+            'retried': 0,    # documents sent again after being rejected
+        }
+
+    def add(self, docs, size):
+        '''Count a _bulk request of `docs` documents and `size` bytes.'''
+        with self._lock:
+            self._stats['docs'] += docs
+            self._stats['bytes'] += size
+            self._stats['requests'] += 1
+
+    def add_retry(self, docs, size):
+        '''Count a _bulk request resending `docs` rejected documents.'''
+        with self._lock:
+            self._stats['retried'] += docs
+            self._stats['bytes'] += size
+            self._stats['requests'] += 1
+
+    def indexed(self, docs):
+        with self._lock:
+            self._stats['indexed'] += docs
+
+    def failed(self, index, status, error):
+        '''Count the failure of the document at `index` of the load.'''
+        with self._lock:
+            self._stats['failed'] += 1
+            if len(self._errors) < self.max_errors:
+                self._errors.append((index, status, error))
+
+    def summary(self):
+        '''Return a dict of the counters, the seconds elapsed since the load
+        started, the throughput in docs_per_sec and bytes_per_sec and the
+        errors: (index, status, error) for the first documents that
+        failed.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['errors'] = sorted(self._errors)
+        elapsed = time.time() - self._start
+        stats['elapsed'] = elapsed
+        stats['docs_per_sec'] = stats['docs'] / elapsed if elapsed else 0.0
+        stats['bytes_per_sec'] = stats['bytes'] / elapsed if elapsed else 0.0
+        return stats
+
+
+def check_items(response, offset, entries, resend, stats, retry=None):
+    '''Count the outcome of each document of a _bulk request from its
+    decoded `response`, resending those rejected with `resend(entries)`,
+    which returns the decoded response to them, as `retry` (a
+    ckanclient.retry.RetryPolicy) allows.
+
+    :param offset: index in the load of the request's first document
+    :param entries: the request's bulk entries
+
+    If the response doesn't have an item for each document, all of them are
+    counted as failed, with an unknown outcome.
+
+    '''
+    positions = range(len(entries))
+    attempt = 0
+    while True:
+        if response.get('errors') is False:
+            # ElasticSearch says there were none
+            stats.indexed(len(positions))
+            return
+        results = list(item_errors(response))
+        if len(results) != len(positions):
+            # which documents the items are for is unknown, so none can be
+            # counted as indexed
+            logger.warning('_bulk response has %s items for %s documents',
+                           len(results), len(positions))
+            error = UNKNOWN_OUTCOME % (len(results), len(positions))
+            for position in positions:
+                stats.failed(offset + position, None, error)
+            return
+        rejected = []
+        indexed = 0
+        for position, (status, error) in zip(positions, results):
+            if error is None:
+                indexed += 1
+            elif retry is not None and attempt < retry.max_retries and \
+                     is_rejected(status, error):
+                rejected.append(position)
+            else:
+                stats.failed(offset + position, status, error)
+        stats.indexed(indexed)
+        if not rejected:
+            return
+        delay = retry.backoff(attempt, None)
+        logger.info('Resending %s rejected documents in %.2fs',
+                    len(rejected), delay)
+        time.sleep(delay)
+        attempt += 1
+        positions = rejected
+        retry_entries = [entries[position] for position in positions]
+        stats.add_retry(len(retry_entries),
+                        sum(len(entry) for entry in retry_entries))
+        response = resend(retry_entries)
@@ -0,0 +1,249 @@
+'''Conditional-GET response cache for the CKAN client.
+
+GET responses that carry an ``ETag`` or ``Last-Modified`` header are kept in
+a cache. The next GET of the same URL is sent with ``If-None-Match`` /
+``If-Modified-Since`` and a ``304 Not Modified`` reply is answered from the
+cache, so unchanged packages, groups and tags aren't downloaded again::
+
+    client = CkanClient(cache=ResponseCache(max_entries=5000))
+
+``ResponseCache`` keeps entries in memory and ``DiskResponseCache`` in a
+directory, so they survive between runs. Both evict the least recently used
+entries once ``max_entries`` or ``max_bytes`` is exceeded.
+'''
+import os
+import hashlib
+import mimetools
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from StringIO import StringIO
+from urllib2 import BaseHandler, addinfourl
+
+import logging
+logger = logging.getLogger('ckanclient.cache')
+
+
+class ResponseCache(object):
+    '''In-memory LRU cache of GET responses.
+
+    :param max_entries: most responses kept. Default *1000*
+    :param max_bytes: most bytes of response bodies and headers kept.
+        Default *None* (no limit)
+
+    '''
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._index = OrderedDict() # key: size, least recently used first
+        self._entries = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,        # 304 responses answered from the cache
+            'misses': 0,      # full responses downloaded
+            'stores': 0,      # responses added to the cache
+            'evictions': 0,   # entries evicted to stay within the limits
+        }
+
+    def get(self, key):
+        '''Return the entry dict for `key` or None.'''
+        with self._lock:
+            if key not in self._index:
+                return None
+            entry = self._load(key)
+            if entry is None:
+                self._discard(key)
+                return None
+            # mark as most recently used
+            self._index[key] = self._index.pop(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            if key in self._index:
+                self._discard(key)
+            size = self._save(key, entry)
+            if self.max_bytes is not None and size > self.max_bytes:
+                self._remove(key)
+                return
+            self._index[key] = size
+            self._bytes += size
+            self._stats['stores'] += 1
+            while self._index and (
+                    (self.max_entries is not None and
+                     len(self._index) > self.max_entries) or
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes)):
+                oldest = next(iter(self._index))
+                self._discard(oldest)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                self._discard(key)
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        '''Return a dict of counters: hits, misses, stores and evictions,
+        plus the current number of entries and bytes.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._index)
+            stats['bytes'] = self._bytes
+            return stats
+
+    def __len__(self):
+        return len(self._index)
+
+    def _discard(self, key):
+        self._bytes -= self._index.pop(key)
+        self._remove(key)
+
+    # storage - called with the lock held
+
+    def _load(self, key):
+        return self._entries.get(key)
+
+    def _save(self, key, entry):
+        '''Store the entry and return its size in bytes.'''
+        self._entries[key] = entry
+        return len(entry['body']) + len(entry['headers'])
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+
+
+class DiskResponseCache(ResponseCache):
+    '''LRU cache of GET responses kept as files in a directory, so it lasts
+    between runs.
+
+    :param path: directory for the cache files, created if need be
+    :param max_entries: most responses kept. Default *None* (no limit)
+    :param max_bytes: most bytes of response bodies and headers kept.
+        Default *None* (no limit)
+
+    '''
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        ResponseCache.__init__(self, max_entries, max_bytes)
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # rebuild the index, least recently used (oldest mtime) first
+        files = []
+        for name in os.listdir(path):
+            if name.endswith('.tmp'):
+                continue
+            st = os.stat(os.path.join(path, name))
+            files.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(files):
+            self._index[name] = size
+            self._bytes += size
+
+    def _filename(self, key):
+        return os.path.join(self.path, key)
+
+    def _load(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(filename, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError), e:
+            logger.warning('Could not read cache file %s: %s', filename, e)
+            return None
+        return entry
+
+    def _save(self, key, entry):
+        filename = self._filename(key)
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.rename(filename + '.tmp', filename)
+        return size
+
+    def _remove(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+
+class CacheHandler(BaseHandler):
+    '''urllib2 handler that revalidates cached GET responses.'''
+    # after ContentEncodingProcessor, so decompressed bodies are cached
+    handler_order = 600
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def _key(self, req):
+        # include the API key, since users may see different things
+        auth = req.get_header('Authorization') or ''
+        return hashlib.sha1('%s\n%s' % (req.get_full_url(), auth)).hexdigest()
+
+    def http_request(self, req):
+        if req.get_method() != 'GET':
+            return req
+        entry = self.cache.get(self._key(req))
+        if entry is not None:
+            if entry['etag'] and not req.has_header('If-none-match'):
+                req.add_unredirected_header('If-none-match', entry['etag'])
+            if entry['last_modified'] and \
+                   not req.has_header('If-modified-since'):
+                req.add_unredirected_header('If-modified-since',
+                                            entry['last_modified'])
+        return req
+    https_request = http_request
+
+    def http_response(self, req, response):
+        if req.get_method() != 'GET' or response.code != 200:
+            return response
+        self.cache.count('misses')
+        headers = response.info()
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified) or \
+               'no-store' in (headers.get('Cache-Control') or ''):
+            return response
+        body = response.read()
+        response.close()
+        # the headers of the body as stored, which may have been
+        # decompressed
+        stored_headers = mimetools.Message(StringIO(''.join(headers.headers)))
+        if getattr(response, 'decoded_encoding', None):
+            del stored_headers['Content-Encoding']
+        del stored_headers['Content-Length']
+        stored_headers['Content-Length'] = str(len(body))
+        entry = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': ''.join(stored_headers.headers),
+            'body': body,
+        }
+        self.cache.set(self._key(req), entry)
+        return self._response(req, entry, response.code, response.msg)
+    https_response = http_response
+
+    def http_error_304(self, req, fp, code, msg, headers):
+        entry = self.cache.get(self._key(req))
+        if entry is None:
+            # evicted since the request was sent - let urllib2 raise
+            return None
+        # read to the end so the connection can be reused
+        fp.read()
+        fp.close()
+        self.cache.count('hits')
+        return self._response(req, entry, 200, 'OK')
+
+    def _response(self, req, entry, code, msg):
+        headers = mimetools.Message(StringIO(entry['headers']))
+        response = addinfourl(StringIO(entry['body']), headers,
+                              req.get_full_url())
+        response.code = code
+        response.msg = msg
+        return response
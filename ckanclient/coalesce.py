@@ -0,0 +1,79 @@
+'''Coalescing of identical concurrent requests.
+
+With ``single_flight=SingleFlight()``, a CkanClient shared between threads
+makes one request for identical idempotent reads that are in flight at the
+same time (e.g. many threads fetching the same popular package), and every
+caller gets its result::
+
+    client = CkanClient(single_flight=SingleFlight())
+    ...
+    print client.single_flight.stats() # {'calls': 120, 'coalesced': 380 ...}
+'''
+import sys
+import threading
+
+import logging
+logger = logging.getLogger('ckanclient.coalesce')
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'exc_info', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    '''Runs one call at a time per key, sharing its result (or error) with
+    the callers of the same key that arrive while it is in flight.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # key: _Call in flight
+        self._stats = {
+            'calls': 0,       # calls made
+            'coalesced': 0,   # calls saved by sharing another's result
+        }
+
+    def do(self, key, func):
+        '''Return (func(), False), or (result, True) with the result of the
+        call of the same key already in flight. The call's exception is
+        raised in every caller sharing it.'''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self._stats['calls'] += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self._stats['coalesced'] += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                exc_type, exc_value, exc_traceback = call.exc_info
+                raise exc_type, exc_value, exc_traceback
+            return call.result, True
+        try:
+            call.result = func()
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.waiters:
+                logger.debug('%s callers shared a call', call.waiters)
+        return call.result, False
+
+    def stats(self):
+        '''Return a dict of counters: calls made, calls coalesced (saved)
+        and calls in_flight now.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+            return stats
@@ -0,0 +1,337 @@
+'''HTTP transport handlers for the CKAN client.
+
+urllib2's stock HTTP handlers send ``Connection: close`` and open a new socket
+for every request. ``KeepAliveHandler`` is a drop-in replacement that takes
+connections from a ``ConnectionPool`` and hands them back once the response
+body has been read, so consecutive API calls to the same host reuse one TCP
+(and TLS) connection.
+
+``ContentEncodingProcessor`` asks for gzip/deflate compressed responses and
+inflates them as they are read.
+'''
+import select
+import socket
+import threading
+import time
+import zlib
+
+import httplib
+from urllib2 import (BaseHandler, HTTPHandler, HTTPSHandler,
+                     AbstractHTTPHandler, URLError, addinfourl)
+
+from ckanclient.retry import IDEMPOTENT_METHODS
+
+import logging
+logger = logging.getLogger('ckanclient.connection')
+
+# errors raised when a pooled connection turns out to have been closed by the
+# server while it sat idle
+STALE_CONNECTION_ERRORS = (socket.error, httplib.BadStatusLine,
+                           httplib.CannotSendRequest)
+
+
+class ConnectionPool(object):
+    '''A thread-safe pool of idle HTTP connections, kept per host.
+
+    :param maxsize: number of idle connections kept per host. default *10*
+    :param idle_timeout: seconds an idle connection is kept before it is
+        closed instead of reused. default *60*
+
+    '''
+    def __init__(self, maxsize=10, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'connects': 0,  # new connections opened
+            'reuses': 0,    # requests sent over a pooled connection
+            'expired': 0,   # idle connections closed by idle_timeout
+            'discarded': 0, # connections closed because the pool was full
+            'stale': 0,     # pooled connections found closed by the server
+        }
+
+    def get(self, key, factory):
+        '''Return an idle connection for `key` or, if there is none, a new
+        one made by calling `factory()`. Returns a (connection, reused)
+        tuple.'''
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    self._stats['expired'] += 1
+                    conn.close()
+                    continue
+                self._stats['reuses'] += 1
+                return conn, True
+            self._stats['connects'] += 1
+        return factory(), False
+
+    def get_open(self, key, factory):
+        '''Like get(), but skip idle connections that the server has
+        closed, as far as can be told without sending on them: for a
+        request that can't be sent again if it turns out to be stale.'''
+        while True:
+            conn, reused = self.get(key, factory)
+            if not reused or conn.sock is None or \
+                   not select.select([conn.sock], [], [], 0)[0]:
+                return conn, reused
+            # readable while idle means closed by the server
+            conn.close()
+            self.discard_stale(key)
+
+    def put(self, key, conn):
+        '''Return a connection whose last response has been fully read.'''
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+            self._stats['discarded'] += 1
+        conn.close()
+
+    def discard_stale(self, key):
+        '''Close the idle connections for `key` after one of them turned
+        out to have been closed by the server.'''
+        with self._lock:
+            self._stats['stale'] += 1
+            idle = self._idle.pop(key, [])
+        for conn, last_used in idle:
+            conn.close()
+
+    def clear(self):
+        '''Close all idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def stats(self):
+        '''Return a dict of counters: connects, reuses, expired, discarded
+        and stale.'''
+        with self._lock:
+            return dict(self._stats)
+
+
+class PooledResponseReader(object):
+    '''Reads an httplib response and gives its connection back to the pool
+    as soon as the body has been read to the end.'''
+    def __init__(self, response, pool, key, conn):
+        self.response = response
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self.bytes_read = 0
+        self._release_if_done()
+
+    def read(self, amt=None):
+        if self._conn is None and self.response.isclosed():
+            return ''
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        self.bytes_read += len(data)
+        self._release_if_done()
+        return data
+    recv = read # for socket._fileobject
+
+    def _release_if_done(self):
+        if self._conn is not None and self.response.isclosed():
+            conn, self._conn = self._conn, None
+            if self.response.will_close:
+                conn.close()
+            else:
+                self._pool.put(self._key, conn)
+
+    def close(self):
+        if self._conn is not None:
+            # body not read to the end, so the connection can't be reused
+            conn, self._conn = self._conn, None
+            conn.close()
+        self.response.close()
+
+
+class KeepAliveHandler(HTTPHandler, HTTPSHandler):
+    '''urllib2 handler for http and https URLs that reuses connections from
+    a ConnectionPool.'''
+    def __init__(self, pool, debuglevel=0, **kwargs):
+        HTTPSHandler.__init__(self, debuglevel, **kwargs)
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.do_open(httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        kwargs = {}
+        if getattr(self, '_context', None) is not None:
+            kwargs['context'] = self._context
+        return self.do_open(httplib.HTTPSConnection, req, **kwargs)
+
+    http_request = AbstractHTTPHandler.do_request_
+    https_request = AbstractHTTPHandler.do_request_
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise URLError('no host given')
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        key = (http_class.__name__, host, tunnel_host)
+
+        def factory():
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            if tunnel_host:
+                conn.set_tunnel(tunnel_host)
+            return conn
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        replayable = req.get_method() in IDEMPOTENT_METHODS
+        if replayable:
+            conn, reused = self.pool.get(key, factory)
+        else:
+            conn, reused = self.pool.get_open(key, factory)
+        try:
+            response = self._send(conn, req, headers)
+        except STALE_CONNECTION_ERRORS, err:
+            conn.close()
+            if not reused or not replayable:
+                # the server may have acted on the request before it closed
+                # the connection, so only idempotent ones are sent again
+                raise URLError(err)
+            # the server closed the idle connection - try a fresh one once
+            logger.debug('Stale connection to %s: %r', host, err)
+            self.pool.discard_stale(key)
+            conn, reused = self.pool.get(key, factory)
+            try:
+                response = self._send(conn, req, headers)
+            except STALE_CONNECTION_ERRORS, err:
+                conn.close()
+                raise URLError(err)
+
+        reader = PooledResponseReader(response, self.pool, key, conn)
+        # for instrumentation: bytes received off the wire
+        req.raw_reader = reader
+        fp = socket._fileobject(reader, close=True)
+        resp = addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send(self, conn, req, headers):
+        # for instrumentation: connect time and time to the response headers
+        start = sent = time.time()
+        if conn.sock is None:
+            conn.connect()
+            sent = time.time()
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        try:
+            response = conn.getresponse(buffering=True)
+        except TypeError: # buffering kw not supported
+            response = conn.getresponse()
+        req.timings = {'connect': sent - start, 'ttfb': time.time() - sent}
+        return response
+
+
+class Inflater(object):
+    '''Incremental decoder for a gzip or deflate content-encoding.'''
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = zlib.decompressobj()
+        self._first_chunk = True
+
+    def decompress(self, chunk):
+        try:
+            data = self._decompressor.decompress(chunk)
+        except zlib.error:
+            if not (self._first_chunk and self.encoding == 'deflate'):
+                raise
+            # some servers send raw deflate data without the zlib header
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decompressor.decompress(chunk)
+        self._first_chunk = False
+        return data
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class DecompressingReader(object):
+    '''Inflates a gzip or deflate encoded body a chunk at a time as it is
+    read, so the whole compressed body is never held in memory.'''
+    chunk_size = 16 * 1024
+
+    def __init__(self, fp, encoding):
+        self.fp = fp
+        self._inflater = Inflater(encoding)
+        self._buffer = ''
+        self._eof = False
+        self.raw_bytes = 0 # compressed bytes read off the wire
+
+    def _fill(self):
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self._buffer += self._inflater.flush()
+            self._eof = True
+            return
+        self.raw_bytes += len(chunk)
+        self._buffer += self._inflater.decompress(chunk)
+
+    def read(self, amt=None):
+        if amt is None:
+            parts = [self._buffer]
+            self._buffer = ''
+            while not self._eof:
+                self._fill()
+                parts.append(self._buffer)
+                self._buffer = ''
+            return ''.join(parts)
+        while not self._eof and len(self._buffer) < amt:
+            self._fill()
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+    recv = read # for socket._fileobject
+
+    def close(self):
+        self.fp.close()
+
+
+class ContentEncodingProcessor(BaseHandler):
+    '''urllib2 processor that sends ``Accept-Encoding: gzip, deflate`` and
+    transparently decompresses encoded responses (including error
+    responses).'''
+    encodings = ('gzip', 'deflate')
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-encoding',
+                                        ', '.join(self.encodings))
+        return req
+    https_request = http_request
+
+    def http_response(self, req, response):
+        headers = response.info()
+        encoding = (headers.get('Content-Encoding') or '').strip().lower()
+        if encoding not in self.encodings:
+            return response
+        reader = DecompressingReader(response, encoding)
+        # the body length no longer matches what is read
+        del headers['Content-Length']
+        fp = socket._fileobject(reader, close=True)
+        decoded = addinfourl(fp, headers, response.geturl())
+        decoded.code = response.code
+        decoded.msg = response.msg
+        # Content-Encoding is left as the server sent it
+        decoded.decoded_encoding = encoding
+        return decoded
+    https_response = http_response
@@ -0,0 +1,121 @@
+'''
+Compare the memory taken by a synthetic catalog held as the dicts the API
+returns and as ckanclient.model objects.
+
+    python model_memory_benchmark.py --packages 10000
+
+Sizes are summed with sys.getsizeof over everything reachable from the
+catalog, counting each object once, so strings shared between packages
+(as the model's interned ones are) count once.
+'''
+import sys
+import json
+import time
+import random
+import argparse
+
+from ckanclient.model import Package
+
+parser = argparse.ArgumentParser(description=
+    'Compare the memory of package dicts and ckanclient.model objects.')
+parser.add_argument('--packages', type=int, default=10000,
+                    help='number of packages in the catalog')
+parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+FORMATS = ['CSV', 'JSON', 'XLS', 'XML', 'PDF', 'HTML', 'RDF', 'API']
+LICENSES = [('cc-by', 'Creative Commons Attribution',
+             'http://www.opendefinition.org/licenses/cc-by'),
+            ('odc-pddl', 'Open Data Commons Public Domain Dedication',
+             'http://www.opendefinition.org/licenses/odc-pddl'),
+            ('uk-ogl', 'UK Open Government Licence',
+             'http://reference.data.gov.uk/id/open-government-licence')]
+TAGS = ['transport', 'health', 'education', 'environment', 'finance',
+        'crime', 'population', 'energy', 'housing', 'spending']
+GROUPS = ['government', 'science', 'culture', 'economy']
+
+
+def make_package(i, rand):
+    '''A package dict shaped like one from package_show.'''
+    license_id, license_title, license_url = rand.choice(LICENSES)
+    name = 'dataset-%06d' % i
+    package_id = '%08x-0000-0000-0000-%012x' % (i, i)
+    return {
+        'id': package_id, 'name': name,
+        'title': 'Dataset number %d' % i,
+        'notes': 'Some description of dataset %d. ' % i * 5,
+        'version': '1.0', 'url': 'http://example.com/%s' % name,
+        'author': 'Department %d' % (i % 20),
+        'author_email': 'dept%d@example.com' % (i % 20),
+        'maintainer': None, 'maintainer_email': None,
+        'license_id': license_id, 'license_title': license_title,
+        'license_url': license_url, 'isopen': True, 'state': 'active',
+        'type': 'dataset', 'private': False, 'owner_org': None,
+        'metadata_created': '2013-01-01T10:00:00.%06d' % i,
+        'metadata_modified': '2013-06-01T10:00:00.%06d' % i,
+        'num_resources': 3, 'num_tags': 3,
+        'extras': [{'key': 'source', 'value': 'harvest'}],
+        'tags': [{'name': tag, 'display_name': tag, 'state': 'active',
+                  'vocabulary_id': None, 'id': 'tag-%s' % tag}
+                 for tag in rand.sample(TAGS, 3)],
+        'groups': [{'name': group, 'title': group.title(),
+                    'id': 'group-%s' % group, 'description': '',
+                    'image_url': ''}
+                   for group in rand.sample(GROUPS, 1)],
+        'resources': [{
+            'id': '%s-%d' % (package_id, r), 'package_id': package_id,
+            'url': 'http://example.com/%s/%d' % (name, r),
+            'format': rand.choice(FORMATS), 'description': '',
+            'name': 'Resource %d' % r, 'mimetype': None,
+            'mimetype_inner': None, 'size': None, 'hash': '',
+            'resource_type': 'file', 'url_type': None, 'position': r,
+            'state': 'active', 'created': '2013-01-01T10:00:00'}
+            for r in range(3)],
+    }
+
+
+def deep_size(obj, seen=None):
+    '''Bytes taken by obj and everything it refers to, counted once.'''
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif hasattr(type(obj), '__slots__'):
+            for cls in type(obj).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    try:
+                        stack.append(object.__getattribute__(obj, name))
+                    except AttributeError:
+                        pass
+    return total
+
+
+def main():
+    args = parser.parse_args()
+    rand = random.Random(args.seed)
+    # decoded from JSON, as a client gets them
+    text = json.dumps([make_package(i, rand) for i in range(args.packages)])
+    dicts = json.loads(text)
+    start = time.time()
+    objects = [Package.from_dict(package) for package in json.loads(text)]
+    convert_time = time.time() - start
+    assert [package.to_dict() for package in objects] == dicts
+    dict_size = deep_size(dicts)
+    object_size = deep_size(objects)
+    print '%d packages' % args.packages
+    print 'dicts:   %8.1f MB' % (dict_size / 1e6)
+    print 'objects: %8.1f MB (%.0f%% of the dicts)' % (
+        object_size / 1e6, 100.0 * object_size / dict_size)
+    print 'converted in %.2fs' % convert_time
+
+if __name__ == '__main__':
+    main()
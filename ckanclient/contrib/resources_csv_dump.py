@@ -20,8 +20,11 @@ def main():
     args = parser.parse_args()
     client = ckanclient.CkanClient(args.url)
     rows = []
-    for pkg_name in client.package_register_get():
-        pkg = client.package_entity_get(pkg_name)
+    packages = client.package_entity_get_many(client.package_register_get(),
+                                              ordered=True)
+    for pkg_name, pkg in packages:
+        if isinstance(pkg, Exception):
+            raise pkg
         for extra, value in pkg.get('extras', {}).items():
             pkg['extras_' + extra] = value
         if 'extras' in pkg:
@@ -16,16 +16,42 @@ import mimetypes
 import os
 import ConfigParser
 import urllib2
+import httplib
 import json
 import csv
 import time
 import logging
+from StringIO import StringIO
+
+from ckanclient.instrument import RequestRecord, call_hooks
+from ckanclient.connection import ConnectionPool, KeepAliveHandler
+from ckanclient import bulk
+from ckanclient.export import writer_for, write_csv
+from ckanclient.retry import RetryPolicy
 
 logger = logging.getLogger('datastore.client')
 
 
 class DataStoreClient:
-    def __init__(self, url):
+    '''Client for a CKAN DataStore table.
+
+    :param url: the table's DataStore URL or CKAN resource URL
+    :param hooks: callables called with a ckanclient.instrument.RequestRecord
+        (timings and sizes) after every request, e.g. a TimingAggregator.
+        Default *None*
+    :param keep_alive: reuse HTTP/1.1 connections between requests. Default
+        *True*
+    :param pool_maxsize: idle connections kept. Default *10*
+    '''
+    def __init__(self, url, hooks=None, keep_alive=True, pool_maxsize=10):
+        self.hooks = list(hooks or [])
+        if keep_alive:
+            self.connection_pool = ConnectionPool(pool_maxsize)
+            self._opener = urllib2.build_opener(
+                KeepAliveHandler(self.connection_pool))
+        else:
+            self.connection_pool = None
+            self._opener = urllib2.build_opener()
         url = url.rstrip('/')
         self.parsed = urlparse.urlparse(url)
         newparsed = list(self.parsed)
@@ -50,43 +76,214 @@ class DataStoreClient:
         '''
         url = self.url + '/_search'
         q = json.dumps(query)
-        req = urllib2.Request(url, q, self._headers)
         try:
-            out = urllib2.urlopen(req).read()
-        except Exception, inst:
+            out = self._open('DataStore Search', url, q, decode=True)
+        except urllib2.HTTPError, inst:
             logger.error('%s: %s' % (inst.url, inst.read()))
             raise
-        return json.loads(out)
+        return out
 
-    def upsert(self, dict_iterator, refresh=False):
-        '''Insert / update documents provided in dict_iterator.'''
-        start = time.time()
+    def scan(self, query=None, batch_size=500, fields=None, scroll='5m'):
+        '''Iterate over all the documents matching a query, a batch of
+        `batch_size` hits per request, so a whole table can be read in
+        constant memory.
+
+        Given a direct ElasticSearch URL (http://host:9200/index/type),
+        this uses the scroll API, which is at the server's root and so
+        isn't reachable through CKAN's Data API (/api/data/<id>). Through
+        the Data API it pages with from/size instead, each page costing the
+        server more than the one before, so use a direct URL to read large
+        tables.
+
+        :param query: an ElasticSearch query dict, as in a search body's
+            'query'. Default *None* (all documents)
+        :param batch_size: hits fetched per request. Default *500*
+        :param fields: the fields of each document to fetch. Default *None*
+            (all)
+        :param scroll: how long the server keeps the scroll between
+            requests. Default *'5m'*
+
+        Yields each document's _source, fetching the next batch only when
+        the previous one has been used.
+        '''
+        body = {'query': query or {'match_all': {}}, 'size': batch_size}
+        if fields is not None:
+            body['_source'] = list(fields)
+        if '/api/data/' in urlparse.urlparse(self.url).path:
+            pages = self._search_pages(body)
+        else:
+            pages = self._scroll_pages(body, scroll)
+        try:
+            for hits in pages:
+                for hit in hits:
+                    yield hit.get('_source', hit.get('fields', {}))
+        finally:
+            # so a scroll stopped early is cleared now
+            pages.close()
+
+    def _search_pages(self, body):
+        url = self.url + '/_search'
+        offset = 0
+        while True:
+            body['from'] = offset
+            out = self._open('DataStore Search', url, json.dumps(body),
+                             decode=True)
+            hits = out['hits']['hits']
+            if not hits:
+                return
+            yield hits
+            offset += len(hits)
+            if offset >= out['hits'].get('total', offset + 1):
+                return
+
+    def _scroll_pages(self, body, scroll):
+        out = self._open('DataStore Search',
+                         self.url + '/_search?scroll=%s' % scroll,
+                         json.dumps(body), decode=True)
+        # the scroll API is at the server's root, not the index's, and
+        # takes the scroll id as the raw body
+        scroll_url = urlparse.urlunparse((self.parsed.scheme, self.netloc,
+                                          '/_search/scroll', '', '', ''))
+        scroll_id = None
+        try:
+            while True:
+                scroll_id = out.get('_scroll_id') or scroll_id
+                hits = out['hits']['hits']
+                if not hits:
+                    return
+                yield hits
+                if scroll_id is None:
+                    return
+                out = self._open('DataStore Scroll',
+                                 scroll_url + '?scroll=%s' % scroll,
+                                 scroll_id, decode=True)
+        finally:
+            if scroll_id is not None:
+                self._clear_scroll(scroll_url, scroll_id)
+
+    def _clear_scroll(self, scroll_url, scroll_id):
+        # frees the server's search context now rather than when the
+        # scroll times out
+        try:
+            self._open('DataStore Scroll', scroll_url, scroll_id, 'DELETE')
+        except (urllib2.URLError, httplib.HTTPException), inst:
+            logger.warning('Could not clear scroll: %r', inst)
+
+    def export(self, filepath_or_fileobj, filetype=None, query=None,
+               fields=None, batch_size=500):
+        '''Write the documents matching `query` (by default, the whole
+        table) to a CSV or NDJSON file as they are scanned. {filetype} is
+        'csv' or 'json' (NDJSON), by default guessed from the file name.
+        Returns the number of documents written.
+        '''
+        fileobj = filepath_or_fileobj
+        if isinstance(filepath_or_fileobj, basestring):
+            if not filetype:
+                filetype = (mimetypes.guess_type(filepath_or_fileobj)[0] or
+                            os.path.splitext(filepath_or_fileobj)[1])
+            fileobj = open(filepath_or_fileobj, 'wb')
+        try:
+            writer = writer_for(filetype or '')
+            docs = self.scan(query, batch_size, fields)
+            if writer is write_csv:
+                count = writer(docs, fileobj, fields)
+            else:
+                count = writer(docs, fileobj)
+        finally:
+            if fileobj is not filepath_or_fileobj:
+                fileobj.close()
+        logger.info('Exported %s docs', count)
+        return count
+
+    def upsert(self, dict_iterator, refresh=False,
+               max_bytes=bulk.DEFAULT_MAX_BYTES, max_docs=None,
+               num_workers=None, queue_size=None, stream=False, retry=None):
+        '''Insert / update documents provided in dict_iterator.
+
+        The documents are sent in _bulk requests of up to `max_bytes`
+        (default 5MB) and/or `max_docs` documents. The outcome of each
+        document is read from the responses, and documents the server
+        rejected as too busy are sent again on their own, with backoff, as
+        `retry` (a ckanclient.retry.RetryPolicy, by default RetryPolicy(),
+        or no retries with `stream`) allows.
+
+        Returns a dict summing up the load: docs, bytes and requests sent,
+        documents indexed, failed and retried, the seconds elapsed,
+        docs_per_sec and bytes_per_sec, and the errors of the first
+        documents that failed as (index, status, error).
+
+        With `num_workers`, that many requests are made at once while the
+        next batches are serialized, with at most `queue_size` (default 2 x
+        num_workers) batches in memory. If requests fail, no more are made
+        and a ckanclient.bulk.BulkError lists the failures in order.
+
+        With `stream`, each request body is written out with chunked
+        transfer encoding as the documents are serialized, rather than
+        built first, so memory use doesn't grow with the batch size. Rejected
+        documents are then only resent if `retry` is given, as resending
+        means keeping the entries of the batch in flight, which takes as
+        much memory as building its body. It can't be combined with
+        `num_workers`.
+        '''
+        if stream and num_workers:
+            raise ValueError('stream and num_workers are exclusive')
+        if stream and retry is None:
+            retry = RetryPolicy(max_retries=0)
+        elif retry is None:
+            retry = RetryPolicy()
         url = self.url + '/_bulk'
         if refresh:
             url += '?refresh=true'
+        stats = bulk.BulkStats()
+
+        def resend(entries):
+            return self._open('DataStore Bulk', url, ''.join(entries),
+                              decode=True)
 
-        def send_request(data):
-            post_data = "%s%s" % ("\n".join(data), "\n")
-            req = urllib2.Request(url, post_data, self._headers)
-            return urllib2.urlopen(req)
-
-        data = []
-        for count,dict_ in enumerate(dict_iterator):
-            bulkmeta = {"index": {}}
-            if 'id' in dict_: bulkmeta['index']['_id'] = dict_['id']
-            data.append(json.dumps(bulkmeta))
-            data.append(json.dumps(dict_))
-            if (count % 100) == 0:
-                response = send_request(data)
-                data[:] = []
-                logger.debug('%s %s' % (count, (time.time() - start)))
-        if data:
-            send_request(data)
-            logger.debug('%s %s' % (count, (time.time() - start)))
+        def send(offset, batch):
+            entries, size = batch
+            response = resend(entries)
+            stats.add(len(entries), size)
+            bulk.check_items(response, offset, entries, resend, stats, retry)
+            logger.debug('%s docs sent', stats.summary()['docs'])
+
+        if stream:
+            offset = 0
+            keep = retry.max_retries > 0
+            for batch in bulk.stream_batches(dict_iterator, max_bytes,
+                                             max_docs, keep):
+                response = json.loads(self._open_chunked(
+                    'DataStore Bulk', url, bulk.chunks(batch)))
+                stats.add(batch.docs, batch.size)
+                bulk.check_items(response, offset,
+                                 batch.entries or [None] * batch.docs,
+                                 resend, stats, retry if keep else None)
+                offset += batch.docs
+                logger.debug('%s docs sent', stats.summary()['docs'])
+        elif num_workers:
+            batches = bulk.batches(dict_iterator, max_bytes, max_docs)
+            try:
+                bulk.send_concurrently(send, batches, num_workers,
+                                       queue_size)
+            except bulk.BulkError, e:
+                e.summary = stats.summary()
+                raise
+        else:
+            offset = 0
+            for batch in bulk.batches(dict_iterator, max_bytes, max_docs):
+                send(offset, batch)
+                offset += len(batch[0])
+        summary = stats.summary()
+        logger.info('Upserted %(docs)s docs in %(requests)s requests, '
+                    '%(indexed)s indexed, %(failed)s failed, %(retried)s '
+                    'retried, %(docs_per_sec).0f docs/s, '
+                    '%(bytes_per_sec).0f bytes/s', summary)
+        return summary
 
     def upload(self, filepath_or_fileobj, filetype=None, **kwargs):
         '''Upload data to webstore table. Additional required arguments is file path
         with data to upload and optional {filetype} giving type of file.
+        Other keyword arguments are passed to upsert.
         '''
         fileobj = filepath_or_fileobj
         if isinstance(filepath_or_fileobj, basestring):
@@ -94,25 +291,23 @@ class DataStoreClient:
                 filetype = mimetypes.guess_type(filepath_or_fileobj)[0]
             fileobj = open(filepath_or_fileobj)
         if filetype.endswith('csv'):
-            self.upsert(csv.DictReader(fileobj))
+            return self.upsert(csv.DictReader(fileobj), **kwargs)
         elif filetype.endswith('json'):
-            self.upsert(json.load(fileobj))
+            return self.upsert(json.load(fileobj), **kwargs)
         else: 
             raise ValueError('Unsupported format: %s' % filetype)
 
     def delete(self):
         '''Delete this DataStore table.'''
         logger.debug('DELETE: %s' % self.url)
-        out = self._request(self.url, None, 'DELETE')
+        out = self._open('DataStore Table', self.url, None, 'DELETE')
         logger.debug('DELETE: %s' % out)
         return out
 
     def mapping(self):
         '''Get the mapping for this DataStore table.'''
         url = self.url + '/_mapping'
-        req = urllib2.Request(url, None, self._headers)
-        data = urllib2.urlopen(req).read()
-        data = json.loads(data)
+        data = self._open('DataStore Mapping', url, decode=True)
         return data
 
     def mapping_update(self, mapping):
@@ -129,19 +324,112 @@ class DataStoreClient:
         url = self.url + '/_mapping'
         data = json.dumps({self.es_type_name: mapping})
         try:
-            out = self._request(url, data, 'PUT')
-        except Exception, inst:
+            out = self._open('DataStore Mapping', url, data, 'PUT')
+        except urllib2.HTTPError, inst:
             logger.error('%s: %s' % (inst.url, inst.read()))
             raise
         logger.debug('%s: %s' % (url, out))
         return out
         
-    def _request(self, url, data, method):
-        opener = urllib2.build_opener(urllib2.HTTPHandler)
+    def _open(self, endpoint, url, data=None, method=None, decode=False):
+        '''Make a request and return the response body, decoded from JSON
+        if `decode`. `endpoint` names the kind of request for the hooks.'''
         request = urllib2.Request(url, data, self._headers)
-        request.get_method = lambda: method
-        response = opener.open(request)
-        return response.read()
+        if method:
+            request.get_method = lambda: method
+        record = RequestRecord(request.get_method(), endpoint, url)
+        record.request_bytes = len(data) if data else 0
+        start = time.time()
+        try:
+            response = self._opener.open(request)
+            opened = time.time()
+            record.status = response.code
+            timings = getattr(request, 'timings', None)
+            if timings:
+                record.connect = timings['connect']
+                record.ttfb = timings['ttfb']
+            else:
+                record.ttfb = opened - start
+            body = response.read()
+            record.transfer = time.time() - opened
+            record.response_bytes = len(body)
+            if decode:
+                decode_start = time.time()
+                body = json.loads(body)
+                record.decode = time.time() - decode_start
+        except urllib2.HTTPError, inst:
+            record.status = inst.code
+            raise
+        finally:
+            record.total = time.time() - start
+            if self.hooks:
+                call_hooks(self.hooks, record)
+        return body
+
+    def _connection(self):
+        '''Return (connection, pool key) for the table's host, pooled if
+        there is a pool.'''
+        if self.parsed.scheme == 'https':
+            http_class = httplib.HTTPSConnection
+        else:
+            http_class = httplib.HTTPConnection
+        # as KeepAliveHandler keys its connections, so they are shared
+        key = (http_class.__name__, self.netloc, None)
+        factory = lambda: http_class(self.netloc)
+        if self.connection_pool is None:
+            return factory(), key
+        # a streamed body can't be sent again, so don't find out that a
+        # connection is stale by sending it
+        conn, reused = self.connection_pool.get_open(key, factory)
+        return conn, key
+
+    def _open_chunked(self, endpoint, url, chunks):
+        '''POST the strings from `chunks` as the body, with chunked
+        transfer encoding, and return the response body. Raises an
+        HTTPError for an error status.'''
+        record = RequestRecord('POST', endpoint, url)
+        start = time.time()
+        conn, key = self._connection()
+        try:
+            if conn.sock is None:
+                conn.connect()
+            record.connect = time.time() - start
+            path = urlparse.urlunparse(('', '') + urlparse.urlparse(url)[2:])
+            conn.putrequest('POST', path, skip_accept_encoding=True)
+            for name, value in self._headers.items():
+                conn.putheader(name, value)
+            conn.putheader('Content-Type', 'application/x-ndjson')
+            conn.putheader('Transfer-Encoding', 'chunked')
+            conn.endheaders()
+            request_bytes = 0
+            for chunk in chunks:
+                conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+                request_bytes += len(chunk)
+            conn.send('0\r\n\r\n')
+            record.request_bytes = request_bytes
+            sent = time.time()
+            response = conn.getresponse()
+            opened = time.time()
+            record.ttfb = opened - sent
+            record.status = response.status
+            body = response.read()
+            record.transfer = time.time() - opened
+            record.response_bytes = len(body)
+        except:
+            conn.close()
+            raise
+        finally:
+            record.total = time.time() - start
+            if self.hooks:
+                call_hooks(self.hooks, record)
+        if response.will_close or self.connection_pool is None:
+            conn.close()
+        else:
+            self.connection_pool.put(key, conn)
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(body))
+        return body
 
     def _setup_authorization(self, username, password=None):
         '''Get authorization field for authorization header.
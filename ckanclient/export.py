@@ -0,0 +1,65 @@
+'''Streaming writers for exporting documents, e.g. a DataStore table.
+
+Each writer takes any iterable of dicts, such as ``DataStoreClient.scan()``,
+and writes the documents one by one as they come, so an export uses the
+same memory however big the table is::
+
+    with open('table.csv', 'wb') as fileobj:
+        write_csv(client.scan(fields=['name', 'price']), fileobj,
+                  fields=['name', 'price'])
+'''
+import csv
+import itertools
+import json
+
+
+def write_ndjson(docs, fileobj):
+    '''Write each document as a line of JSON. Returns the number
+    written.'''
+    count = 0
+    for doc in docs:
+        fileobj.write(json.dumps(doc))
+        fileobj.write('\n')
+        count += 1
+    return count
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def write_csv(docs, fileobj, fields=None):
+    '''Write the documents as CSV (UTF-8), with a header row of `fields`,
+    by default the keys of the first document, sorted. Other keys are left
+    out, and missing ones are empty cells. Nested values are written as
+    JSON. Returns the number of rows written.'''
+    docs = iter(docs)
+    first = next(docs, None)
+    if fields is None:
+        fields = sorted(first or [])
+    writer = csv.writer(fileobj)
+    writer.writerow([_cell(field) for field in fields])
+    if first is None:
+        return 0
+    count = 0
+    for doc in itertools.chain([first], docs):
+        writer.writerow([_cell(doc.get(field)) for field in fields])
+        count += 1
+    return count
+
+
+def writer_for(filetype):
+    '''Return the writer for a filetype or mimetype such as 'csv',
+    'text/csv', 'ndjson' or 'application/x-ndjson' (JSON is written as
+    NDJSON).'''
+    if filetype.endswith('csv'):
+        return write_csv
+    elif filetype.endswith('json'):
+        return write_ndjson
+    raise ValueError('Unsupported format: %s' % filetype)
@@ -0,0 +1,150 @@
+'''Per-request instrumentation for CkanClient and DataStoreClient.
+
+Both clients call each of their `hooks` with a ``RequestRecord`` after every
+HTTP request. ``TimingAggregator`` is a hook that collects the records and
+reports percentiles per endpoint::
+
+    timings = TimingAggregator()
+    client = CkanClient(hooks=[timings])
+    ...
+    timings.report()
+'''
+import sys
+import atexit
+import threading
+from collections import defaultdict
+
+import logging
+logger = logging.getLogger('ckanclient.instrument')
+
+PHASES = ('connect', 'ttfb', 'transfer', 'decode', 'total')
+
+
+class RequestRecord(object):
+    '''Timings and sizes of one HTTP request. Times are in seconds and are
+    None where they weren't measured (e.g. connect for a reused connection
+    is 0, transfer and decode for a streamed body are None).
+
+    :ivar method: HTTP method
+    :ivar endpoint: URL template, e.g. 'Package Entity' or
+        'action/package_show'
+    :ivar url: the URL requested
+    :ivar status: HTTP status code, or None if the server wasn't reached
+    :ivar connect: time to open the connection
+    :ivar ttfb: time from sending the request to receiving the response
+        headers
+    :ivar transfer: time to read the response body
+    :ivar decode: time to decode the body from JSON
+    :ivar total: time for the whole request, including decoding
+    :ivar request_bytes: size of the request body
+    :ivar response_bytes: size of the response body as received
+    :ivar attempt: 0 for the first attempt, 1 for the first retry, ...
+
+    '''
+    __slots__ = ('method', 'endpoint', 'url', 'status', 'connect', 'ttfb',
+                 'transfer', 'decode', 'total', 'request_bytes',
+                 'response_bytes', 'attempt')
+
+    def __init__(self, method, endpoint, url):
+        self.method = method
+        self.endpoint = endpoint
+        self.url = url
+        self.status = None
+        self.connect = None
+        self.ttfb = None
+        self.transfer = None
+        self.decode = None
+        self.total = None
+        self.request_bytes = 0
+        self.response_bytes = None
+        self.attempt = 0
+
+    def __repr__(self):
+        return '<RequestRecord %s %s %s %.3fs>' % (
+            self.method, self.endpoint, self.status, self.total or 0)
+
+
+def call_hooks(hooks, record):
+    '''Call each hook with the record. A failing hook is logged rather than
+    allowed to break the request.'''
+    for hook in hooks:
+        try:
+            hook(record)
+        except Exception, e:
+            logger.exception('Instrumentation hook %r failed: %s', hook, e)
+
+
+def percentile(sorted_values, fraction):
+    '''Nearest-rank percentile of a sorted list.'''
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class TimingAggregator(object):
+    '''Hook that collects request timings per endpoint (method and URL
+    template) and reports their percentiles.
+
+    :param at_exit: print the report when the program exits. Default
+        *False*
+
+    '''
+    def __init__(self, at_exit=False):
+        self._lock = threading.Lock()
+        self._timings = defaultdict(lambda: defaultdict(list))
+        self._counts = defaultdict(lambda: defaultdict(int))
+        if at_exit:
+            atexit.register(self.report)
+
+    def __call__(self, record):
+        key = '%s %s' % (record.method, record.endpoint)
+        with self._lock:
+            timings = self._timings[key]
+            for phase in PHASES:
+                value = getattr(record, phase)
+                if value is not None:
+                    timings[phase].append(value)
+            counts = self._counts[key]
+            counts['requests'] += 1
+            if record.status is None or record.status >= 400:
+                counts['errors'] += 1
+            counts['request_bytes'] += record.request_bytes or 0
+            counts['response_bytes'] += record.response_bytes or 0
+
+    def summary(self):
+        '''Returns a dict of endpoint: stats, where stats has the counts
+        (requests, errors, request_bytes, response_bytes) and, for each
+        phase, a (p50, p95, p99) tuple.'''
+        summary = {}
+        with self._lock:
+            for key, timings in self._timings.items():
+                stats = dict(self._counts[key])
+                for phase in PHASES:
+                    values = sorted(timings.get(phase, []))
+                    stats[phase] = tuple(percentile(values, fraction)
+                                         for fraction in (0.5, 0.95, 0.99))
+                summary[key] = stats
+        return summary
+
+    def report(self, out=None):
+        '''Print a table of percentiles (in milliseconds) per endpoint.'''
+        out = out or sys.stdout
+        summary = self.summary()
+        if not summary:
+            return
+        def ms(value):
+            return '%8.1f' % (value * 1000) if value is not None else \
+                   '%8s' % '-'
+        width = max(len(key) for key in summary)
+        out.write('%-*s %7s %6s %10s  %s\n' % (
+            width, 'endpoint', 'count', 'errors', 'KB in',
+            '  '.join('%24s' % ('%s p50/p95/p99 ms' % phase)
+                      for phase in PHASES)))
+        for key in sorted(summary):
+            stats = summary[key]
+            out.write('%-*s %7d %6d %10.1f  %s\n' % (
+                width, key, stats['requests'], stats.get('errors', 0),
+                stats.get('response_bytes', 0) / 1024.0,
+                '  '.join(''.join(ms(value) for value in stats[phase])
+                          for phase in PHASES)))
@@ -0,0 +1,124 @@
+'''Incremental decoding of JSON arrays from a file-like object.
+
+``iter_array`` yields the items of a (possibly very long) JSON array as they
+are read, without holding the whole document or the decoded list in memory::
+
+    for name in iter_array(response):
+        ...
+
+The array can also be a member of a top-level object, as in an Action API
+response, by giving its `key`.
+'''
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# characters that can follow a complete number
+DELIMITERS = (' ', '\t', '\n', '\r', ',', ']', '}')
+
+
+class _Reader(object):
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        '''Read another chunk, dropping what has been consumed. Returns False
+        at the end of the input.'''
+        if self.eof:
+            return False
+        # read more the longer the unfinished value gets, so a huge item
+        # isn't decoded over and over from the start
+        chunk = self.fp.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''Skip whitespace and return the next character ('' at the end).'''
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r at %r' %
+                             (chars, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''Decode the next JSON value.'''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            if isinstance(value, (int, long, float)) and \
+                   self.buffer[end:end + 1] not in DELIMITERS and self.fill():
+                # the number may carry on into the next chunk
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_items(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_array(fp, key=None, envelope=None, chunk_size=CHUNK_SIZE):
+    '''Yield the items of the JSON array read from file-like `fp`, which is
+    closed at the end.
+
+    :param key: if given, the document is an object and the array is its
+        `key` member
+    :param envelope: optional dict to put the object's other members in
+    :param chunk_size: bytes read at a time
+
+    '''
+    reader = _Reader(fp, chunk_size)
+    try:
+        if key is None:
+            for item in _iter_items(reader):
+                yield item
+            return
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.expect(':')
+            if name == key:
+                for item in _iter_items(reader):
+                    yield item
+            else:
+                value = reader.value()
+                if envelope is not None:
+                    envelope[name] = value
+            if reader.expect(',}') == '}':
+                return
+    finally:
+        fp.close()
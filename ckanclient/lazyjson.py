@@ -0,0 +1,221 @@
+'''Lazy and projected decoding of JSON objects.
+
+``LazyObject`` is a read-only mapping over a JSON object in a string. Its
+scalar members are decoded straight away, but its arrays and objects (a
+package's resources, extras, tags ...) only when they are first accessed::
+
+    package = LazyObject(body)
+    print package['name']            # decoded when the object was scanned
+    urls = [r['url'] for r in package['resources']] # decoded now
+
+With `fields`, the other members are skipped over without being decoded at
+all. Nested values are kept as spans of the original string, which is held
+until they have all been decoded.
+
+Scanning past a value is only a little quicker than decoding it with the C
+decoder, so the saving is mostly in the memory of the objects that aren't
+built. ``project()`` cuts decoded dicts down to some fields, which is the
+quicker way to get a few fields of every package.
+'''
+import re
+import json
+from collections import Mapping
+
+_decoder = json.JSONDecoder()
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+# a run of anything but brackets, taking strings (which may contain
+# brackets) whole
+_CONTENT = r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*'
+SKIP = re.compile(_CONTENT)
+
+
+def _nested(depth):
+    # an array or object with up to `depth` levels of containers inside
+    inner = '' if not depth else '(?:%s%s)*' % (_nested(depth - 1), _CONTENT)
+    return r'[\[{]%s%s[\]}]' % (_CONTENT, inner)
+
+# skips most values in one match, which is quicker than decoding them
+CONTAINER = re.compile(_nested(4))
+
+
+def _ws(text, pos):
+    return WHITESPACE.match(text, pos).end()
+
+
+def _expect(text, pos, chars):
+    char = text[pos:pos + 1]
+    if not char or char not in chars:
+        raise ValueError('Expected one of %r at %r' %
+                         (chars, text[pos:pos + 20]))
+    return char
+
+
+def container_end(text, pos):
+    '''Return the index just past the JSON array or object starting at
+    `pos`, without decoding it.'''
+    match = CONTAINER.match(text, pos)
+    if match is not None:
+        return match.end()
+    # nested more deeply (or invalid), so count the brackets
+    depth = 0
+    while True:
+        char = text[pos:pos + 1]
+        if char == '[' or char == '{':
+            depth += 1
+        elif char == ']' or char == '}':
+            depth -= 1
+        else:
+            raise ValueError('Unterminated JSON value at %r' %
+                             text[pos:pos + 20])
+        pos += 1
+        if not depth:
+            return pos
+        pos = SKIP.match(text, pos).end()
+
+
+def skip_value(text, pos):
+    '''Return the index just past the JSON value starting at `pos`.'''
+    char = text[pos:pos + 1]
+    if char == '"':
+        match = STRING.match(text, pos)
+        if match is None:
+            raise ValueError('Unterminated string at %r' % text[pos:pos + 20])
+        return match.end()
+    if char == '[' or char == '{':
+        return container_end(text, pos)
+    return _decoder.raw_decode(text, pos)[1]
+
+
+class LazyObject(Mapping):
+    '''Read-only mapping over the JSON object in `text` at `pos`, whose
+    arrays and objects are decoded when first accessed.
+
+    :param fields: if given, only these members are kept and the others
+        are skipped without being decoded. Default *None*
+
+    :ivar end: the index just past the object in `text`
+
+    '''
+    def __init__(self, text, pos=0, fields=None):
+        if fields is not None:
+            fields = frozenset(fields)
+        self._text = text
+        self._keys = []
+        self._values = {}
+        self._spans = {} # name: start of a value not decoded yet
+        self.end = self._scan(_ws(text, pos), fields)
+        if not self._spans:
+            self._text = None
+
+    def _scan(self, pos, fields):
+        text = self._text
+        _expect(text, pos, '{')
+        pos = _ws(text, pos + 1)
+        if text[pos:pos + 1] == '}':
+            return pos + 1
+        while True:
+            _expect(text, pos, '"')
+            name, pos = _decoder.raw_decode(text, pos)
+            pos = _ws(text, pos)
+            _expect(text, pos, ':')
+            pos = _ws(text, pos + 1)
+            char = text[pos:pos + 1]
+            if fields is not None and name not in fields:
+                pos = skip_value(text, pos)
+            else:
+                if char == '[' or char == '{':
+                    self._spans[name] = pos
+                    pos = container_end(text, pos)
+                else:
+                    self._values[name], pos = _decoder.raw_decode(text, pos)
+                self._keys.append(name)
+            pos = _ws(text, pos)
+            if _expect(text, pos, ',}') == '}':
+                return pos + 1
+            pos = _ws(text, pos + 1)
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        # the text is only dropped once no spans are left, so reading it
+        # first keeps it for the span even if another thread decodes the
+        # last one meanwhile
+        text = self._text
+        start = self._spans.get(name)
+        if start is None:
+            # missing, or decoded by another thread meanwhile
+            return self._values[name]
+        value = _decoder.raw_decode(text, start)[0]
+        self._values[name] = value
+        self._spans.pop(name, None)
+        if not self._spans:
+            self._text = None
+        return value
+
+    def get_lazy(self, name, fields=None):
+        '''Return member `name` without decoding it: a LazyObject if it is
+        an object or a list of them (and any other items) if it is an
+        array. `fields` is passed to the LazyObjects.'''
+        text = self._text
+        start = self._spans.get(name)
+        if start is None:
+            return self[name]
+        if text[start] == '{':
+            return LazyObject(text, start, fields)
+        return lazy_array(text, start, fields)
+
+    def __contains__(self, name):
+        return name in self._values or name in self._spans
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def to_dict(self):
+        '''Decode the rest of the object and return it as a dict.'''
+        return dict((name, self[name]) for name in self._keys)
+
+    def __repr__(self):
+        return '<LazyObject %s>' % ', '.join(
+            '%s=%r' % (name, self._values[name]) if name in self._values
+            else '%s=...' % name for name in self._keys)
+
+
+def lazy_array(text, pos=0, fields=None):
+    '''Return a list of the items of the JSON array in `text` at `pos`,
+    with objects as LazyObjects (given `fields`).'''
+    items = []
+    pos = _ws(text, pos)
+    _expect(text, pos, '[')
+    pos = _ws(text, pos + 1)
+    if text[pos:pos + 1] == ']':
+        return items
+    while True:
+        if text[pos:pos + 1] == '{':
+            item = LazyObject(text, pos, fields)
+            pos = item.end
+        else:
+            item, pos = _decoder.raw_decode(text, pos)
+        items.append(item)
+        pos = _ws(text, pos)
+        if _expect(text, pos, ',]') == ']':
+            return items
+        pos = _ws(text, pos + 1)
+
+
+
+def project(value, fields):
+    '''Return dict `value` with only its `fields`, or for a list, each of
+    its dicts so.'''
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if isinstance(value, dict):
+        return dict((name, item) for name, item in value.iteritems()
+                    if name in fields)
+    return value
@@ -0,0 +1,300 @@
+'''Local mirror of a CKAN catalog that answers searches offline.
+
+``CatalogMirror`` pulls every package through a CkanClient once, keeps them
+in memory with an inverted index over their title, notes, tags and resource
+formats, and answers ``package_search``-style queries locally::
+
+    mirror = CatalogMirror(client)
+    mirror.refresh()                      # everything the first time
+    res = mirror.package_search('transport', {'fq': 'res_format:CSV',
+                                              'limit': 20})
+    ...
+    mirror.refresh()                      # only what changed since
+
+Matching is simpler than Solr's: the words of `q` must all appear (whole
+words, ignoring case) and results are ranked by how often and where they
+appear, so counts and ordering can differ a little from the server's.
+'''
+import re
+import time
+import threading
+from collections import defaultdict
+
+from ckanclient.sync import deleted_since
+
+import logging
+logger = logging.getLogger('ckanclient.mirror')
+
+WORD = re.compile(r'\w+', re.UNICODE)
+# field:value or field:"quoted value", optionally +required
+TERM = re.compile(r'\+?(?:(\w+):)?(?:"([^"]*)"|(\S+))')
+
+# weight of a word in each field when ranking
+FIELD_WEIGHTS = (('name', 3), ('title', 3), ('tags', 2), ('notes', 1),
+                 ('res_format', 1))
+# fields that can be filtered on with fq or a search option
+FILTER_FIELDS = ('id', 'name', 'tags', 'groups', 'res_format', 'license_id',
+                 'organization', 'author', 'maintainer', 'state')
+# search options that aren't filters
+QUERY_OPTIONS = ('q', 'fq', 'limit', 'offset', 'sort', 'all_fields',
+                 'filter_by_openness', 'filter_by_downloadable', 'fl')
+
+
+def words(text):
+    return [word.lower() for word in WORD.findall(text or '')]
+
+
+def _names(values):
+    # tags and groups are names (REST API) or dicts (Action API)
+    names = []
+    for value in values or []:
+        if isinstance(value, dict):
+            value = value.get('name')
+        if value:
+            names.append(value)
+    return names
+
+
+def field_values(package, field):
+    '''The values of a searchable field of a package dict.'''
+    if field in ('tags', 'groups'):
+        return _names(package.get(field))
+    if field == 'res_format':
+        return [resource.get('format') for resource in
+                package.get('resources') or [] if resource.get('format')]
+    if field == 'organization':
+        organization = package.get('organization')
+        if isinstance(organization, dict):
+            organization = organization.get('name')
+        return [organization] if organization else []
+    value = package.get(field)
+    if value is None or isinstance(value, (dict, list)):
+        return []
+    return [unicode(value)]
+
+
+class CatalogMirror(object):
+    '''In-memory copy of a catalog with an inverted index for searching.
+
+    :param client: the CkanClient to pull packages with
+    :param page_size: packages fetched per search request. Default *1000*
+    :param prefetch: pages fetched ahead while indexing. Default *1*
+
+    '''
+    def __init__(self, client, page_size=1000, prefetch=1):
+        self.client = client
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.cursor = None # where the next refresh carries on from
+        self._lock = threading.RLock()
+        self._packages = {} # id: package dict
+        self._names = {} # name: id
+        self._words = defaultdict(dict) # word: {id: weight}
+        self._filters = defaultdict(set) # (field, value): ids
+        self._keys = {} # id: (words, filters) the package is indexed under
+        self._stats = {'refreshes': 0, 'updated': 0, 'deleted': 0,
+                       'searches': 0, 'refresh_time': 0.0}
+
+    def __len__(self):
+        return len(self._packages)
+
+    def refresh(self, deletions=True):
+        '''Fetch the packages modified since the last refresh (all of them
+        the first time) and index them.
+
+        :param deletions: also drop the packages no longer in the catalog,
+            found from the package register. Default *True*
+
+        Returns the number of packages added or updated.
+        '''
+        start = time.time()
+        res = self.client.package_search_keyset(
+            '', {'limit': self.page_size}, cursor=self.cursor,
+            prefetch=self.prefetch)
+        results = res['results']
+        updated = 0
+        for package in results:
+            self.add(package)
+            updated += 1
+        self.cursor = results.cursor
+        deleted = self._drop_deleted() if deletions else 0
+        with self._lock:
+            self._stats['refreshes'] += 1
+            self._stats['updated'] += updated
+            self._stats['deleted'] += deleted
+            self._stats['refresh_time'] += time.time() - start
+        logger.info('Mirror refreshed: %s updated, %s deleted, %s in all',
+                    updated, deleted, len(self))
+        return updated
+
+    def _drop_deleted(self):
+        with self._lock:
+            known = dict((package['name'], package.get('id'))
+                         for package in self._packages.itervalues())
+        gone = deleted_since(self.client, known)
+        with self._lock:
+            for name, package_id in gone:
+                self.remove(package_id or name)
+        return len(gone)
+
+    def add(self, package):
+        '''Add or replace a package dict in the mirror.'''
+        package_id = package.get('id') or package['name']
+        word_weights = defaultdict(int)
+        for field, weight in FIELD_WEIGHTS:
+            for value in field_values(package, field):
+                for word in words(value):
+                    word_weights[word] += weight
+        filters = set()
+        for field in FILTER_FIELDS:
+            for value in field_values(package, field):
+                filters.add((field, value.lower()))
+        with self._lock:
+            self.remove(package_id)
+            self._packages[package_id] = package
+            self._names[package['name']] = package_id
+            for word, weight in word_weights.iteritems():
+                self._words[word][package_id] = weight
+            for key in filters:
+                self._filters[key].add(package_id)
+            self._keys[package_id] = (word_weights.keys(), filters)
+
+    def remove(self, package_id):
+        '''Remove a package (by id or name) from the mirror.'''
+        with self._lock:
+            package_id = self._names.get(package_id, package_id)
+            package = self._packages.pop(package_id, None)
+            if package is None:
+                return
+            if self._names.get(package['name']) == package_id:
+                del self._names[package['name']]
+            word_list, filters = self._keys.pop(package_id)
+            for word in word_list:
+                postings = self._words[word]
+                postings.pop(package_id, None)
+                if not postings:
+                    del self._words[word]
+            for key in filters:
+                ids = self._filters[key]
+                ids.discard(package_id)
+                if not ids:
+                    del self._filters[key]
+
+    def get(self, name_or_id):
+        '''Return the package dict with this name or id, or None.'''
+        with self._lock:
+            package_id = self._names.get(name_or_id, name_or_id)
+            return self._packages.get(package_id)
+
+    def package_search(self, q, search_options=None):
+        '''Search the mirror like CkanClient.package_search, returning a
+        dict with the 'count' and a list of 'results': names, or package
+        dicts with all_fields.
+
+        Understood are `q` (words, and field:value terms), `fq` (field:value
+        terms), any of FILTER_FIELDS as options, `sort` (e.g. 'name asc',
+        'metadata_modified desc'; by default by rank), `limit` and `offset`.
+        '''
+        search_options = dict(search_options or {})
+        terms = []
+        for query in (q, search_options.get('fq')):
+            if query and query.strip() not in ('*:*', '*'):
+                terms.extend(parse_terms(query))
+        for field in FILTER_FIELDS:
+            if field in search_options:
+                terms.append((field, unicode(search_options[field])))
+        for option in search_options:
+            if option not in QUERY_OPTIONS and option not in FILTER_FIELDS:
+                logger.debug('Search option %s is ignored by the mirror',
+                             option)
+        with self._lock:
+            self._stats['searches'] += 1
+            scores = self._match(terms)
+            ranked = self._sort(scores, search_options.get('sort'))
+            offset = int(search_options.get('offset') or 0)
+            limit = search_options.get('limit')
+            page = ranked[offset:offset + int(limit) if limit else None]
+            if search_options.get('all_fields'):
+                results = [self._packages[package_id] for package_id in page]
+            else:
+                results = [self._packages[package_id]['name']
+                           for package_id in page]
+        return {'count': len(ranked), 'results': results}
+
+    def _match(self, terms):
+        '''Return {id: score} of the packages matching all the terms.'''
+        scores = None
+        for field, value in terms:
+            if field is None:
+                # every word of free text must match
+                for word in words(value):
+                    postings = self._words.get(word, {})
+                    if scores is None:
+                        scores = dict(postings)
+                    else:
+                        scores = dict((package_id, score + postings[package_id])
+                                      for package_id, score
+                                      in scores.iteritems()
+                                      if package_id in postings)
+                continue
+            ids = self._filter(field, value)
+            if scores is None:
+                scores = dict.fromkeys(ids, 0)
+            else:
+                scores = dict((package_id, score) for package_id, score
+                              in scores.iteritems() if package_id in ids)
+        if scores is None:
+            scores = dict.fromkeys(self._packages, 0)
+        return scores
+
+    def _filter(self, field, value):
+        if field in FILTER_FIELDS:
+            return self._filters.get((field, value.lower()), set())
+        # any other field is compared as it is, package by package
+        return set(package_id for package_id, package
+                   in self._packages.iteritems()
+                   if value in field_values(package, field))
+
+    def _sort(self, scores, sort):
+        if not sort:
+            # by rank, and by name between equals so pages are stable
+            names = dict((package_id, self._packages[package_id]['name'])
+                         for package_id in scores)
+            return sorted(scores, key=lambda package_id: (
+                -scores[package_id], names[package_id]))
+        ranked = list(scores)
+        # stable sorts, least significant key first
+        for clause in reversed(sort.split(',')):
+            parts = clause.split()
+            field = parts[0]
+            reverse = len(parts) > 1 and parts[1].lower() == 'desc'
+            if field == 'score':
+                key = scores.get
+            else:
+                key = lambda package_id: \
+                    self._packages[package_id].get(field)
+            ranked.sort(key=key, reverse=reverse)
+        return ranked
+
+    def stats(self):
+        '''Return a dict of counters: refreshes, packages updated and
+        deleted by them, searches, refresh_time (seconds) and the current
+        number of packages and indexed words.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['packages'] = len(self._packages)
+            stats['words'] = len(self._words)
+            return stats
+
+
+def parse_terms(query):
+    '''Split a query into (field, value) terms, field being None for free
+    text.'''
+    terms = []
+    for match in TERM.finditer(query):
+        field, quoted, value = match.groups()
+        value = quoted if quoted is not None else value
+        if field is None and value.upper() in ('AND', 'OR'):
+            continue
+        terms.append((field, value))
+    return terms
@@ -0,0 +1,179 @@
+'''Compact objects for packages, resources, tags and groups.
+
+A large catalog held as the nested dicts the API returns takes a lot of
+memory: every dict has a hash table, and strings such as formats and
+licenses are repeated in every package. ``Package``, ``Resource``, ``Tag``
+and ``Group`` keep their fields in ``__slots__`` instead, and share one copy
+of each of the repetitive strings::
+
+    package = Package.from_dict(client.package_entity_get('mypkg'))
+    print package.title, [res.format for res in package.resources]
+    client.package_entity_put(package.to_dict())
+
+``to_dict()`` gives back a dict equal to the one the object was made from:
+fields the class doesn't know are kept aside, and fields that were missing
+stay missing (reading them gives None). Tags and groups given as names, as
+the REST API gives them, stay names.
+
+``contrib/model_memory_benchmark.py`` compares the memory taken by the two.
+'''
+
+# one copy of each interned string. It is never emptied, so only fields
+# with few distinct values in a whole catalog (formats, licenses, states,
+# types, and tag, group and organization names and ids) are interned, and
+# none with a value per package (ids, authors ...), so it stays small.
+_strings = {}
+
+
+def intern_string(value):
+    '''Return the copy kept of a string equal to `value`, keeping this one
+    if there is none. Unlike the builtin intern() it takes unicode, as
+    decoded JSON is.'''
+    if isinstance(value, basestring):
+        return _strings.setdefault(value, value)
+    return value
+
+
+class Model(object):
+    '''Base for the model classes: an object with a slot per field in
+    FIELDS.
+
+    :cvar FIELDS: the fields kept in slots
+    :cvar INTERNED: fields whose strings are interned
+    :cvar CHILDREN: fields holding a list of dicts, and the class each dict
+        becomes
+
+    '''
+    __slots__ = ('_extra',)
+    FIELDS = ()
+    INTERNED = frozenset()
+    CHILDREN = {}
+
+    def __init__(self, data=None, **fields):
+        self._extra = None # fields not in FIELDS
+        for source in (data or {}), fields:
+            for name, value in source.iteritems():
+                self._set(name, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Make an object from a dict as the API returns it.'''
+        return cls(data)
+
+    def _set(self, name, value):
+        child_class = self.CHILDREN.get(name)
+        if child_class is not None and isinstance(value, list):
+            value = [child_class(item) if isinstance(item, dict)
+                     else intern_string(item) for item in value]
+        elif name in self.INTERNED:
+            value = intern_string(value)
+        if name in self.FIELDS:
+            setattr(self, name, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+
+    def __getattr__(self, name):
+        # only called for a field with no value
+        if name in self.FIELDS:
+            return None
+        extra = object.__getattribute__(self, '_extra')
+        if extra is not None and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+    def _items(self):
+        for name in self.FIELDS:
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                # missing from the dict the object was made from
+                pass
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
+
+    def to_dict(self):
+        '''Return the object as a dict for the API, equal to the one it was
+        made from.'''
+        data = {}
+        for name, value in self._items():
+            if name in self.CHILDREN and isinstance(value, list):
+                value = [item.to_dict() if isinstance(item, Model) else item
+                         for item in value]
+            data[name] = value
+        return data
+
+    def get(self, name, default=None):
+        for field, value in self._items():
+            if field == name:
+                return value
+        return default
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+               self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__,
+                            self.get('name') or self.get('id'))
+
+
+class Resource(Model):
+    FIELDS = ('id', 'url', 'format', 'name', 'description', 'mimetype',
+              'mimetype_inner', 'size', 'hash', 'last_modified', 'created',
+              'cache_url', 'cache_last_updated', 'webstore_url',
+              'webstore_last_updated', 'resource_type', 'resource_group_id',
+              'position', 'package_id', 'revision_id', 'revision_timestamp',
+              'state', 'url_type', 'datastore_active', 'tracking_summary')
+    __slots__ = FIELDS
+    INTERNED = frozenset(('format', 'mimetype', 'mimetype_inner',
+                          'resource_type', 'state', 'url_type'))
+
+
+class Tag(Model):
+    FIELDS = ('id', 'name', 'display_name', 'vocabulary_id', 'state',
+              'revision_timestamp')
+    __slots__ = FIELDS
+    INTERNED = frozenset(('id', 'name', 'display_name', 'vocabulary_id',
+                          'state'))
+
+
+class Group(Model):
+    FIELDS = ('id', 'name', 'title', 'display_name', 'description',
+              'image_url', 'image_display_url', 'type', 'state',
+              'is_organization', 'approval_status', 'revision_id', 'created')
+    __slots__ = FIELDS
+    INTERNED = frozenset(('id', 'name', 'title', 'display_name', 'type',
+                          'state', 'approval_status'))
+
+
+class Package(Model):
+    FIELDS = ('id', 'name', 'title', 'version', 'url', 'author',
+              'author_email', 'maintainer', 'maintainer_email', 'notes',
+              'notes_rendered', 'license_id', 'license', 'license_title',
+              'license_url', 'isopen', 'state', 'type', 'private',
+              'owner_org', 'organization', 'revision_id',
+              'metadata_created', 'metadata_modified', 'ckan_url',
+              'download_url', 'num_resources', 'num_tags', 'ratings_average',
+              'ratings_count', 'relationships', 'tracking_summary', 'extras',
+              'resources', 'tags', 'groups')
+    __slots__ = FIELDS
+    INTERNED = frozenset(('license_id', 'license', 'license_title',
+                          'license_url', 'state', 'type', 'owner_org'))
+    CHILDREN = {'resources': Resource, 'tags': Tag, 'groups': Group}
+
+    def _set(self, name, value):
+        if name == 'organization' and isinstance(value, dict):
+            value = Group(value)
+        Model._set(self, name, value)
+
+    def to_dict(self):
+        data = Model.to_dict(self)
+        if isinstance(data.get('organization'), Group):
+            data['organization'] = data['organization'].to_dict()
+        return data
@@ -0,0 +1,137 @@
+'''Retrying and rate limiting of CKAN API requests.
+
+``RetryPolicy`` retries idempotent requests that fail with an overload
+status (429, 503 ...) or a connection error, backing off exponentially with
+jitter and honouring any ``Retry-After`` header. ``TokenBucket`` limits the
+request rate of all the threads using a client::
+
+    client = CkanClient(retry=RetryPolicy(max_retries=5),
+                        rate_limiter=TokenBucket(rate=20))
+'''
+import time
+import random
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+import logging
+logger = logging.getLogger('ckanclient.retry')
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class RetryPolicy(object):
+    '''When and how long to wait before retrying a failed request.
+
+    :param max_retries: retries after the first attempt. Default *3*
+    :param backoff_factor: the n-th retry waits a random time up to
+        backoff_factor * 2 ** n seconds. Default *0.5*
+    :param max_backoff: most seconds to wait before a retry, including any
+        Retry-After. Default *60*
+    :param statuses: HTTP statuses to retry. Default *(429, 502, 503, 504)*
+    :param retry_url_errors: retry when the server could not be reached.
+        Default *True*
+
+    '''
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=60,
+                 statuses=(429, 502, 503, 504), retry_url_errors=True):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.retry_url_errors = retry_url_errors
+        self._lock = threading.Lock()
+        self._stats = {'retries': 0, 'retry_wait': 0.0}
+
+    def should_retry(self, response, attempt, idempotent):
+        '''Whether to retry after `response`, the result of attempt number
+        `attempt` (counting from 0).'''
+        if not idempotent or attempt >= self.max_retries:
+            return False
+        if response.url_error is not None:
+            return self.retry_url_errors
+        return response.status in self.statuses
+
+    def backoff(self, attempt, response):
+        '''Seconds to wait before the next attempt.'''
+        delay = random.uniform(0, self.backoff_factor * 2 ** attempt)
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return min(delay, self.max_backoff)
+
+    def retry_after(self, response):
+        '''The delay the server asked for in a Retry-After header, in
+        seconds, or None.'''
+        if response is None or response.headers is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return int(value)
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, mktime_tz(date) - time.time())
+
+    def wait(self, attempt, response):
+        '''Sleep before retrying and count the retry.'''
+        delay = self.backoff(attempt, response)
+        with self._lock:
+            self._stats['retries'] += 1
+            self._stats['retry_wait'] += delay
+        logger.info('Retrying %s after status %s in %.2fs',
+                    response.location, response.status, delay)
+        time.sleep(delay)
+
+    def stats(self):
+        '''Return a dict of counters: retries and retry_wait (seconds).'''
+        with self._lock:
+            return dict(self._stats)
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket rate limiter.
+
+    Each request takes a token. Tokens are added at `rate` per second up to
+    `capacity`; when the bucket is empty, callers wait their turn.
+
+    :param rate: requests per second
+    :param capacity: most requests allowed in a burst. Default *rate* (at
+        least 1)
+
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self._stats = {'acquired': 0, 'throttled': 0, 'throttle_wait': 0.0}
+
+    def acquire(self, tokens=1):
+        '''Take `tokens`, sleeping until they are available. Returns the
+        seconds waited.'''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # the tokens are reserved now, so waiting threads queue up
+            # behind each other rather than all waking at once
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self._stats['acquired'] += 1
+            if wait:
+                self._stats['throttled'] += 1
+                self._stats['throttle_wait'] += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        '''Return a dict of counters: acquired, throttled and
+        throttle_wait (seconds).'''
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,340 @@
+'''Paging through package_search results.
+
+``CkanClient.package_search`` returns its 'results' as a ``SearchResults``,
+an iterator over the results of all the pages. The remaining pages can be
+fetched one at a time as they are needed, prefetched in the background, or
+fetched all at once by a pool of workers::
+
+    res = client.package_search('', {'limit': 100}, num_workers=8)
+    for name in res['results']:
+        ...
+    print res['results'].stats()
+
+Rather than a fixed limit, ``AdaptivePageSize`` can choose the size of each
+page from how long the previous ones took to fetch::
+
+    res = client.package_search('', page_size=AdaptivePageSize(0.5))
+
+``CkanClient.package_search_keyset`` pages by key instead of offset, giving
+``KeysetResults`` whose ``cursor`` can be saved to resume a scan later.
+'''
+import json
+import time
+import base64
+import threading
+
+from ckanclient import workers
+
+# statuses with which a server may refuse a page size
+REJECTED_STATUSES = (400, 409, 413)
+
+
+class PageSizeRejected(Exception):
+    '''Raised by a fetch_page function when the server refused the limit.
+    `exc_info` is that of the original error.'''
+    def __init__(self, limit, exc_info):
+        Exception.__init__(self, limit)
+        self.limit = limit
+        self.exc_info = exc_info
+
+
+class AdaptivePageSize(object):
+    '''Chooses the limit of each page of search results, aiming for page
+    requests that take `target_time` seconds, from the time and size of the
+    pages so far. The limit at most halves or doubles from page to page.
+
+    If the server refuses a limit (with a 400, 409 or 413 status) the page
+    is asked for again with half the limit, which becomes the largest
+    limit tried from then on. If it returns fewer results than asked for
+    when there are more to come, it is taken to cap the page size there.
+
+    A policy can be shared between searches, so later ones start from the
+    size learnt by earlier ones.
+
+    :param target_time: seconds per page request to aim for. Default *1.0*
+    :param min_size: smallest limit. Default *10*
+    :param max_size: largest limit. Default *1000*
+    :param initial_size: limit of the first page. Default *min_size*
+    :param max_bytes: most bytes per response to aim for. Default *None*
+
+    '''
+    def __init__(self, target_time=1.0, min_size=10, max_size=1000,
+                 initial_size=None, max_bytes=None):
+        self.target_time = target_time
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.size = initial_size or min_size
+        self._lock = threading.Lock()
+        self._stats = {
+            'rejections': 0,   # limits the server refused
+            'capped': 0,       # pages the server returned short
+        }
+
+    def fetch(self, fetch_page, offset):
+        '''Fetch the page at `offset` with `fetch_page(offset, limit)`,
+        which returns (result_dict, response_bytes), and adjust the size.
+        Returns (result_dict, limit).'''
+        while True:
+            with self._lock:
+                limit = self.size
+            start = time.time()
+            try:
+                result_dict, response_bytes = fetch_page(offset, limit)
+            except PageSizeRejected, e:
+                if not self.reject(limit):
+                    exc_type, exc_value, exc_traceback = e.exc_info
+                    raise exc_type, exc_value, exc_traceback
+                continue
+            self.observe(limit, offset, result_dict, time.time() - start,
+                         response_bytes)
+            return result_dict, limit
+
+    def observe(self, limit, offset, result_dict, elapsed, response_bytes):
+        '''Choose the next size after a page of `limit` took `elapsed`
+        seconds and `response_bytes`.'''
+        received = len(result_dict['results'])
+        count = result_dict.get('count')
+        with self._lock:
+            if received < limit and count is not None and \
+                   offset + received < count:
+                self.max_size = max(self.min_size, received)
+                self._stats['capped'] += 1
+            if not received:
+                return
+            size = self.target_time * received / max(elapsed, 0.001)
+            if self.max_bytes and response_bytes:
+                size = min(size, float(self.max_bytes) * received /
+                           response_bytes)
+            size = max(limit // 2, min(limit * 2, int(size)))
+            self.size = max(self.min_size, min(self.max_size, size))
+
+    def reject(self, limit):
+        '''The server refused `limit`: lower the largest size. Returns
+        False if it can go no lower.'''
+        with self._lock:
+            if limit <= self.min_size:
+                return False
+            self.max_size = max(self.min_size, limit // 2)
+            self.size = min(self.size, self.max_size)
+            self._stats['rejections'] += 1
+            return True
+
+    def stats(self):
+        '''Return a dict of the current size and max_size and counters of
+        rejections and capped pages.'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['max_size'] = self.max_size
+            return stats
+
+
+class SearchResults(object):
+    '''Iterator over the results of a search, page by page.
+
+    :param results: the results of the first page
+    :param fetch_page: function taking a page offset and limit and
+        returning that page's (result_dict, response_bytes)
+    :param count: number of results in all
+    :param limit: page size, or the limit of the first page with an
+        adaptive `page_size`
+    :param prefetch: number of pages to request in the background while the
+        caller works through the current one. Default *0*
+    :param num_workers: if given, the remaining pages are requested by this
+        many threads at once, still yielding the results in rank order.
+        Default *None*
+    :param page_size: an AdaptivePageSize choosing the limit of each page
+        instead, which can't be combined with `num_workers`. Default *None*
+
+    '''
+    def __init__(self, results, fetch_page, count, limit, prefetch=0,
+                 num_workers=None, page_size=None):
+        self._fetch_page = fetch_page
+        self._count = count
+        self._limit = limit
+        self._prefetch = prefetch
+        self._num_workers = num_workers
+        self._page_size = page_size
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._end = None
+        self._page_sizes = [limit]
+        self._stats = {
+            'pages': 1,           # pages received, including the first
+            'results': len(results),
+            'fetch_time': 0.0,    # seconds spent in page requests
+        }
+        self._iter = self._generate(results)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self._iter.next()
+
+    def close(self):
+        '''Stop fetching pages.'''
+        self._iter.close()
+
+    def stats(self):
+        '''Return a dict of counters: pages and results received, the
+        seconds spent in requests (fetch_time) and since the search started
+        (elapsed), the throughput in pages_per_sec and results_per_sec and
+        the limit of each page (page_sizes).
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['page_sizes'] = list(self._page_sizes)
+            elapsed = (self._end or time.time()) - self._start
+        stats['elapsed'] = elapsed
+        stats['pages_per_sec'] = stats['pages'] / elapsed if elapsed else 0.0
+        stats['results_per_sec'] = \
+            stats['results'] / elapsed if elapsed else 0.0
+        return stats
+
+    def _fetch(self, position):
+        # position is the offset of the page, or for keyset paging the key
+        # the results are after
+        start = time.time()
+        if self._page_size is not None:
+            result_dict, limit = self._page_size.fetch(self._fetch_page,
+                                                       position)
+        else:
+            limit = self._limit
+            result_dict = self._fetch_page(position, limit)[0]
+        with self._lock:
+            self._stats['pages'] += 1
+            self._stats['results'] += len(result_dict['results'])
+            self._stats['fetch_time'] += time.time() - start
+            self._page_sizes.append(limit)
+        return result_dict
+
+    def _pages(self, results):
+        offset = len(results)
+        if self._page_size is not None:
+            # the next offset depends on the size of this page
+            while offset < self._count:
+                results = self._fetch(offset)['results']
+                if not results:
+                    return
+                offset += len(results)
+                yield results
+        elif self._num_workers:
+            offsets = xrange(self._limit, self._count, self._limit)
+            for offset, result_dict, error in workers.imap(
+                    self._fetch, offsets, self._num_workers, ordered=True):
+                if error is not None:
+                    raise error
+                yield result_dict['results']
+        else:
+            for offset in xrange(self._limit, self._count, self._limit):
+                yield self._fetch(offset)['results']
+
+    def _generate(self, results):
+        pages = self._pages(results)
+        if self._prefetch and not self._num_workers and \
+               len(results) < self._count:
+            # start on the next pages while the caller uses this one
+            pages = workers.Prefetcher(pages, self._prefetch)
+        try:
+            for res in results:
+                yield res
+            for results in pages:
+                for res in results:
+                    yield res
+            self._end = time.time()
+        finally:
+            pages.close()
+
+
+# the sort keyset paging relies on: unique and, as packages are only ever
+# modified later, new and changed packages sort after those already seen
+KEYSET_SORT = 'metadata_modified asc, id asc'
+
+
+def keyset_key(package):
+    '''The (metadata_modified, id) sort key of a package dict.'''
+    return package['metadata_modified'], package['id']
+
+
+def encode_cursor(key):
+    '''Encode a sort key as a cursor token.'''
+    return base64.urlsafe_b64encode(json.dumps(list(key)))
+
+
+def decode_cursor(token):
+    '''Decode a cursor token made by encode_cursor, raising ValueError if
+    it isn't one.'''
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError), e:
+        raise ValueError('Invalid cursor %r: %s' % (token, e))
+    if not isinstance(key, list) or len(key) != 2:
+        raise ValueError('Invalid cursor %r' % token)
+    return tuple(key)
+
+
+def solr_date(value):
+    '''Convert a CKAN timestamp (e.g. 2013-06-12T10:05:27.123456) to the
+    form Solr queries take, to the millisecond Solr keeps.'''
+    value = value.rstrip('Z')
+    if '.' in value:
+        value, fraction = value.split('.', 1)
+        value += '.' + fraction[:3]
+    return value + 'Z'
+
+
+def keyset_filter(key):
+    '''Solr filter query for the packages sorting after `key`.'''
+    modified, package_id = key
+    modified = solr_date(modified)
+    return 'metadata_modified:{%s TO *] OR ' \
+           '(metadata_modified:"%s" AND id:{%s TO *])' % (
+               modified, modified, package_id)
+
+
+class KeysetResults(SearchResults):
+    '''Iterator over the results of a search sorted by KEYSET_SORT, where
+    each page is asked for as the results after the last one of the page
+    before.
+
+    :param results: the results of the first page
+    :param fetch_page: function taking the sort key the page's results come
+        after and the limit, and returning (result_dict, response_bytes)
+    :param count: number of results in all
+    :param limit: page size
+    :param prefetch: number of pages to request in the background while the
+        caller works through the current one. Default *0*
+    :param cursor: the cursor the search started from. Default *None*
+
+    '''
+    def __init__(self, results, fetch_page, count, limit, prefetch=0,
+                 cursor=None):
+        SearchResults.__init__(self, results, fetch_page, count, limit,
+                               prefetch)
+        self._cursor = cursor
+        self._last = None
+
+    def next(self):
+        self._last = SearchResults.next(self)
+        return self._last
+
+    @property
+    def cursor(self):
+        '''Token for resuming the search after the last result yielded,
+        with package_search_keyset(cursor=...).'''
+        if self._last is None:
+            return self._cursor
+        return encode_cursor(keyset_key(self._last))
+
+    def _pages(self, results):
+        # each page's count is of the results after its key, so there are
+        # more until a page has them all
+        remaining = self._count
+        while results and len(results) < remaining:
+            result_dict = self._fetch(keyset_key(results[-1]))
+            results = result_dict['results']
+            remaining = result_dict['count']
+            if results:
+                yield results
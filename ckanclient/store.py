@@ -0,0 +1,297 @@
+'''Persistent local store of packages, groups and tags in SQLite.
+
+``PackageStore`` keeps package, group and tag dicts as fetched from CKAN,
+with indexes on package name, id, tag, group, resource format and
+metadata_modified, so they needn't be fetched again on the next run::
+
+    store = PackageStore('catalog.db')
+    store.upsert_packages(client.package_entity_get_many(names))
+    store.upsert_packages(client.package_search('', {'all_fields': 1})
+                          ['results'])
+    for package in store.find_packages(tag='transport', res_format='CSV'):
+        ...
+
+Its read methods are named after, and return the same shapes as, the
+CkanClient REST methods (package_register_get, package_entity_get ...).
+'''
+import json
+import sqlite3
+import threading
+
+from ckanclient.mirror import field_values
+
+import logging
+logger = logging.getLogger('ckanclient.store')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS package (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    metadata_modified TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS package_modified ON package (metadata_modified);
+CREATE TABLE IF NOT EXISTS package_tag (
+    package_id TEXT NOT NULL,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS package_tag_tag ON package_tag (tag);
+CREATE INDEX IF NOT EXISTS package_tag_package ON package_tag (package_id);
+CREATE TABLE IF NOT EXISTS package_group (
+    package_id TEXT NOT NULL,
+    grp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS package_group_grp ON package_group (grp);
+CREATE INDEX IF NOT EXISTS package_group_package
+    ON package_group (package_id);
+CREATE TABLE IF NOT EXISTS package_format (
+    package_id TEXT NOT NULL,
+    format TEXT NOT NULL COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS package_format_format ON package_format (format);
+CREATE INDEX IF NOT EXISTS package_format_package
+    ON package_format (package_id);
+CREATE TABLE IF NOT EXISTS grp (
+    name TEXT PRIMARY KEY,
+    id TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag (
+    name TEXT PRIMARY KEY
+);
+'''
+
+# tables of package index entries, and their value column
+INDEX_TABLES = (('package_tag', 'tag'), ('package_group', 'grp'),
+                ('package_format', 'format'))
+# the package fields they index
+INDEX_FIELDS = ('tags', 'groups', 'res_format')
+
+
+class PackageStore(object):
+    '''Package, group and tag dicts kept in an SQLite database.
+
+    :param path: the database file, created if need be. Default *':memory:'*
+
+    A store can be shared between threads.
+    '''
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    #
+    # Writing
+    #
+
+    def upsert_packages(self, packages, batch_size=500):
+        '''Add or replace packages, committing every `batch_size`.
+
+        `packages` may be package dicts, such as the 'results' of
+        package_search with all_fields, or the (name, package or error)
+        tuples of package_entity_get_many, whose errors are logged and
+        skipped. Returns the number of packages stored.
+
+        The store is only locked while a batch is written, not while the
+        next packages are taken, which may mean fetching them, so it can be
+        read meanwhile, and if taking them fails the batches written before
+        are kept.
+        '''
+        count = 0
+        batch = []
+        for package in packages:
+            if isinstance(package, tuple):
+                name, package = package
+                if isinstance(package, Exception):
+                    logger.warning('Not storing package %s: %r',
+                                   name, package)
+                    continue
+            batch.append(package)
+            if len(batch) >= batch_size:
+                count += self._upsert_batch(batch)
+                batch = []
+        if batch:
+            count += self._upsert_batch(batch)
+        return count
+
+    def _upsert_batch(self, packages):
+        with self._lock:
+            with self._db:
+                for package in packages:
+                    self._upsert_package(package)
+        return len(packages)
+
+    def upsert_package(self, package):
+        '''Add or replace a package dict.'''
+        return self.upsert_packages([package])
+
+    def _upsert_package(self, package):
+        if hasattr(package, 'to_dict'):
+            # a LazyObject
+            package = package.to_dict()
+        package_id = package.get('id') or package['name']
+        self._delete_package(package_id, package['name'])
+        self._db.execute(
+            'INSERT INTO package (id, name, metadata_modified, data) '
+            'VALUES (?, ?, ?, ?)',
+            (package_id, package['name'], package.get('metadata_modified'),
+             json.dumps(package)))
+        for (table, column), field in zip(INDEX_TABLES, INDEX_FIELDS):
+            self._db.executemany(
+                'INSERT INTO %s VALUES (?, ?)' % table,
+                [(package_id, value) for value
+                 in set(field_values(package, field))])
+
+    def _delete_package(self, package_id, name=None):
+        rows = self._db.execute(
+            'SELECT id FROM package WHERE id = ? OR name = ?',
+            (package_id, name or package_id)).fetchall()
+        for (row_id,) in rows:
+            self._db.execute('DELETE FROM package WHERE id = ?', (row_id,))
+            for table, column in INDEX_TABLES:
+                self._db.execute('DELETE FROM %s WHERE package_id = ?' %
+                                 table, (row_id,))
+        return len(rows)
+
+    def delete_package(self, name_or_id):
+        '''Remove a package. Returns whether it was there.'''
+        with self._lock:
+            with self._db:
+                return bool(self._delete_package(name_or_id))
+
+    def apply_changes(self, changes):
+        '''Apply a stream of ckanclient.sync.Change objects, committing
+        each one, so the store is never behind the mark of the last change
+        applied. Returns the number applied.'''
+        count = 0
+        for change in changes:
+            with self._lock:
+                with self._db:
+                    if change.type == 'deleted':
+                        self._delete_package(change.id or change.name,
+                                             change.name)
+                    else:
+                        self._upsert_package(change.package)
+            count += 1
+        return count
+
+    def upsert_groups(self, groups):
+        '''Add or replace group dicts (or (name, group or error) tuples).
+        Returns the number stored.'''
+        rows = []
+        for group in groups:
+            if isinstance(group, tuple):
+                name, group = group
+                if isinstance(group, Exception):
+                    logger.warning('Not storing group %s: %r', name, group)
+                    continue
+            rows.append((group['name'], group.get('id'), json.dumps(group)))
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO grp VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def upsert_tags(self, tag_names):
+        '''Add tag names, as from tag_register_get. Returns the number
+        given.'''
+        rows = [(name,) for name in tag_names]
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT OR IGNORE INTO tag VALUES (?)',
+                                     rows)
+        return len(rows)
+
+    #
+    # Reading
+    #
+
+    def package_register_get(self):
+        '''Return the list of package names.'''
+        return [name for (name,) in
+                self._query('SELECT name FROM package ORDER BY name')]
+
+    def package_entity_get(self, name_or_id):
+        '''Return the package dict with this name or id, or None.'''
+        rows = self._query('SELECT data FROM package WHERE name = ? '
+                           'UNION ALL SELECT data FROM package WHERE id = ?',
+                           (name_or_id, name_or_id))
+        return json.loads(rows[0][0]) if rows else None
+
+    def tag_register_get(self):
+        '''Return the list of tag names, of tags stored or on packages.'''
+        return [name for (name,) in self._query(
+            'SELECT name FROM tag UNION SELECT tag FROM package_tag '
+            'ORDER BY 1')]
+
+    def tag_entity_get(self, tag_name):
+        '''Return the names of the packages with this tag.'''
+        return [name for (name,) in self._query(
+            'SELECT name FROM package JOIN package_tag '
+            'ON package_tag.package_id = package.id '
+            'WHERE package_tag.tag = ? ORDER BY name', (tag_name,))]
+
+    def group_register_get(self):
+        '''Return the list of group names.'''
+        return [name for (name,) in
+                self._query('SELECT name FROM grp ORDER BY name')]
+
+    def group_entity_get(self, name_or_id):
+        '''Return the group dict with this name or id, or None.'''
+        rows = self._query('SELECT data FROM grp WHERE name = ? OR id = ?',
+                           (name_or_id, name_or_id))
+        return json.loads(rows[0][0]) if rows else None
+
+    def find_packages(self, tag=None, group=None, res_format=None,
+                      modified_since=None, names_only=False):
+        '''Return the package dicts (or names) matching all the filters,
+        by name.
+
+        :param tag: with this tag
+        :param group: in this group
+        :param res_format: with a resource of this format (any case)
+        :param modified_since: with a metadata_modified after this
+        :param names_only: return package names. Default *False*
+
+        '''
+        where = []
+        params = []
+        for (table, column), value in zip(INDEX_TABLES,
+                                          (tag, group, res_format)):
+            if value is not None:
+                where.append('id IN (SELECT package_id FROM %s '
+                             'WHERE %s = ?)' % (table, column))
+                params.append(value)
+        if modified_since is not None:
+            where.append('metadata_modified > ?')
+            params.append(modified_since)
+        sql = 'SELECT %s FROM package' % ('name' if names_only else 'data')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        rows = self._query(sql + ' ORDER BY name', params)
+        if names_only:
+            return [name for (name,) in rows]
+        return [json.loads(data) for (data,) in rows]
+
+    def last_modified(self):
+        '''Return the latest metadata_modified of the packages, e.g. to
+        sync from, or None if there are none.'''
+        return self._query('SELECT MAX(metadata_modified) FROM package')[0][0]
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM package')[0][0]
+
+    def stats(self):
+        '''Return a dict of the numbers of packages, groups and tags.'''
+        return {'packages': len(self),
+                'groups': self._query('SELECT COUNT(*) FROM grp')[0][0],
+                'tags': len(self.tag_register_get())}
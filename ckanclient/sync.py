@@ -0,0 +1,240 @@
+'''Incremental sync of a catalog from its change feeds.
+
+``CatalogSync`` remembers a high-water mark and turns the packages created,
+updated or deleted since then into a stream of ``Change``s::
+
+    sync = CatalogSync(client, mark=load_mark())
+    for change in sync.changes():
+        if change.type == DELETED:
+            drop(change.name)
+        else:
+            store(change.package)
+        save_mark(change.mark)
+
+Changes are delivered at least once: resuming from the mark of a change
+never skips a later one, but may repeat a few before it.
+
+The changes come from a feed:
+
+``ModifiedFeed`` (the default) searches for the packages by their
+metadata_modified, after the keyset cursor that is its mark. Deleted
+packages drop out of search, so they are found by comparing the package
+register with the names already seen (which can be given as `known`).
+
+``RevisionFeed`` follows the revision search API of CKAN's REST API, whose
+marks are revision ids (or an ISO timestamp to start from), and sees
+deletions directly.
+'''
+import re
+
+from ckanclient import (CkanApiNotFoundError, CkanApiNotAuthorizedError,
+                        workers)
+from ckanclient.search import decode_cursor
+
+import logging
+logger = logging.getLogger('ckanclient.sync')
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+
+TIMESTAMP = re.compile(r'^\d{4}-\d\d-\d\dT')
+# where a revision feed without a mark starts
+EPOCH = '1970-01-01T00:00:00'
+
+
+class Change(object):
+    '''A package created, updated or deleted.
+
+    :ivar type: CREATED, UPDATED or DELETED
+    :ivar name: the package's name (or id, as the feed gave it)
+    :ivar id: the package's id, if known
+    :ivar package: the package dict, or None for a package that has been
+        purged or can't be read
+    :ivar mark: the mark to resume from after handling this change
+
+    '''
+    __slots__ = ('type', 'name', 'id', 'package', 'mark')
+
+    def __init__(self, type, name, id, package, mark):
+        self.type = type
+        self.name = name
+        self.id = id
+        self.package = package
+        self.mark = mark
+
+    def __repr__(self):
+        return '<Change %s %s>' % (self.type, self.name)
+
+
+def _created_or_updated(package, since):
+    if since is None or package.get('metadata_created', '') > since:
+        return CREATED
+    return UPDATED
+
+
+def deleted_since(client, known):
+    '''Return (name, id) for the packages of `known` (a dict of name: id,
+    or None if unknown) no longer in the package register, by name.
+
+    A package is matched on its id whenever it has one, so one renamed
+    since is not taken for deleted if another name in `known` has its id.
+    '''
+    # the register lists names (API v1) or ids (API v2)
+    current = set(client.package_register_get())
+    current_ids = set(package_id for name, package_id in known.iteritems()
+                      if package_id is not None and
+                      (name in current or package_id in current))
+    return sorted((name, package_id) for name, package_id
+                  in known.iteritems()
+                  if name not in current and (package_id is None or
+                                              package_id not in current_ids))
+
+
+class ModifiedFeed(object):
+    '''Changes found by searching for packages modified after the mark, a
+    package_search_keyset cursor.
+
+    :param page_size: packages fetched per search request. Default *1000*
+    :param prefetch: pages fetched ahead. Default *1*
+    :param deletions: look for deleted packages in the package register.
+        Default *True*
+    :param known: names of the packages already held, to look for
+        deletions among. Those the feed reports are added. Default *None*
+
+    '''
+    def __init__(self, page_size=1000, prefetch=1, deletions=True,
+                 known=None):
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.deletions = deletions
+        self.known = dict.fromkeys(known or []) # name: id
+        self._names = {} # id: name, of the known packages with an id
+
+    def changes(self, client, mark):
+        '''Yield (mark, change) for each change since `mark`.'''
+        since = decode_cursor(mark)[0] if mark else None
+        res = client.package_search_keyset(
+            '', {'limit': self.page_size}, cursor=mark,
+            prefetch=self.prefetch)
+        results = res['results']
+        for package in results:
+            mark = results.cursor
+            self._add_known(package['name'], package.get('id'))
+            yield mark, Change(_created_or_updated(package, since),
+                               package['name'], package.get('id'), package,
+                               mark)
+        if not self.deletions or not self.known:
+            return
+        for name, package_id in deleted_since(client, self.known):
+            del self.known[name]
+            self._names.pop(package_id, None)
+            yield mark, Change(DELETED, name, package_id, None, mark)
+
+    def _add_known(self, name, package_id):
+        if package_id is not None:
+            old_name = self._names.get(package_id)
+            if old_name is not None and old_name != name:
+                # renamed
+                self.known.pop(old_name, None)
+            self._names[package_id] = name
+        self.known[name] = package_id
+
+
+class RevisionFeed(object):
+    '''Changes found from the revisions made after the mark, a revision id
+    or ISO timestamp (from the start of the history if there is none).
+    Each batch of revisions is fetched, then the packages they changed.
+
+    :param num_workers: concurrent requests for the revisions and packages
+        of a batch. Default *8*
+
+    '''
+    def __init__(self, num_workers=workers.DEFAULT_WORKERS):
+        self.num_workers = num_workers
+
+    def changes(self, client, mark):
+        '''Yield (mark, change) for each change since `mark`, or
+        (mark, None) when a batch of revisions changed no packages.'''
+        if mark is None or TIMESTAMP.match(mark):
+            since = mark
+            ids = client.revision_search(since_time=mark or EPOCH)
+        else:
+            since = client.revision_entity_get(mark)['timestamp']
+            ids = client.revision_search(since_id=mark)
+        while ids:
+            revisions = []
+            for revision_id, revision, error in workers.imap(
+                    client.revision_entity_get, ids, self.num_workers,
+                    ordered=True):
+                if error is not None:
+                    raise error
+                revisions.append(revision)
+            names = []
+            for revision in revisions:
+                for name in revision.get('packages') or []:
+                    if name not in names:
+                        names.append(name)
+            packages = dict(client.package_entity_get_many(
+                names, self.num_workers))
+            batch_mark = ids[-1]
+            for i, name in enumerate(names):
+                package = packages[name]
+                # only the last change of the batch moves the mark on
+                change_mark = batch_mark if i == len(names) - 1 else mark
+                yield change_mark, self._change(name, package, since,
+                                                change_mark)
+            if not names:
+                yield batch_mark, None
+            mark = batch_mark
+            since = revisions[-1]['timestamp']
+            ids = client.revision_search(since_id=mark)
+
+    def _change(self, name, package, since, mark):
+        if isinstance(package, (CkanApiNotFoundError,
+                                CkanApiNotAuthorizedError)):
+            # purged, or deleted and only visible to sysadmins
+            return Change(DELETED, name, None, None, mark)
+        if isinstance(package, Exception):
+            raise package
+        if package.get('state') == 'deleted':
+            change_type = DELETED
+        else:
+            change_type = _created_or_updated(package, since)
+        return Change(change_type, package.get('name', name),
+                      package.get('id'), package, mark)
+
+
+class CatalogSync(object):
+    '''Incremental sync from a high-water mark.
+
+    :param client: the CkanClient to fetch changes with
+    :param mark: the mark to start from, e.g. saved from a previous sync.
+        Default *None* (everything)
+    :param feed: where the changes come from, a ModifiedFeed or
+        RevisionFeed. Default *ModifiedFeed()*
+
+    :ivar mark: the mark after the last change handled
+
+    '''
+    def __init__(self, client, mark=None, feed=None):
+        self.client = client
+        self.mark = mark
+        self.feed = feed if feed is not None else ModifiedFeed()
+        self._stats = {CREATED: 0, UPDATED: 0, DELETED: 0, 'syncs': 0}
+
+    def changes(self):
+        '''Yield a Change for each package created, updated or deleted
+        since the mark, advancing the mark as each one is handled.'''
+        self._stats['syncs'] += 1
+        for mark, change in self.feed.changes(self.client, self.mark):
+            if change is not None:
+                self._stats[change.type] += 1
+                yield change
+            self.mark = mark
+        logger.info('Synced to %s: %s', self.mark, self._stats)
+
+    def stats(self):
+        '''Return a dict of counters: syncs run and changes created, updated
+        and deleted.'''
+        return dict(self._stats)
@@ -0,0 +1,131 @@
+'''A small threaded HTTP/1.1 server for testing the client transport without
+a CKAN instance.
+
+Register responses with ``route()`` and point a client at ``server.url``::
+
+    server = StubServer()
+    server.route('/api/rest/package/x', {'name': 'x'})
+    server.start()
+    ...
+    server.stop()
+'''
+import json
+import threading
+import urllib
+import BaseHTTPServer
+import SocketServer
+
+
+def decode_body(body):
+    '''Decode the JSON data from a request body, which the clients send
+    urlencoded as a form field name.'''
+    return json.loads(urllib.unquote_plus(body.rsplit('=', 1)[0]))
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections are expected
+        pass
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one go rather than a packet per header line
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stub._count_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else ''
+        stub = self.server.stub
+        stub._record(self.command, self.path, self.headers, body)
+        status, headers, content = stub._respond(self, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+        self.wfile.flush()
+        if headers.get('Connection') == 'close':
+            self.close_connection = 1
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(';')[0], 16)
+            chunk = self.rfile.read(size)
+            self.rfile.readline()
+            if not size:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+
+class StubServer(object):
+    '''Serves canned responses on a free localhost port.
+
+    Each route is either a JSON-serialisable value, a (status, headers,
+    content) tuple or a callable taking (request_handler, request_body) and
+    returning such a tuple.
+    '''
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.stub = self
+        self.port = self._server.server_address[1]
+        self.url = 'http://127.0.0.1:%s' % self.port
+        self._thread = None
+
+    def route(self, path, response):
+        self.routes[path] = response
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def _record(self, method, path, headers, body):
+        with self._lock:
+            self.requests.append((method, path, headers, body))
+
+    def _respond(self, handler, body):
+        path = handler.path
+        response = self.routes.get(path)
+        if response is None:
+            response = self.routes.get(path.split('?')[0])
+        if response is None:
+            return 404, {'Content-Type': 'application/json'}, '"Not found"'
+        if callable(response):
+            response = response(handler, body)
+        if not isinstance(response, tuple):
+            response = (200, {'Content-Type': 'application/json'},
+                        json.dumps(response))
+        return response
@@ -0,0 +1,141 @@
+import json
+import socket
+import threading
+import time
+
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.skip import SkipTest
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    raise SkipTest('Need trollius installed to test the asyncio client.')
+
+from ckanclient import (CkanApiError, CkanApiNotFoundError,
+                        CkanApiActionError)
+from ckanclient.aio import AsyncCkanClient, AsyncConnectionPool
+from ckanclient.tests.stubserver import StubServer, decode_body
+
+
+class TestAsyncCkanClient:
+
+    def setup(self):
+        self.server = StubServer().start()
+        base_location = self.server.url + '/api'
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncCkanClient(base_location=base_location,
+                                      api_key='x', concurrency=3,
+                                      loop=self.loop)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def teardown(self):
+        self.client.close()
+        self.loop.close()
+        self.server.stop()
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def _slow_package(self, handler, body):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        return {'name': handler.path.split('/')[-1]}
+
+    def test_package_entity_get(self):
+        for i in range(10):
+            self.server.route('/api/rest/package/pkg%s' % i,
+                              self._slow_package)
+        coros = [self.client.package_entity_get('pkg%s' % i)
+                 for i in range(10)]
+        packages = self.run(asyncio.gather(*coros, loop=self.loop))
+        assert_equal([pkg['name'] for pkg in packages],
+                     ['pkg%s' % i for i in range(10)])
+        # no more requests in flight, or connections, than the concurrency
+        # limit
+        assert_equal(self.max_in_flight, 3)
+        assert self.server.connections <= 3, self.server.connections
+
+    def test_not_found(self):
+        assert_raises(CkanApiNotFoundError, self.run,
+                      self.client.package_entity_get('missing'))
+
+    def test_action(self):
+        self.server.route('/api/action/package_show',
+            {'help': '', 'success': True, 'result': {'name': 'pkg'}})
+        self.server.route('/api/action/group_show',
+            {'help': '', 'success': False, 'error': {'message': 'bad'}})
+        assert_equal(self.run(self.client.package_show('pkg')),
+                     {'name': 'pkg'})
+        method, path, headers, body = self.server.requests[-1]
+        assert_equal(method, 'POST')
+        assert_equal(decode_body(body), {'id': 'pkg'})
+        assert_raises(CkanApiActionError, self.run,
+                      self.client.action('group_show', id='x'))
+
+    def _close_after_request(self, handler, body):
+        # act on the request, then close the connection without responding
+        handler.connection.shutdown(socket.SHUT_RDWR)
+        handler.close_connection = 1
+        return {}
+
+    def test_post_on_stale_connection_not_resent(self):
+        self.server.route('/api/rest/package/pkg', {'name': 'pkg'})
+        self.server.route('/api/action/package_create',
+                          self._close_after_request)
+        self.run(self.client.package_entity_get('pkg'))
+        assert_raises(CkanApiError, self.run,
+                      self.client.action('package_create', name='new'))
+        assert_equal([method for method, path, headers, body
+                      in self.server.requests], ['GET', 'POST'])
+        # idempotent requests are sent again on a new connection
+        self.server.route('/api/rest/package/closing',
+                          self._close_after_request)
+        self.run(self.client.package_entity_get('pkg'))
+        del self.server.requests[:]
+        assert_raises(CkanApiError, self.run,
+                      self.client.package_entity_get('closing'))
+        assert_equal([method for method, path, headers, body
+                      in self.server.requests], ['GET', 'GET'])
+
+    def test_package_search(self):
+        names = ['pkg%s' % i for i in range(25)]
+        def search(handler, body):
+            options = decode_body(body)
+            offset = options.get('offset', 0)
+            return 200, {'Content-Type': 'application/json'}, json.dumps(
+                {'count': len(names),
+                 'results': names[offset:offset + options['limit']]})
+        self.server.route('/api/search/package', search)
+
+        @asyncio.coroutine
+        def scan():
+            result_dict = yield From(self.client.package_search('pkg'))
+            results = yield From(result_dict['results'].all())
+            raise Return(results)
+        assert_equal(self.run(scan()), names)
+
+
+class FakeWriter(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_clear_key():
+    pool = AsyncConnectionPool()
+    writers = [FakeWriter() for i in range(3)]
+    pool.put(('a', 80, False), None, writers[0])
+    pool.put(('a', 80, False), None, writers[1])
+    pool.put(('b', 80, False), None, writers[2])
+    pool.clear(('a', 80, False))
+    assert_equal([writer.closed for writer in writers], [True, True, False])
+    pool.clear()
+    assert writers[2].closed
@@ -0,0 +1,363 @@
+import json
+import socket
+import time
+import threading
+import urllib2
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import bulk
+from ckanclient.bulk import BulkError
+from ckanclient.datastore import DataStoreClient
+from ckanclient.retry import RetryPolicy
+from ckanclient.tests.stubserver import StubServer
+
+
+def parse_bulk(body):
+    '''The (action, document) pairs of a _bulk request body.'''
+    lines = body.split('\n')
+    assert_equal(lines[-1], '')
+    lines = [json.loads(line) for line in lines[:-1]]
+    return zip(lines[::2], lines[1::2])
+
+
+def indexed(handler, body):
+    '''A _bulk response indexing every document of the request.'''
+    return {'errors': False,
+            'items': [{'index': {'status': 201}}] * len(parse_bulk(body))}
+
+
+def test_bulk_entry():
+    assert_equal(parse_bulk(bulk.bulk_entry({'id': 7, 'a': 'x'})),
+                 [({'index': {'_id': 7}}, {'id': 7, 'a': 'x'})])
+    assert_equal(parse_bulk(bulk.bulk_entry({'a': 'x'})),
+                 [({'index': {}}, {'a': 'x'})])
+
+
+def test_batches():
+    docs = [{'a': 'x' * (i % 3 * 50)} for i in range(30)]
+    entry_sizes = [len(bulk.bulk_entry(doc)) for doc in docs]
+    batches = list(bulk.batches(docs, max_bytes=300))
+    assert_equal(sum(len(entries) for entries, size in batches), 30)
+    # every document's entry, in order
+    assert_equal([len(entry) for entries, size in batches
+                  for entry in entries], entry_sizes)
+    for entries, size in batches:
+        assert_equal(size, sum(len(entry) for entry in entries))
+        assert size <= 300
+    # the next entry didn't fit
+    for (entries, size), (next_entries, next_size) in zip(batches,
+                                                          batches[1:]):
+        assert size + len(next_entries[0]) > 300
+    assert_equal([len(entries) for entries, size in
+                  bulk.batches(docs, max_bytes=None, max_docs=7)],
+                 [7, 7, 7, 7, 2])
+    assert_equal([len(entries) for entries, size in
+                  bulk.batches(docs, max_bytes=10 ** 6, max_docs=20)],
+                 [20, 10])
+    # an entry bigger than the budget goes on its own
+    assert_equal([len(entries) for entries, size in
+                  bulk.batches(docs[:3], max_bytes=10)], [1, 1, 1])
+    assert_raises(ValueError, list, bulk.batches(docs, None, None))
+
+
+class TestUpsert:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.server.route('/api/data/abc/_bulk', indexed)
+        self.client = DataStoreClient(self.server.url + '/api/data/abc')
+
+    def teardown(self):
+        self.server.stop()
+
+    def _bodies(self):
+        return [body for method, path, headers, body in self.server.requests]
+
+    def test_budgets_and_connection_reuse(self):
+        docs = [{'id': i, 'name': 'row %d' % i} for i in range(250)]
+        stats = self.client.upsert(docs, max_docs=100)
+        bodies = self._bodies()
+        assert_equal([len(parse_bulk(body)) for body in bodies],
+                     [100, 100, 50])
+        assert_equal([doc for body in bodies
+                      for action, doc in parse_bulk(body)], docs)
+        assert_equal(self.server.connections, 1)
+        assert_equal((stats['docs'], stats['requests'], stats['bytes']),
+                     (250, 3, sum(len(body) for body in bodies)))
+        assert stats['docs_per_sec'] > 0 and stats['bytes_per_sec'] > 0
+
+    def test_upload(self):
+        stats = self.client.upload(StringIO('a,b\n1,2\n3,4\n'),
+                                   filetype='text/csv', max_bytes=40)
+        assert_equal(stats['requests'], 2)
+        assert_equal([doc for body in self._bodies()
+                      for action, doc in parse_bulk(body)],
+                     [{'a': '1', 'b': '2'}, {'a': '3', 'b': '4'}])
+
+
+class TestItemErrors:
+
+    def setup(self):
+        self.server = StubServer().start()
+        # id: statuses the server gives the document, one per attempt
+        self.statuses = {}
+        self.server.route('/api/data/abc/_bulk', self._bulk)
+        self.client = DataStoreClient(self.server.url + '/api/data/abc')
+        self.retry = RetryPolicy(backoff_factor=0.01)
+
+    def teardown(self):
+        self.server.stop()
+
+    def _bulk(self, handler, body):
+        items = []
+        for action, doc in parse_bulk(body):
+            statuses = self.statuses.get(doc['id'])
+            status = statuses.pop(0) if statuses else 201
+            result = {'_id': doc['id'], 'status': status}
+            if status == 429:
+                result['error'] = {'type': 'es_rejected_execution_exception',
+                                   'reason': 'queue full'}
+            elif status >= 300:
+                result['error'] = 'MapperParsingException[failed to parse]'
+            items.append({'index': result})
+        return {'errors': any('error' in item['index'] for item in items),
+                'items': items}
+
+    def _sent(self):
+        return [[doc['id'] for action, doc in parse_bulk(body)]
+                for method, path, headers, body in self.server.requests]
+
+    def test_failed_documents(self):
+        self.statuses = {3: [400], 12: [400]}
+        stats = self.client.upsert([{'id': i} for i in range(20)],
+                                   max_docs=10, retry=self.retry)
+        assert_equal((stats['docs'], stats['indexed'], stats['failed'],
+                      stats['retried'], stats['requests']), (20, 18, 2, 0, 2))
+        assert_equal(stats['errors'], [
+            (3, 400, 'MapperParsingException[failed to parse]'),
+            (12, 400, 'MapperParsingException[failed to parse]')])
+
+    def test_rejected_documents_resent(self):
+        self.statuses = {4: [429, 429], 7: [429], 15: [429]}
+        stats = self.client.upsert([{'id': i} for i in range(20)],
+                                   max_docs=10, retry=self.retry)
+        # only the rejected documents are sent again
+        assert_equal(self._sent(), [range(10), [4, 7], [4],
+                                    range(10, 20), [15]])
+        assert_equal((stats['docs'], stats['indexed'], stats['failed'],
+                      stats['retried'], stats['requests']), (20, 20, 0, 4, 5))
+        assert_equal(stats['errors'], [])
+
+    def test_rejected_documents_not_resent(self):
+        self.statuses = {4: [429]}
+        stats = self.client.upsert([{'id': i} for i in range(10)],
+                                   retry=RetryPolicy(max_retries=0))
+        assert_equal(len(self._sent()), 1)
+        assert_equal((stats['indexed'], stats['failed']), (9, 1))
+        assert_equal(stats['errors'][0][:2], (4, 429))
+
+    def test_rejected_documents_given_up(self):
+        self.statuses = {4: [429] * 5}
+        stats = self.client.upsert([{'id': i} for i in range(10)],
+                                   retry=RetryPolicy(max_retries=2,
+                                                     backoff_factor=0.01))
+        assert_equal(self._sent(), [range(10), [4], [4]])
+        assert_equal((stats['indexed'], stats['failed'], stats['retried']),
+                     (9, 1, 2))
+
+    def test_streamed_rejected_documents_resent(self):
+        self.statuses = {1: [429], 8: [400]}
+        stats = self.client.upsert([{'id': i} for i in range(10)],
+                                   stream=True, max_docs=5, retry=self.retry)
+        assert_equal(self._sent(), [range(5), [1], range(5, 10)])
+        assert_equal((stats['indexed'], stats['failed'], stats['retried']),
+                     (9, 1, 1))
+        assert_equal(stats['errors'][0][:2], (8, 400))
+
+    def test_streamed_entries_not_kept_without_retry(self):
+        self.statuses = {1: [429]}
+        kept = []
+        stream_batches = bulk.stream_batches
+        def recording_stream_batches(*args):
+            for batch in stream_batches(*args):
+                kept.append(batch.entries)
+                yield batch
+        bulk.stream_batches = recording_stream_batches
+        try:
+            stats = self.client.upsert([{'id': i} for i in range(10)],
+                                       stream=True, max_docs=5)
+        finally:
+            bulk.stream_batches = stream_batches
+        assert_equal(kept, [None, None])
+        assert_equal(self._sent(), [range(5), range(5, 10)])
+        assert_equal((stats['indexed'], stats['failed'], stats['retried']),
+                     (9, 1, 0))
+
+    def test_concurrent_rejected_documents_resent(self):
+        self.statuses = {5: [429], 25: [400]}
+        stats = self.client.upsert([{'id': i} for i in range(40)],
+                                   max_docs=10, num_workers=4,
+                                   retry=self.retry)
+        assert_equal((stats['indexed'], stats['failed'], stats['retried'],
+                      stats['requests']), (39, 1, 1, 5))
+        assert_equal(stats['errors'][0][:2], (25, 400))
+
+    def test_too_few_items(self):
+        self.server.route('/api/data/abc/_bulk', lambda handler, body: {
+            'errors': True, 'items': [{'index': {'status': 201}}] * 3})
+        stats = self.client.upsert([{'id': i} for i in range(5)],
+                                   retry=self.retry)
+        assert_equal((stats['indexed'], stats['failed'], stats['retried']),
+                     (0, 5, 0))
+        assert_equal([error[:2] for error in stats['errors']],
+                     [(i, None) for i in range(5)])
+        assert stats['errors'][0][2].startswith('unknown outcome')
+        self.server.route('/api/data/abc/_bulk', {'errors': True})
+        stats = self.client.upsert([{'id': i} for i in range(5)])
+        assert_equal((stats['indexed'], stats['failed']), (0, 5))
+
+    def test_item_errors(self):
+        response = {'items': [{'index': {'status': 201}},
+                              {'create': {'status': 409}},
+                              {'index': {'status': 400, 'error': 'bad'}}]}
+        assert_equal(list(bulk.item_errors(response)),
+                     [(201, None), (409, 'status 409'), (400, 'bad')])
+        assert bulk.is_rejected(429, None)
+        assert bulk.is_rejected(
+            503, 'RemoteTransportException[[node][inet[/1.2.3.4:9300]]'
+            '[bulk/shard]]; nested: EsRejectedExecutionException[rejected '
+            'execution (queue capacity 50)]')
+        assert not bulk.is_rejected(400, 'MapperParsingException[..]')
+
+
+class TestConcurrentUpsert:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.failing = set()
+        self.server.route('/api/data/abc/_bulk', self._bulk)
+        self.client = DataStoreClient(self.server.url + '/api/data/abc')
+
+    def teardown(self):
+        self.server.stop()
+
+    def _bulk(self, handler, body):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.1)
+        with self.lock:
+            self.in_flight -= 1
+        ids = [doc['id'] for action, doc in parse_bulk(body)]
+        if self.failing.intersection(ids):
+            return 500, {'Content-Type': 'application/json'}, '{}'
+        return indexed(handler, body)
+
+    def test_requests_in_parallel(self):
+        docs = [{'id': i} for i in range(80)]
+        stats = self.client.upsert(docs, max_docs=10, num_workers=4)
+        assert_equal(stats['requests'], 8)
+        assert_equal(stats['docs'], 80)
+        assert_equal(self.most_in_flight, 4)
+        sent = sorted(doc['id'] for method, path, headers, body
+                      in self.server.requests
+                      for action, doc in parse_bulk(body))
+        assert_equal(sent, range(80))
+
+    def test_failures_in_order(self):
+        self.failing.update([35, 12])
+        docs = ({'id': i} for i in range(1000))
+        try:
+            self.client.upsert(docs, max_docs=10, num_workers=3)
+        except BulkError, e:
+            assert_equal([(offset, count) for offset, count, error
+                          in e.failures], [(10, 10), (30, 10)])
+            assert_equal(e.failures[0][2].code, 500)
+            # it stopped soon after the first failure
+            assert e.summary['requests'] < 20
+        else:
+            assert False, 'BulkError not raised'
+
+    def test_upload_json(self):
+        data = json.dumps([{'id': i} for i in range(30)])
+        stats = self.client.upload(StringIO(data), filetype='json',
+                                   max_docs=10, num_workers=3)
+        assert_equal(stats['docs'], 30)
+        assert_equal(self.most_in_flight, 3)
+
+
+class TestStreamedUpsert:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.server.route('/api/data/abc/_bulk', indexed)
+        self.records = []
+        self.client = DataStoreClient(self.server.url + '/api/data/abc',
+                                      hooks=[self.records.append])
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_chunked_bodies(self):
+        taken = []
+        def docs():
+            for i in range(500):
+                taken.append(i)
+                yield {'id': i, 'text': 'x' * 100}
+        stats = self.client.upsert(docs(), max_bytes=20000, stream=True,
+                                   refresh=True)
+        requests = self.server.requests
+        assert_equal([path for method, path, headers, body in requests],
+                     ['/api/data/abc/_bulk?refresh=true'] * stats['requests'])
+        assert all(headers['Transfer-Encoding'] == 'chunked'
+                   for method, path, headers, body in requests)
+        bodies = [body for method, path, headers, body in requests]
+        assert all(len(body) <= 20000 for body in bodies)
+        assert_equal([doc['id'] for body in bodies
+                      for action, doc in parse_bulk(body)], range(500))
+        assert_equal(stats['bytes'], sum(len(body) for body in bodies))
+        assert_equal(self.server.connections, 1)
+        assert_equal([record.request_bytes for record in self.records],
+                     [len(body) for body in bodies])
+        assert_equal(self.records[0].status, 200)
+
+    def test_stale_connection_skipped(self):
+        self.client.upsert([{'id': 1}], stream=True)
+        # make the idle connection look closed by the server
+        pool = self.client.connection_pool
+        key = ('HTTPConnection', self.client.netloc, None)
+        conn, reused = pool.get(key, None)
+        assert reused
+        conn.sock.shutdown(socket.SHUT_RD)
+        pool.put(key, conn)
+        self.client.upsert([{'id': 2}], stream=True)
+        assert_equal(pool.stats()['stale'], 1)
+        assert_equal(self.server.connections, 2)
+        assert_equal(len(self.server.requests), 2)
+
+    def test_error_status(self):
+        self.server.route('/api/data/abc/_bulk', (
+            400, {'Content-Type': 'application/json'}, '{"error": "bad"}'))
+        try:
+            self.client.upsert([{'id': 1}], stream=True)
+        except urllib2.HTTPError, e:
+            assert_equal(e.code, 400)
+            assert_equal(e.read(), '{"error": "bad"}')
+        else:
+            assert False, 'HTTPError not raised'
+
+    def test_stream_batches(self):
+        batches = bulk.stream_batches([{'id': i} for i in range(5)],
+                                      max_docs=2)
+        sizes = []
+        for batch in batches:
+            list(batch)
+            sizes.append(batch.docs)
+        assert_equal(sizes, [2, 2, 1])
+        assert_equal(list(bulk.chunks(['ab', 'cd', 'e'], chunk_size=3)),
+                     ['abcd', 'e'])
@@ -0,0 +1,121 @@
+import json
+import mimetools
+import zlib
+from StringIO import StringIO
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiNotFoundError
+from ckanclient.cache import ResponseCache, DiskResponseCache
+from ckanclient.tests.stubserver import StubServer
+
+
+def _entry(body):
+    return {'etag': '"1"', 'last_modified': None, 'headers': '',
+            'body': body}
+
+
+class TestResponseCache:
+
+    def test_lru_by_entries(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', _entry('1'))
+        cache.set('b', _entry('2'))
+        cache.get('a')
+        cache.set('c', _entry('3'))
+        assert cache.get('b') is None
+        assert_equal(cache.get('a')['body'], '1')
+        assert_equal(cache.get('c')['body'], '3')
+        assert_equal(cache.stats()['evictions'], 1)
+
+    def test_lru_by_bytes(self):
+        cache = ResponseCache(max_entries=None, max_bytes=10)
+        cache.set('a', _entry('x' * 6))
+        cache.set('b', _entry('x' * 6))
+        assert cache.get('a') is None
+        assert_equal(cache.stats()['bytes'], 6)
+        # too big to cache at all
+        cache.set('c', _entry('x' * 11))
+        assert cache.get('c') is None
+        assert_equal(len(cache), 1)
+
+    def test_disk_cache_persists(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = DiskResponseCache(path)
+            cache.set('a', _entry('1'))
+            cache.set('b', _entry('2'))
+            cache = DiskResponseCache(path, max_entries=2)
+            assert_equal(len(cache), 2)
+            assert_equal(cache.get('a')['body'], '1')
+            cache.set('c', _entry('3'))
+            # b was least recently used
+            assert cache.get('b') is None
+            assert_equal(cache.get('a')['body'], '1')
+        finally:
+            shutil.rmtree(path)
+
+
+class TestCacheHandler:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.version = 1
+        def package(handler, body):
+            etag = '"v%s"' % self.version
+            if handler.headers.get('If-None-Match') == etag:
+                return 304, {'ETag': etag}, ''
+            return 200, {'Content-Type': 'application/json', 'ETag': etag}, \
+                json.dumps({'name': 'pkg', 'version': self.version})
+        self.server.route('/api/rest/package/pkg', package)
+        self.cache = ResponseCache()
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x', cache=self.cache)
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_not_modified_served_from_cache(self):
+        assert_equal(self.client.package_entity_get('pkg')['version'], 1)
+        assert_equal(self.client.package_entity_get('pkg')['version'], 1)
+        assert_equal(self.client.last_status, 200)
+        method, path, headers, body = self.server.requests[-1]
+        assert_equal(headers['If-None-Match'], '"v1"')
+        stats = self.cache.stats()
+        assert_equal((stats['hits'], stats['misses']), (1, 1))
+        # the connection is reused after a 304
+        assert_equal(self.client.connection_pool.stats()['connects'], 1)
+
+    def test_modified(self):
+        self.client.package_entity_get('pkg')
+        self.version = 2
+        assert_equal(self.client.package_entity_get('pkg')['version'], 2)
+        assert_equal(self.client.package_entity_get('pkg')['version'], 2)
+        assert_equal(self.cache.stats()['hits'], 1)
+
+    def test_decompressed_body_headers(self):
+        content = json.dumps({'name': 'zipped'})
+        def package(handler, body):
+            if handler.headers.get('If-None-Match') == '"z1"':
+                return 304, {'ETag': '"z1"'}, ''
+            return 200, {'Content-Type': 'application/json', 'ETag': '"z1"',
+                         'Content-Encoding': 'deflate'}, zlib.compress(content)
+        self.server.route('/api/rest/package/zipped', package)
+        self.client.package_entity_get('zipped')
+        entry = self.cache.get(self.cache._entries.keys()[0])
+        headers = mimetools.Message(StringIO(entry['headers']))
+        assert_equal(entry['body'], content)
+        assert_equal(headers.get('Content-Encoding'), None)
+        assert_equal(headers['Content-Length'], str(len(content)))
+        # replayed from the cache
+        assert_equal(self.client.package_entity_get('zipped'),
+                     {'name': 'zipped'})
+        assert_equal(self.cache.stats()['hits'], 1)
+        assert_equal(self.client.last_headers.get('Content-Encoding'), None)
+
+    def test_errors_not_cached(self):
+        assert_raises(CkanApiNotFoundError,
+                      self.client.package_entity_get, 'missing')
+        assert_equal(len(self.cache), 0)
@@ -0,0 +1,124 @@
+import time
+import threading
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiNotFoundError
+from ckanclient.coalesce import SingleFlight
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestSingleFlight:
+
+    def test_concurrent_calls_share_one(self):
+        flight = SingleFlight()
+        calls = []
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'result'
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            flight.do('key', func))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(len(calls), 1)
+        assert_equal(sorted(results), [('result', False)] +
+                     [('result', True)] * 4)
+        assert_equal(flight.stats(), {'calls': 1, 'coalesced': 4,
+                                      'in_flight': 0})
+        # once done, the next call is made afresh
+        assert_equal(flight.do('key', func), ('result', False))
+
+    def test_error_shared(self):
+        flight = SingleFlight()
+        def func():
+            time.sleep(0.2)
+            raise ValueError('boom')
+        errors = []
+        def call():
+            try:
+                flight.do('key', func)
+            except ValueError, e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal([str(e) for e in errors], ['boom'] * 3)
+        assert_equal(flight.stats(), {'calls': 1, 'coalesced': 2,
+                                      'in_flight': 0})
+        # a failed call isn't left in flight: the next one is made afresh
+        assert_raises(ValueError, flight.do, 'key', func)
+        assert_equal(flight.stats()['calls'], 2)
+
+
+class TestClientCoalescing:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.server.route('/api/rest/package/pkg1', self._slow(
+            {'name': 'pkg1', 'tags': ['a']}))
+        self.server.route('/api/action/package_show', self._slow(
+            {'help': '', 'success': True, 'result': {'name': 'pkg1'}}))
+        self.server.route('/api/rest/package/missing', self._slow(
+            (404, {'Content-Type': 'application/json'}, '"Not found"')))
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x', single_flight=SingleFlight())
+
+    def teardown(self):
+        self.server.stop()
+
+    def _slow(self, response):
+        def respond(handler, body):
+            time.sleep(0.3)
+            return response
+        return respond
+
+    def _concurrently(self, func, count=6):
+        results = [None] * count
+        def run(i):
+            try:
+                results[i] = func(i)
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_package_entity_get(self):
+        def get(i):
+            package = self.client.package_entity_get('pkg1')
+            assert_equal(self.client.last_status, 200)
+            return package
+        packages = self._concurrently(get)
+        assert_equal(len(self.server.requests), 1)
+        assert_equal(packages, [{'name': 'pkg1', 'tags': ['a']}] * 6)
+        # each caller has its own copy
+        packages[0]['tags'].append('b')
+        assert_equal(packages[1]['tags'], ['a'])
+        assert_equal(self.client.single_flight.stats()['coalesced'], 5)
+
+    def test_errors_and_distinct_requests(self):
+        errors = self._concurrently(
+            lambda i: self.client.package_entity_get('missing'))
+        assert all(isinstance(e, CkanApiNotFoundError) for e in errors)
+        assert_equal(len(self.server.requests), 1)
+        # read actions are coalesced by their data
+        results = self._concurrently(
+            lambda i: self.client.package_show('pkg1' if i % 2 else 'x'))
+        assert_equal(len(self.server.requests), 3)
+        assert_equal(results, [{'name': 'pkg1'}] * 6)
+
+    def test_writes_not_coalesced(self):
+        self.server.route('/api/rest/package', {'name': 'new'})
+        self._concurrently(lambda i: self.client.package_register_post(
+            {'name': 'new'}), count=3)
+        assert_equal(len(self.server.requests), 3)
@@ -0,0 +1,192 @@
+import gzip
+import httplib
+import json
+import socket
+import time
+import urllib2
+import zlib
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient
+from ckanclient.connection import (ConnectionPool, DecompressingReader,
+                                   KeepAliveHandler)
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestConnectionPool:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.server.route('/api/rest/package/annakarenina',
+                          {'name': 'annakarenina'})
+        self.base_location = self.server.url + '/api'
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_connection_reused(self):
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        for i in range(3):
+            pkg = client.package_entity_get('annakarenina')
+            assert_equal(pkg['name'], 'annakarenina')
+        stats = client.connection_pool.stats()
+        assert_equal(stats['connects'], 1)
+        assert_equal(stats['reuses'], 2)
+        assert_equal(self.server.connections, 1)
+
+    def test_idle_timeout(self):
+        client = CkanClient(base_location=self.base_location, api_key='x',
+                            pool_idle_timeout=0.1)
+        client.package_entity_get('annakarenina')
+        time.sleep(0.2)
+        client.package_entity_get('annakarenina')
+        stats = client.connection_pool.stats()
+        assert_equal(stats['connects'], 2)
+        assert_equal(stats['expired'], 1)
+
+    def test_server_closed_connection(self):
+        self.server.route('/api/rest/package/closing',
+            (200, {'Content-Type': 'application/json',
+                   'Connection': 'close'}, '{"name": "closing"}'))
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        client.package_entity_get('closing')
+        client.package_entity_get('annakarenina')
+        assert_equal(client.connection_pool.stats()['connects'], 2)
+
+    def test_stale_connection_retried(self):
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        client.package_entity_get('annakarenina')
+        # close the server side of the pooled connection behind its back
+        for conns in client.connection_pool._idle.values():
+            for conn, last_used in conns:
+                conn.sock.shutdown(2)
+        pkg = client.package_entity_get('annakarenina')
+        assert_equal(pkg['name'], 'annakarenina')
+        assert_equal(client.connection_pool.stats()['stale'], 1)
+
+    def _stale_connection(self, pool):
+        # a pooled connection on which the server takes the request, then
+        # closes without responding
+        class StaleConnection(object):
+            # idle and still open as far as select can tell
+            sock, peer = socket.socketpair()
+            requests = []
+            def request(self, method, url, body=None, headers={}):
+                self.requests.append(method)
+            def getresponse(self, buffering=False):
+                raise httplib.BadStatusLine('')
+            def close(self):
+                pass
+        conn = StaleConnection()
+        key = ('HTTPConnection', '127.0.0.1:%s' % self.server.port, None)
+        pool.put(key, conn)
+        return conn
+
+    def test_post_not_replayed(self):
+        self.server.route('/api/rest/package', {'name': 'new'})
+        pool = ConnectionPool()
+        opener = urllib2.build_opener(KeepAliveHandler(pool))
+        conn = self._stale_connection(pool)
+        assert_raises(urllib2.URLError, opener.open,
+                      self.base_location + '/rest/package', '{}')
+        assert_equal(conn.requests, ['POST'])
+        assert_equal(self.server.requests, [])
+        # idempotent requests are sent again on a new connection
+        conn = self._stale_connection(pool)
+        opener.open(self.base_location + '/rest/package/annakarenina').read()
+        assert_equal(conn.requests, ['GET'])
+        assert_equal(len(self.server.requests), 1)
+
+    def test_post_skips_closed_connection(self):
+        self.server.route('/api/rest/package', {'name': 'new'})
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        client.package_entity_get('annakarenina')
+        for conns in client.connection_pool._idle.values():
+            for conn, last_used in conns:
+                conn.sock.shutdown(2)
+        client.package_register_post({'name': 'new'})
+        assert_equal([method for method, path, headers, body
+                      in self.server.requests], ['GET', 'POST'])
+        stats = client.connection_pool.stats()
+        assert_equal((stats['stale'], stats['connects']), (1, 2))
+
+    def test_keep_alive_off(self):
+        client = CkanClient(base_location=self.base_location, api_key='x',
+                            keep_alive=False)
+        client.package_entity_get('annakarenina')
+        client.package_entity_get('annakarenina')
+        assert client.connection_pool is None
+        assert_equal(self.server.connections, 2)
+
+
+class TestCompression:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.base_location = self.server.url + '/api'
+        self.packages = ['package%s' % i for i in range(1000)]
+
+    def teardown(self):
+        self.server.stop()
+
+    def _route_encoded(self, encoding, compress):
+        def respond(handler, body):
+            content = json.dumps(self.packages)
+            headers = {'Content-Type': 'application/json'}
+            if encoding in handler.headers.get('Accept-Encoding', ''):
+                content = compress(content)
+                headers['Content-Encoding'] = encoding
+            return 200, headers, content
+        self.server.route('/api/rest/package', respond)
+
+    def test_gzip(self):
+        def gzip_compress(content):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(content)
+            f.close()
+            return buf.getvalue()
+        self._route_encoded('gzip', gzip_compress)
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        assert_equal(client.package_register_get(), self.packages)
+        assert_equal(client.last_headers['Content-Encoding'], 'gzip')
+        # the connection is still reusable after a compressed body
+        assert_equal(client.package_register_get(), self.packages)
+        assert_equal(client.connection_pool.stats()['reuses'], 1)
+
+    def test_deflate(self):
+        self._route_encoded('deflate', zlib.compress)
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        assert_equal(client.package_register_get(), self.packages)
+
+    def test_raw_deflate(self):
+        def raw_deflate(content):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            return compressor.compress(content) + compressor.flush()
+        self._route_encoded('deflate', raw_deflate)
+        client = CkanClient(base_location=self.base_location, api_key='x')
+        assert_equal(client.package_register_get(), self.packages)
+
+    def test_compression_off(self):
+        self._route_encoded('gzip', None)
+        client = CkanClient(base_location=self.base_location, api_key='x',
+                            compression=False)
+        assert_equal(client.package_register_get(), self.packages)
+        method, path, headers, body = self.server.requests[-1]
+        assert 'gzip' not in headers.get('Accept-Encoding', ''), headers
+
+    def test_reader_reads_in_chunks(self):
+        content = json.dumps(self.packages)
+        reader = DecompressingReader(StringIO(zlib.compress(content)),
+                                     'deflate')
+        reader.chunk_size = 64
+        parts = []
+        while True:
+            data = reader.read(100)
+            if not data:
+                break
+            parts.append(data)
+        assert_equal(''.join(parts), content)
+        assert_equal(reader.raw_bytes, len(zlib.compress(content)))
@@ -0,0 +1,144 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import export
+from ckanclient.datastore import DataStoreClient
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestScan:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.docs = [{'id': i, 'name': u'row %d \xe9' % i, 'tags': ['a']}
+                     for i in range(25)]
+        self.scrolls = {} # scroll id: documents left
+        self.cleared = []
+        # ElasticSearch itself, rather than the Data API
+        self.server.route('/index/abc/_search', self._search)
+        self.server.route('/_search/scroll', self._scroll)
+        self.client = DataStoreClient(self.server.url + '/index/abc')
+
+    def teardown(self):
+        self.server.stop()
+
+    def _hits(self, scroll_id):
+        docs, size, source = self.scrolls[scroll_id]
+        hits = []
+        for doc in docs[:size]:
+            if source is not None:
+                doc = dict((key, value) for key, value in doc.items()
+                           if key in source)
+            hits.append({'_id': doc.get('id'), '_source': doc})
+        self.scrolls[scroll_id] = docs[size:], size, source
+        return {'_scroll_id': scroll_id, 'hits': {'total': len(docs),
+                                                  'hits': hits}}
+
+    def _search(self, handler, body):
+        assert 'scroll=5m' in handler.path
+        body = json.loads(body)
+        scroll_id = 'scroll%d' % len(self.scrolls)
+        self.scrolls[scroll_id] = (self.docs, body['size'],
+                                   body.get('_source'))
+        return self._hits(scroll_id)
+
+    def _scroll(self, handler, body):
+        # the raw scroll id
+        if handler.command == 'DELETE':
+            self.cleared.append(body)
+            return {}
+        return self._hits(body)
+
+    def _paths(self):
+        return [(method, path) for method, path, headers, body
+                in self.server.requests]
+
+    def test_scan(self):
+        docs = list(self.client.scan(batch_size=10))
+        assert_equal(docs, self.docs)
+        scroll = '/_search/scroll?scroll=5m'
+        assert_equal(self._paths(), [
+            ('POST', '/index/abc/_search?scroll=5m'), ('POST', scroll),
+            ('POST', scroll), ('POST', scroll),
+            ('DELETE', '/_search/scroll')])
+        assert_equal(self.server.requests[1][3], 'scroll0')
+        assert_equal(self.cleared, ['scroll0'])
+        body = json.loads(self.server.requests[0][3])
+        assert_equal(body, {'query': {'match_all': {}}, 'size': 10})
+
+    def test_scan_is_lazy(self):
+        docs = self.client.scan(batch_size=10)
+        for i in range(10):
+            next(docs)
+        assert_equal(len(self.server.requests), 1)
+        next(docs)
+        assert_equal(len(self.server.requests), 2)
+        # stopping early clears the scroll too
+        docs.close()
+        assert_equal(self.cleared, ['scroll0'])
+
+    def test_scan_fields(self):
+        docs = list(self.client.scan({'term': {'tags': 'a'}}, batch_size=7,
+                                     fields=['id']))
+        assert_equal(docs, [{'id': i} for i in range(25)])
+        body = json.loads(self.server.requests[0][3])
+        assert_equal(body['query'], {'term': {'tags': 'a'}})
+        assert_equal(body['_source'], ['id'])
+
+    def test_scan_through_data_api(self):
+        # the Data API only proxies the table's own URLs, so no scroll
+        def search(handler, body):
+            body = json.loads(body)
+            hits = [{'_source': doc} for doc in
+                    self.docs[body['from']:body['from'] + body['size']]]
+            return {'hits': {'total': len(self.docs), 'hits': hits}}
+        self.server.route('/api/data/abc/_search', search)
+        client = DataStoreClient(self.server.url + '/api/data/abc')
+        docs = client.scan(batch_size=10)
+        assert_equal(next(docs), self.docs[0])
+        assert_equal(len(self.server.requests), 1)
+        assert_equal(list(docs), self.docs[1:])
+        assert_equal(self._paths(), [('POST', '/api/data/abc/_search')] * 3)
+        assert_equal([json.loads(body)['from'] for method, path, headers, body
+                      in self.server.requests], [0, 10, 20])
+
+    def test_export(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'table.ndjson')
+            assert_equal(self.client.export(path, batch_size=10), 25)
+            with open(path) as fileobj:
+                assert_equal([json.loads(line) for line in fileobj],
+                             self.docs)
+            path = os.path.join(tmpdir, 'table.csv')
+            assert_equal(self.client.export(path, fields=['name', 'id']), 25)
+            with open(path) as fileobj:
+                rows = list(csv.reader(fileobj))
+            assert_equal(rows[0], ['name', 'id'])
+            assert_equal(rows[1], ['row 0 \xc3\xa9', '0'])
+            assert_equal(len(rows), 26)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def test_write_csv():
+    out = StringIO()
+    docs = [{'b': 1, 'a': {'x': None}}, {'b': None, 'c': 'extra'}]
+    assert_equal(export.write_csv(docs, out), 2)
+    assert_equal(out.getvalue(), 'a,b\r\n"{""x"": null}",1\r\n,\r\n')
+    out = StringIO()
+    assert_equal(export.write_csv([], out, fields=['a']), 0)
+    assert_equal(out.getvalue(), 'a\r\n')
+
+
+def test_writer_for():
+    assert export.writer_for('text/csv') is export.write_csv
+    assert export.writer_for('application/x-ndjson') is export.write_ndjson
+    assert export.writer_for('.json') is export.write_ndjson
+    assert_raises(ValueError, export.writer_for, 'application/xml')
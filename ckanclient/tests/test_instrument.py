@@ -0,0 +1,119 @@
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiError, CkanApiNotFoundError
+from ckanclient.datastore import DataStoreClient
+from ckanclient.instrument import TimingAggregator, RequestRecord, percentile
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestInstrumentation:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.server.route('/api/rest/package/pkg1', {'name': 'pkg1'})
+        self.server.route('/api/rest/package', ['pkg1'])
+        self.server.route('/api/action/package_show',
+                          {'help': '', 'success': True,
+                           'result': {'name': 'pkg1'}})
+        self.records = []
+        self.timings = TimingAggregator()
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x',
+                                 hooks=[self.records.append, self.timings])
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_record_fields(self):
+        self.client.package_entity_get('pkg1')
+        assert_equal(len(self.records), 1)
+        record = self.records[0]
+        assert_equal(record.method, 'GET')
+        assert_equal(record.endpoint, 'Package Entity')
+        assert_equal(record.status, 200)
+        assert_equal(record.response_bytes, len('{"name": "pkg1"}'))
+        assert_equal(record.attempt, 0)
+        for phase in ('connect', 'ttfb', 'transfer', 'decode', 'total'):
+            assert getattr(record, phase) >= 0, (phase, record)
+        assert record.total >= record.ttfb
+
+    def test_reused_connection(self):
+        self.client.package_entity_get('pkg1')
+        self.client.package_entity_get('pkg1')
+        assert_equal(self.records[1].connect, 0)
+
+    def test_endpoint_names(self):
+        self.client.package_register_get()
+        self.client.action('package_show', id='pkg1')
+        assert_raises(CkanApiNotFoundError,
+                      self.client.package_entity_get, 'missing')
+        assert_equal([(r.method, r.endpoint, r.status) for r in self.records],
+                     [('GET', 'Package Register', 200),
+                      ('POST', 'action/package_show', 200),
+                      ('GET', 'Package Entity', 404)])
+        assert self.records[1].request_bytes > 0
+
+    def test_unreachable_server(self):
+        self.server.stop()
+        assert_raises(CkanApiError, self.client.package_entity_get, 'pkg1')
+        assert_equal(self.records[-1].status, None)
+
+    def test_failing_hook_is_ignored(self):
+        def hook(record):
+            raise ValueError('hook failed')
+        self.client.hooks.insert(0, hook)
+        assert_equal(self.client.package_entity_get('pkg1'), {'name': 'pkg1'})
+        assert_equal(len(self.records), 1)
+
+    def test_aggregator(self):
+        for i in range(3):
+            self.client.package_entity_get('pkg1')
+        assert_raises(CkanApiNotFoundError,
+                      self.client.package_entity_get, 'missing')
+        summary = self.timings.summary()
+        stats = summary['GET Package Entity']
+        assert_equal(stats['requests'], 4)
+        assert_equal(stats['errors'], 1)
+        p50, p95, p99 = stats['total']
+        assert 0 <= p50 <= p95 <= p99, stats['total']
+        out = StringIO()
+        self.timings.report(out)
+        lines = out.getvalue().splitlines()
+        assert_equal(len(lines), 2)
+        assert lines[1].startswith('GET Package Entity'), lines
+
+    def test_datastore_client(self):
+        self.server.route('/api/data/abc/_search', {'hits': {'total': 0}})
+        self.server.route('/api/data/abc/_bulk',
+                          {'items': [{'index': {'status': 201}}]})
+        client = DataStoreClient(self.server.url + '/api/data/abc',
+                                 hooks=[self.records.append])
+        client.query({'query': {'match_all': {}}})
+        client.upsert([{'a': 1}])
+        assert_equal([(r.method, r.endpoint, r.status) for r in self.records],
+                     [('POST', 'DataStore Search', 200),
+                      ('POST', 'DataStore Bulk', 200)])
+        # bulk responses are decoded for the outcome of each document too
+        assert self.records[0].decode >= 0
+        assert self.records[1].decode >= 0
+        assert self.records[1].request_bytes > 0
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert_equal(percentile(values, 0.5), 51)
+    assert_equal(percentile(values, 0.99), 99)
+    assert_equal(percentile([], 0.5), None)
+
+
+def test_aggregator_skips_missing_phases():
+    timings = TimingAggregator()
+    record = RequestRecord('GET', 'Package Register', 'http://x')
+    record.status = 200
+    record.total = 0.5
+    timings(record)
+    stats = timings.summary()['GET Package Register']
+    assert_equal(stats['total'], (0.5, 0.5, 0.5))
+    assert_equal(stats['decode'], (None, None, None))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import json
+from StringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiActionError
+from ckanclient.jsonstream import iter_array
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestIterArray:
+
+    items = [u'annakarenina', 12345, -1.5e3, None, True, False,
+             {u'nested': [1, {u'a': u'b'}], u'title': u'W\xe4r & Peace'},
+             [], {}, u'"quoted" \\ ☃']
+
+    def _iter(self, text, chunk_size, **kwargs):
+        return list(iter_array(StringIO(text), chunk_size=chunk_size,
+                               **kwargs))
+
+    def test_chunk_boundaries(self):
+        text = json.dumps(self.items, indent=1)
+        for chunk_size in (1, 2, 3, 7, 1000):
+            assert_equal(self._iter(text, chunk_size), self.items)
+
+    def test_utf8(self):
+        text = json.dumps(self.items, ensure_ascii=False).encode('utf-8')
+        assert_equal(self._iter(text, 1), self.items)
+
+    def test_empty(self):
+        assert_equal(self._iter(' [ ] ', 1), [])
+        assert_equal(self._iter('{"result": []}', 1, key='result'), [])
+
+    def test_key(self):
+        text = json.dumps({'help': 'x', 'success': True,
+                           'result': self.items})
+        envelope = {}
+        for chunk_size in (1, 5):
+            assert_equal(self._iter(text, chunk_size, key='result',
+                                    envelope=envelope), self.items)
+        assert_equal(envelope, {'help': 'x', 'success': True})
+
+    def test_invalid(self):
+        assert_raises(ValueError, self._iter, '{"a": 1}', 3)
+        assert_raises(ValueError, self._iter, '[1, 2', 3)
+        assert_raises(ValueError, self._iter, '[1 2]', 3)
+
+
+class TestStreamingClient:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.names = ['pkg%s' % i for i in range(2000)]
+        self.server.route('/api/rest/package', self.names)
+        self.server.route('/api/action/package_list',
+            {'help': '', 'success': True, 'result': self.names})
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_package_register_get(self):
+        names = self.client.package_register_get(stream=True)
+        assert self.client.last_body is None
+        assert_equal(list(names), self.names)
+        # the connection went back to the pool once the body was read
+        self.client.package_register_get()
+        assert_equal(self.client.connection_pool.stats()['reuses'], 1)
+
+    def test_package_list(self):
+        assert_equal(list(self.client.package_list(stream=True)), self.names)
+
+    def test_package_list_error(self):
+        self.server.route('/api/action/package_list',
+            {'help': '', 'success': False, 'error': {'message': 'bad'}})
+        assert_raises(CkanApiActionError, list,
+                      self.client.package_list(stream=True))
@@ -0,0 +1,140 @@
+import json
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient
+from ckanclient.lazyjson import LazyObject, lazy_array, project
+from ckanclient.tests.stubserver import StubServer, decode_body
+
+PACKAGE = {
+    'name': 'pkg1',
+    'title': u'Caf\xe9 [with] {brackets}',
+    'notes': 'Quotes " and backslashes \\ and \\"',
+    'version': None,
+    'private': False,
+    'num_resources': 2,
+    'resources': [
+        {'url': 'http://example.com/1.csv', 'format': 'CSV',
+         'description': 'closing ] and } in a string'},
+        {'url': 'http://example.com/2.json', 'format': 'JSON'},
+    ],
+    'tags': ['a', 'b'],
+    'extras': {'k': 'v'},
+    'groups': [],
+    'tracking_summary': {},
+    'deep': [[[[[[{'x': [1, 2]}]]]]]],
+}
+
+
+class TestLazyObject:
+
+    def test_round_trip(self):
+        for indent in (None, 2):
+            text = json.dumps(PACKAGE, indent=indent)
+            package = LazyObject(text)
+            assert_equal(package.to_dict(), PACKAGE)
+            assert_equal(package.end, len(text))
+
+    def test_nested_sections_decoded_on_access(self):
+        package = LazyObject(json.dumps(PACKAGE))
+        assert_equal(package['name'], 'pkg1')
+        assert 'resources' in package
+        assert 'resources' not in package._values
+        assert_equal(package['resources'][1]['format'], 'JSON')
+        assert 'resources' in package._values
+        assert package._text is not None
+        package.to_dict()
+        # nothing left to decode, so the text is let go
+        assert package._text is None
+
+    def test_last_span_decoded_meanwhile(self):
+        obj = LazyObject('{"a": [1], "b": {"c": 2}}')
+        assert_equal(obj['b'], {'c': 2})
+        class Spans(dict):
+            # another thread decodes the same member, the last one left,
+            # just after this thread has looked up its span
+            interleaved = False
+            def get(self, name, default=None):
+                start = dict.get(self, name, default)
+                if not self.interleaved:
+                    self.interleaved = True
+                    assert_equal(obj[name], [1])
+                return start
+        obj._spans = Spans(obj._spans)
+        assert_equal(obj['a'], [1])
+        assert_equal(obj.to_dict(), {'a': [1], 'b': {'c': 2}})
+        assert obj._text is None
+
+    def test_fields(self):
+        package = LazyObject(json.dumps(PACKAGE),
+                             fields=['name', 'resources', 'missing'])
+        assert_equal(sorted(package), ['name', 'resources'])
+        assert_equal(package.to_dict(), project(PACKAGE, ['name',
+                                                          'resources']))
+        assert_raises(KeyError, package.__getitem__, 'notes')
+        assert_equal(package.get('notes'), None)
+
+    def test_get_lazy(self):
+        message = LazyObject(json.dumps({'count': 2,
+                                         'results': [PACKAGE, 'x']}))
+        results = message.get_lazy('results', fields=['name'])
+        assert isinstance(results[0], LazyObject)
+        assert_equal(results[0].to_dict(), {'name': 'pkg1'})
+        assert_equal(results[1], 'x')
+        assert_equal(message.get_lazy('count'), 2)
+
+    def test_lazy_array(self):
+        assert_equal(lazy_array(' [ ] '), [])
+        items = lazy_array('[1, "two", {"three": [3]}]')
+        assert_equal(items[:2], [1, 'two'])
+        assert_equal(items[2]['three'], [3])
+
+    def test_invalid(self):
+        for text in ('', '[]', '{"a" 1}', '{"a": [1, 2}', '{"a": 1',
+                     '{"a": "unterminated}'):
+            assert_raises(ValueError, LazyObject, text)
+
+
+class TestProjection:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.server.route('/api/rest/package/pkg1', PACKAGE)
+        self.server.route('/api/action/package_show',
+                          {'help': '', 'success': True, 'result': PACKAGE})
+        self.server.route('/api/search/package',
+                          {'count': 2, 'results': [PACKAGE, PACKAGE]})
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_package_entity_get(self):
+        assert_equal(self.client.package_entity_get('pkg1', fields=['name']),
+                     {'name': 'pkg1'})
+        package = self.client.package_entity_get('pkg1', lazy=True)
+        assert isinstance(package, LazyObject)
+        assert_equal(package.to_dict(), PACKAGE)
+
+    def test_package_show(self):
+        package = self.client.package_show('pkg1', fields=['name', 'tags'])
+        assert_equal(package, {'name': 'pkg1', 'tags': ['a', 'b']})
+        package = self.client.package_show('pkg1', fields=['resources'],
+                                           lazy=True)
+        assert isinstance(package, LazyObject)
+        assert_equal(list(package), ['resources'])
+        assert_equal(self.client.last_help, '')
+
+    def test_package_search(self):
+        res = self.client.package_search('x', {'all_fields': 1},
+                                         fields=['name', 'resources'])
+        options = decode_body(self.server.requests[-1][3])
+        assert_equal(options['fl'], 'name resources')
+        assert_equal(list(res['results']),
+                     [project(PACKAGE, ['name', 'resources'])] * 2)
+        res = self.client.package_search('x', {'all_fields': 1}, lazy=True)
+        results = list(res['results'])
+        assert isinstance(results[0], LazyObject)
+        assert_equal(results[1]['extras'], {'k': 'v'})
+        assert_equal(res['count'], 2)
@@ -0,0 +1,91 @@
+from nose.tools import assert_equal
+
+from ckanclient import CkanClient
+from ckanclient.mirror import CatalogMirror, parse_terms
+from ckanclient.tests.stubserver import StubServer
+from ckanclient.tests.test_search import FakeKeysetSearch
+
+
+def make_package(i, title, tags, formats, modified='2013-06-01T10:00:00'):
+    return {'id': 'id%02d' % i, 'name': 'pkg%02d' % i, 'title': title,
+            'notes': 'Notes about %s' % title.lower(),
+            'tags': tags, 'groups': ['roger'] if i % 2 else [],
+            'resources': [{'format': f} for f in formats],
+            'license_id': 'cc-by', 'metadata_modified': modified}
+
+
+class TestCatalogMirror:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.packages = [
+            make_package(0, 'Bus stops', ['transport'], ['CSV']),
+            make_package(1, 'Bus routes and bus timetables',
+                         ['transport', 'bus'], ['CSV', 'JSON']),
+            make_package(2, 'Rail stations', ['transport', 'rail'], ['XLS']),
+            make_package(3, 'School results', ['education'], ['CSV']),
+        ]
+        self.search = FakeKeysetSearch(self.packages)
+        self.server.route('/api/search/package', self.search)
+        self.server.route('/api/rest/package', self._register)
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+        self.mirror = CatalogMirror(self.client, page_size=3)
+        assert_equal(self.mirror.refresh(), 4)
+
+    def _register(self, handler, body):
+        return [pkg['name'] for pkg in self.packages]
+
+    def teardown(self):
+        self.server.stop()
+
+    def _names(self, q, search_options=None):
+        return self.mirror.package_search(q, search_options)['results']
+
+    def test_free_text(self):
+        assert_equal(self._names('bus'), ['pkg01', 'pkg00'])
+        assert_equal(self._names('BUS Timetables'), ['pkg01'])
+        assert_equal(self._names('transport'), ['pkg00', 'pkg01', 'pkg02'])
+        assert_equal(self._names('csv'), ['pkg00', 'pkg01', 'pkg03'])
+        assert_equal(self._names('ferry'), [])
+        assert_equal(len(self._names('')), 4)
+        assert_equal(len(self._names('*:*')), 4)
+
+    def test_filters(self):
+        assert_equal(self._names('', {'fq': 'res_format:CSV tags:transport'}),
+                     ['pkg00', 'pkg01'])
+        assert_equal(self._names('tags:rail'), ['pkg02'])
+        assert_equal(self._names('bus', {'groups': 'roger'}), ['pkg01'])
+        assert_equal(self._names('', {'fq': 'title:"Rail stations"'}),
+                     ['pkg02'])
+
+    def test_paging_and_sort(self):
+        res = self.mirror.package_search('', {'sort': 'name desc',
+                                              'limit': 2, 'offset': 1,
+                                              'all_fields': 1})
+        assert_equal(res['count'], 4)
+        assert_equal([pkg['name'] for pkg in res['results']],
+                     ['pkg02', 'pkg01'])
+
+    def test_refresh(self):
+        requests = len(self.search.requests)
+        assert_equal(self.mirror.refresh(), 0)
+        self.packages[0] = make_package(0, 'Tram stops', ['transport'],
+                                        ['CSV'], '2013-06-02T10:00:00')
+        del self.packages[3]
+        assert_equal(self.mirror.refresh(), 1)
+        # only the changes were fetched
+        assert_equal(len(self.search.requests), requests + 2)
+        assert_equal(self._names('tram'), ['pkg00'])
+        assert_equal(self._names('bus'), ['pkg01'])
+        assert_equal(self._names('school'), [])
+        assert_equal(self.mirror.get('pkg03'), None)
+        stats = self.mirror.stats()
+        assert_equal((stats['refreshes'], stats['updated'], stats['deleted'],
+                      stats['packages']), (3, 5, 1, 3))
+
+
+def test_parse_terms():
+    assert_equal(parse_terms('bus AND +tags:transport res_format:"CSV x"'),
+                 [(None, 'bus'), ('tags', 'transport'),
+                  ('res_format', 'CSV x')])
@@ -0,0 +1,79 @@
+import json
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import model
+from ckanclient.model import Package, Resource, Tag, Group, intern_string
+
+REST_PACKAGE = {
+    'id': 'id1', 'name': 'pkg1', 'title': 'Package 1', 'notes': None,
+    'license_id': 'cc-by', 'tags': ['transport', 'bus'],
+    'groups': ['roger'], 'extras': {'k': 'v'},
+    'resources': [{'url': 'http://x/1.csv', 'format': 'CSV',
+                   'custom': [1, 2]}],
+    'ratings_average': None,
+}
+ACTION_PACKAGE = {
+    'id': 'id2', 'name': 'pkg2', 'state': 'active', 'private': False,
+    'tags': [{'name': 'transport', 'display_name': 'transport',
+              'vocabulary_id': None}],
+    'groups': [{'name': 'roger', 'title': 'Roger', 'id': 'g1'}],
+    'organization': {'name': 'org', 'is_organization': True},
+    'extras': [{'key': 'k', 'value': 'v'}],
+    'resources': [],
+    'unknown_field': {'nested': True},
+}
+
+
+def test_round_trip():
+    for data in (REST_PACKAGE, ACTION_PACKAGE):
+        # as decoded from JSON, with unicode strings
+        data = json.loads(json.dumps(data))
+        package = Package.from_dict(data)
+        assert_equal(package.to_dict(), data)
+        assert_equal(Package.from_dict(package.to_dict()), package)
+
+
+def test_attributes():
+    package = Package.from_dict(ACTION_PACKAGE)
+    assert not hasattr(package, '__dict__')
+    assert isinstance(package.tags[0], Tag)
+    assert isinstance(package.groups[0], Group)
+    assert isinstance(package.organization, Group)
+    assert_equal(package.organization.name, 'org')
+    # missing fields read as None but aren't added to the dict
+    assert_equal(package.title, None)
+    assert 'title' not in package.to_dict()
+    assert_equal(package.unknown_field, {'nested': True})
+    assert_equal(package.get('unknown_field'), {'nested': True})
+    assert_raises(AttributeError, getattr, package, 'nonsense')
+    package = Package.from_dict(REST_PACKAGE)
+    assert isinstance(package.resources[0], Resource)
+    assert_equal(package.resources[0].format, 'CSV')
+    assert_equal(package.tags, ['transport', 'bus'])
+
+
+def test_strings_interned():
+    first, second = [Package.from_dict(json.loads(json.dumps(REST_PACKAGE)))
+                     for i in range(2)]
+    assert first.license_id is second.license_id
+    assert first.resources[0].format is second.resources[0].format
+    assert first.tags[0] is second.tags[0]
+    # not fields with many values, which would stay in the table
+    assert first.title is not second.title
+    Package.from_dict({'name': 'p', 'author': u'Only Author',
+                       'version': u'only-version',
+                       'resources': [{'package_id': u'only-package-id'}],
+                       'groups': [{'name': 'g',
+                                   'description': u'only description'}]})
+    for value in (u'Only Author', u'only-version', u'only-package-id',
+                  u'only description'):
+        assert value not in model._strings, value
+    assert_equal(intern_string(None), None)
+
+
+def test_construct():
+    resource = Resource(url='http://x', format='CSV')
+    package = Package(name='new', resources=[resource.to_dict()])
+    assert_equal(package.to_dict(), {'name': 'new', 'resources': [
+        {'url': 'http://x', 'format': 'CSV'}]})
@@ -0,0 +1,60 @@
+import threading
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiNotFoundError, ApiResponse
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestApiResponse:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.names = ['pkg%s' % i for i in range(20)]
+        for name in self.names:
+            self.server.route('/api/rest/package/' + name, {'name': name})
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_open_url_returns_response(self):
+        url = self.client.get_location('Package Entity', 'pkg1')
+        response = self.client.open_url(url)
+        assert isinstance(response, ApiResponse)
+        assert_equal(response.status, 200)
+        assert_equal(response.method, 'GET')
+        assert_equal(response.message, {'name': 'pkg1'})
+        assert_equal(response.headers['Content-Type'], 'application/json')
+        assert response.elapsed >= 0, response.elapsed
+        assert self.client.last_response is response
+
+    def test_last_attributes(self):
+        self.client.package_entity_get('pkg1')
+        assert_equal(self.client.last_status, 200)
+        assert_equal(self.client.last_message, {'name': 'pkg1'})
+        assert_raises(CkanApiNotFoundError,
+                      self.client.package_entity_get, 'missing')
+        assert_equal(self.client.last_status, 404)
+        assert self.client.last_http_error
+        self.client.reset()
+        assert self.client.last_status is None
+
+    def test_shared_between_threads(self):
+        errors = []
+        def fetch(name):
+            for i in range(10):
+                pkg = self.client.package_entity_get(name)
+                if pkg['name'] != name or \
+                       self.client.last_message['name'] != name:
+                    errors.append((name, pkg, self.client.last_message))
+        threads = [threading.Thread(target=fetch, args=(name,))
+                   for name in self.names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+        # the last_* attributes are per thread
+        assert self.client.last_response is None
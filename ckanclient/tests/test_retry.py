@@ -0,0 +1,116 @@
+import time
+import threading
+from email.utils import formatdate
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiError, ApiResponse
+from ckanclient.retry import RetryPolicy, TokenBucket
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestRetryPolicy:
+
+    def _response(self, status, retry_after=None):
+        response = ApiResponse('http://test/api')
+        response.status = status
+        response.headers = {}
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        return response
+
+    def test_should_retry(self):
+        policy = RetryPolicy(max_retries=2)
+        assert policy.should_retry(self._response(503), 0, True)
+        assert policy.should_retry(self._response(429), 1, True)
+        assert not policy.should_retry(self._response(429), 2, True)
+        assert not policy.should_retry(self._response(503), 0, False)
+        assert not policy.should_retry(self._response(404), 0, True)
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff_factor=1, max_backoff=5)
+        for attempt in range(5):
+            delay = policy.backoff(attempt, self._response(503))
+            assert 0 <= delay <= min(2 ** attempt, 5), delay
+
+    def test_retry_after(self):
+        policy = RetryPolicy(max_backoff=100)
+        assert_equal(policy.backoff(0, self._response(503, '7')), 7)
+        date = formatdate(time.time() + 30, usegmt=True)
+        delay = policy.backoff(0, self._response(503, date))
+        assert 28 <= delay <= 30, delay
+        # capped by max_backoff
+        assert_equal(RetryPolicy(max_backoff=2).backoff(
+            0, self._response(503, '7')), 2)
+
+
+class TestTokenBucket:
+
+    def test_rate(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.time()
+        threads = [threading.Thread(target=bucket.acquire)
+                   for i in range(11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        assert 0.18 <= elapsed < 0.4, elapsed
+        stats = bucket.stats()
+        assert_equal(stats['acquired'], 11)
+        assert_equal(stats['throttled'], 10)
+        assert stats['throttle_wait'] > 0
+
+
+class TestClientRetry:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.failures = 2
+        def overloaded(handler, body):
+            if self.failures:
+                self.failures -= 1
+                return 503, {'Retry-After': '0'}, 'busy'
+            return 200, {'Content-Type': 'application/json'}, \
+                '{"help": "", "success": true, "result": {"name": "pkg"}}'
+        self.server.route('/api/rest/package/pkg', overloaded)
+        self.server.route('/api/rest/package', overloaded)
+        self.server.route('/api/action/package_show', overloaded)
+        self.server.route('/api/action/package_create', overloaded)
+        self.policy = RetryPolicy(backoff_factor=0.01)
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x', retry=self.policy)
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_get_retried(self):
+        self.client.package_entity_get('pkg')
+        assert_equal(self.client.last_response.retries, 2)
+        assert_equal(self.policy.stats()['retries'], 2)
+        assert_equal(len(self.server.requests), 3)
+
+    def test_read_action_retried(self):
+        assert_equal(self.client.package_show('pkg'), {'name': 'pkg'})
+
+    def test_write_not_retried(self):
+        assert_raises(CkanApiError, self.client.action, 'package_create',
+                      name='pkg')
+        assert_raises(CkanApiError, self.client.package_register_post,
+                      {'name': 'pkg'})
+        assert_equal(self.policy.stats()['retries'], 0)
+
+    def test_gives_up(self):
+        self.failures = 10
+        assert_raises(CkanApiError, self.client.package_entity_get, 'pkg')
+        assert_equal(len(self.server.requests), 4)
+
+    def test_rate_limited(self):
+        bucket = TokenBucket(rate=1000)
+        client = CkanClient(base_location=self.server.url + '/api',
+                            api_key='x', retry=self.policy,
+                            rate_limiter=bucket)
+        client.package_entity_get('pkg')
+        # retries take tokens too
+        assert_equal(bucket.stats()['acquired'], 3)
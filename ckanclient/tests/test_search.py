@@ -0,0 +1,335 @@
+import re
+import random
+import threading
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiError
+from ckanclient.workers import Prefetcher
+from ckanclient.search import (AdaptivePageSize, KEYSET_SORT, solr_date,
+                               encode_cursor, decode_cursor)
+from ckanclient.tests.stubserver import StubServer, decode_body
+
+
+class FakeSearch(object):
+    '''A /search/package route over a list of package names.'''
+    def __init__(self, names, delay=0, max_limit=None, cap=None):
+        self.names = names
+        self.delay = delay
+        self.max_limit = max_limit # larger limits are refused
+        self.cap = cap # larger limits are quietly reduced
+        self.offsets = []
+        self.limits = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, handler, body):
+        options = decode_body(body)
+        offset = int(options.get('offset', 0))
+        limit = int(options['limit'])
+        if self.max_limit and limit > self.max_limit:
+            return 409, {'Content-Type': 'text/plain'}, 'Limit too large'
+        limit = min(limit, self.cap or limit)
+        with self.lock:
+            self.offsets.append(offset)
+            self.limits.append(limit)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay(limit) if callable(self.delay) else self.delay)
+        with self.lock:
+            self.running -= 1
+        return {'count': len(self.names),
+                'results': self.names[offset:offset + limit]}
+
+
+class TestPackageSearch:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.names = ['pkg%03d' % i for i in range(95)]
+        self.search = FakeSearch(self.names)
+        self.server.route('/api/search/package', self.search)
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_pages(self):
+        res = self.client.package_search('x')
+        assert_equal(res['count'], 95)
+        assert_equal(list(res['results']), self.names)
+        assert_equal(self.search.offsets, range(0, 95, 10))
+
+    def test_prefetch(self):
+        res = self.client.package_search('x', {'limit': 20}, prefetch=2)
+        assert_equal(list(res['results']), self.names)
+        assert_equal(sorted(self.search.offsets), range(0, 95, 20))
+
+    def _requested(self, offset, timeout):
+        deadline = time.time() + timeout
+        while offset not in self.search.offsets and time.time() < deadline:
+            time.sleep(0.001)
+        return offset in self.search.offsets
+
+    def test_prefetch_overlaps_processing(self):
+        self.search.delay = 0.05
+        def scan(prefetch, timeout):
+            # whether the next page was requested while the consumer was
+            # still on the last result of each page
+            overlapped = []
+            res = self.client.package_search('x', {'limit': 10},
+                                             prefetch=prefetch)
+            for i, name in enumerate(res['results']):
+                if i % 10 == 9 and i < 90:
+                    overlapped.append(self._requested(i + 1, timeout))
+            return overlapped
+        assert_equal(scan(1, timeout=5), [True] * 9)
+        del self.search.offsets[:]
+        assert_equal(scan(0, timeout=0.01), [False] * 9)
+
+    def test_prefetch_stops_early(self):
+        res = self.client.package_search('x', {'limit': 10}, prefetch=2)
+        results = res['results']
+        assert_equal(results.next(), 'pkg000')
+        time.sleep(0.1)
+        results.close()
+        time.sleep(0.1)
+        assert len(self.search.offsets) <= 3, self.search.offsets
+
+    def test_prefetch_error(self):
+        res = self.client.package_search('x', {'limit': 50}, prefetch=1)
+        self.server.route('/api/search/package',
+                          (500, {'Content-Type': 'text/plain'}, 'Error'))
+        assert_raises(CkanApiError, list, res['results'])
+
+
+    def test_fan_out(self):
+        # pages finish in random order but are yielded in rank order
+        self.search.delay = lambda limit: random.uniform(0, 0.02)
+        res = self.client.package_search('x', num_workers=4)
+        assert_equal(list(res['results']), self.names)
+        assert_equal(sorted(self.search.offsets), range(0, 95, 10))
+        assert 1 < self.search.max_running <= 4, self.search.max_running
+
+    def test_fan_out_error(self):
+        res = self.client.package_search('x', num_workers=4)
+        self.server.route('/api/search/package',
+                          (500, {'Content-Type': 'text/plain'}, 'Error'))
+        results = res['results']
+        assert_equal([results.next() for i in range(10)], self.names[:10])
+        assert_raises(CkanApiError, results.next)
+
+    def test_stats(self):
+        res = self.client.package_search('x', {'limit': 20}, num_workers=2)
+        results = res['results']
+        assert_equal(results.stats()['pages'], 1)
+        assert_equal(len(list(results)), 95)
+        stats = results.stats()
+        assert_equal(stats['pages'], 5)
+        assert_equal(stats['results'], 95)
+        assert stats['elapsed'] > 0
+        assert stats['results_per_sec'] > 0
+        # finished, so the rates stay put
+        assert_equal(results.stats()['elapsed'], stats['elapsed'])
+
+
+class TestAdaptivePageSize:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.names = ['pkg%04d' % i for i in range(2000)]
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def _search(self, page_size, **kwargs):
+        search = FakeSearch(self.names, **kwargs)
+        self.server.route('/api/search/package', search)
+        res = self.client.package_search('x', page_size=page_size)
+        assert_equal(list(res['results']), self.names)
+        return search, res['results'].stats()
+
+    def test_grows_to_target_time(self):
+        # 1ms per result, so 50ms pages hold about 50 results
+        page_size = AdaptivePageSize(target_time=0.05, max_size=500)
+        search, stats = self._search(page_size,
+                                     delay=lambda limit: limit * 0.001)
+        sizes = stats['page_sizes']
+        assert_equal(sizes[:2], [10, 20])
+        assert 30 <= sizes[-2] <= 70, sizes
+        assert_equal(sizes, search.limits)
+
+    def test_max_bytes(self):
+        # each result is about 11 bytes in the response
+        page_size = AdaptivePageSize(target_time=10, max_bytes=1200)
+        search, stats = self._search(page_size)
+        assert 90 <= max(stats['page_sizes']) <= 110, stats['page_sizes']
+
+    def test_backs_off_when_refused(self):
+        page_size = AdaptivePageSize(target_time=10, initial_size=200)
+        search, stats = self._search(page_size, max_limit=60)
+        assert_equal(page_size.stats()['rejections'], 2)
+        assert_equal(page_size.max_size, 50)
+        assert_equal(stats['page_sizes'][0], 50)
+        assert max(search.limits) <= 50
+
+    def test_capped_by_server(self):
+        page_size = AdaptivePageSize(target_time=10)
+        search, stats = self._search(page_size, cap=100)
+        assert_equal(page_size.max_size, 100)
+        assert_equal(page_size.stats()['capped'], 1)
+
+    def test_refused_at_min_size(self):
+        search = FakeSearch(self.names, max_limit=5)
+        self.server.route('/api/search/package', search)
+        assert_raises(CkanApiError, self.client.package_search, 'x',
+                      page_size=AdaptivePageSize())
+
+    def test_not_with_num_workers(self):
+        search = FakeSearch(self.names)
+        self.server.route('/api/search/package', search)
+        assert_raises(ValueError, self.client.package_search, 'x',
+                      page_size=AdaptivePageSize(), num_workers=4)
+        assert_equal(search.offsets, [])
+
+
+class FakeKeysetSearch(object):
+    '''A /search/package route over package dicts that understands the
+    keyset filter and sort.'''
+    after = re.compile(r'metadata_modified:\{(\S+) TO \*\] OR '
+                       r'\(metadata_modified:"(\S+)" AND id:\{(\S+) TO \*\]\)')
+
+    def __init__(self, packages):
+        self.packages = packages
+        self.requests = []
+
+    def __call__(self, handler, body):
+        options = decode_body(body)
+        self.requests.append(options)
+        assert_equal(options['sort'], KEYSET_SORT)
+        assert 'offset' not in options
+        packages = sorted(self.packages, key=lambda pkg: (
+            solr_date(pkg['metadata_modified']), pkg['id']))
+        match = self.after.search(options.get('fq', ''))
+        if match:
+            modified, modified_again, package_id = match.groups()
+            packages = [pkg for pkg in packages
+                        if (solr_date(pkg['metadata_modified']), pkg['id'])
+                        > (modified, package_id)]
+        if 'odd' in options.get('fq', ''):
+            packages = [pkg for pkg in packages if int(pkg['name'][3:]) % 2]
+        return {'count': len(packages),
+                'results': packages[:int(options['limit'])]}
+
+
+class TestKeysetSearch:
+
+    def setup(self):
+        self.server = StubServer().start()
+        # ten packages share each timestamp, so the id breaks the ties
+        self.packages = [
+            {'id': 'id%03d' % (i * 37 % 100), 'name': 'pkg%03d' % i,
+             'metadata_modified': '2013-06-%02dT10:00:00.123456' % (i / 10 + 1)}
+            for i in range(100)]
+        self.search = FakeKeysetSearch(self.packages)
+        self.server.route('/api/search/package', self.search)
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def _expected(self):
+        return [pkg['name'] for pkg in sorted(self.packages, key=lambda pkg: (
+            pkg['metadata_modified'], pkg['id']))]
+
+    def test_scan(self):
+        res = self.client.package_search_keyset('x', {'limit': 15})
+        assert_equal(res['count'], 100)
+        assert_equal([pkg['name'] for pkg in res['results']],
+                     self._expected())
+        assert_equal(len(self.search.requests), 7)
+
+    def test_resume_from_cursor(self):
+        res = self.client.package_search_keyset('x', {'limit': 15},
+                                                prefetch=1)
+        results = res['results']
+        assert_equal(results.cursor, None)
+        first = [results.next()['name'] for i in range(42)]
+        cursor = results.cursor
+        results.close()
+        res = self.client.package_search_keyset('x', {'limit': 15},
+                                                cursor=cursor)
+        assert_equal(res['count'], 58)
+        rest = [pkg['name'] for pkg in res['results']]
+        assert_equal(first + rest, self._expected())
+
+    def test_changes_during_scan(self):
+        res = self.client.package_search_keyset('x', {'limit': 10})
+        results = res['results']
+        seen = [results.next()['name'] for i in range(30)]
+        # a package already seen is modified, and one not yet seen
+        self.packages[0]['metadata_modified'] = '2013-07-01T00:00:00'
+        self.packages[50]['metadata_modified'] = '2013-07-02T00:00:00'
+        seen += [pkg['name'] for pkg in results]
+        assert_equal(sorted(set(seen)), sorted(self._expected()))
+        assert_equal(seen[-2:], ['pkg000', 'pkg050'])
+        assert_equal(len(seen), 101)
+
+    def test_filter_query(self):
+        res = self.client.package_search_keyset('x', {'fq': 'odd:1'})
+        names = [pkg['name'] for pkg in res['results']]
+        assert_equal(len(names), 50)
+        assert self.search.requests[-1]['fq'].startswith('(odd:1) AND (')
+
+    def test_invalid_cursor(self):
+        assert_raises(ValueError, self.client.package_search_keyset, 'x',
+                      cursor='not a cursor')
+        assert_raises(ValueError, self.client.package_search_keyset, 'x',
+                      {'offset': 10})
+
+
+def test_cursor_round_trip():
+    key = (u'2013-06-12T10:05:27.123456', u'abc-123')
+    assert_equal(decode_cursor(encode_cursor(key)), key)
+
+
+def test_solr_date():
+    assert_equal(solr_date('2013-06-12T10:05:27.123456'),
+                 '2013-06-12T10:05:27.123Z')
+    assert_equal(solr_date('2013-06-12T10:05:27'), '2013-06-12T10:05:27Z')
+    assert_equal(solr_date('2013-06-12T10:05:27Z'), '2013-06-12T10:05:27Z')
+
+
+class TestPrefetcher:
+
+    def test_items(self):
+        assert_equal(list(Prefetcher(iter(range(10)), 3)), range(10))
+
+    def test_ahead(self):
+        taken = []
+        def items():
+            for i in range(100):
+                taken.append(i)
+                yield i
+        prefetcher = Prefetcher(items(), 3)
+        time.sleep(0.05)
+        assert_equal(taken, [0, 1, 2])
+        prefetcher.next()
+        time.sleep(0.05)
+        assert_equal(taken, [0, 1, 2, 3])
+        prefetcher.close()
+
+    def test_error(self):
+        def items():
+            yield 1
+            raise ValueError('bad')
+        prefetcher = Prefetcher(items())
+        assert_equal(prefetcher.next(), 1)
+        assert_raises(ValueError, prefetcher.next)
+        assert_raises(StopIteration, prefetcher.next)
@@ -0,0 +1,128 @@
+import os
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanclient import CkanClient, CkanApiNotFoundError
+from ckanclient.store import PackageStore
+from ckanclient.sync import Change
+from ckanclient.tests.stubserver import StubServer
+
+
+def make_package(i, tags, groups, formats, modified):
+    return {'id': 'id%02d' % i, 'name': 'pkg%02d' % i, 'tags': tags,
+            'groups': groups, 'metadata_modified': modified,
+            'resources': [{'url': 'http://x/%s' % f, 'format': f}
+                          for f in formats]}
+
+
+PACKAGES = [
+    make_package(0, ['transport'], ['roger'], ['CSV', 'csv'], '2013-01-01'),
+    make_package(1, ['transport', 'bus'], [], ['JSON'], '2013-01-02'),
+    # action API shapes
+    make_package(2, [{'name': 'rail'}], [{'name': 'roger'}], ['XLS'],
+                 '2013-01-03'),
+]
+
+
+class TestPackageStore:
+
+    def setup(self):
+        self.store = PackageStore()
+        assert_equal(self.store.upsert_packages(PACKAGES), 3)
+
+    def test_entities(self):
+        assert_equal(self.store.package_register_get(),
+                     ['pkg00', 'pkg01', 'pkg02'])
+        assert_equal(self.store.package_entity_get('pkg01'), PACKAGES[1])
+        assert_equal(self.store.package_entity_get('id02'), PACKAGES[2])
+        assert_equal(self.store.package_entity_get('missing'), None)
+        assert_equal(self.store.tag_register_get(),
+                     ['bus', 'rail', 'transport'])
+        assert_equal(self.store.tag_entity_get('transport'),
+                     ['pkg00', 'pkg01'])
+
+    def test_find_packages(self):
+        find = self.store.find_packages
+        assert_equal(find(group='roger', names_only=True), ['pkg00', 'pkg02'])
+        assert_equal(find(tag='transport', res_format='Csv',
+                          names_only=True), ['pkg00'])
+        assert_equal(find(modified_since='2013-01-01'), PACKAGES[1:])
+        assert_equal(find(tag='missing'), [])
+        assert_equal(self.store.last_modified(), '2013-01-03')
+
+    def test_upsert_replaces(self):
+        package = make_package(1, ['tram'], [], [], '2013-02-01')
+        self.store.upsert_package(package)
+        assert_equal(len(self.store), 3)
+        assert_equal(self.store.package_entity_get('pkg01'), package)
+        assert_equal(self.store.tag_entity_get('bus'), [])
+        assert_equal(self.store.find_packages(res_format='JSON'), [])
+        # renamed
+        package = dict(package, name='renamed')
+        self.store.upsert_package(package)
+        assert_equal(self.store.package_register_get(),
+                     ['pkg00', 'pkg02', 'renamed'])
+
+    def test_get_many_tuples_and_changes(self):
+        store = PackageStore()
+        stored = store.upsert_packages([('pkg00', PACKAGES[0]),
+                                        ('gone', CkanApiNotFoundError(404))])
+        assert_equal(stored, 1)
+        store.apply_changes([
+            Change('created', 'pkg01', 'id01', PACKAGES[1], None),
+            Change('deleted', 'pkg00', None, None, None)])
+        assert_equal(store.package_register_get(), ['pkg01'])
+
+    def test_upsert_in_batches(self):
+        store = PackageStore()
+        seen = []
+        def fetch():
+            for package in PACKAGES:
+                # the store can be read while packages are fetched
+                seen.append(len(store))
+                yield package
+            raise IOError('connection reset')
+        try:
+            store.upsert_packages(fetch(), batch_size=2)
+        except IOError:
+            pass
+        else:
+            assert False, 'IOError not raised'
+        assert_equal(seen, [0, 0, 2])
+        # the batch written before the error is kept
+        assert_equal(store.package_register_get(), ['pkg00', 'pkg01'])
+
+    def test_groups_and_persistence(self):
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            store = PackageStore(path)
+            store.upsert_packages(PACKAGES)
+            store.upsert_groups([{'name': 'roger', 'id': 'g1',
+                                  'packages': ['pkg00', 'pkg02']}])
+            store.upsert_tags(['unused', 'bus'])
+            store.close()
+            store = PackageStore(path)
+            assert_equal(store.group_register_get(), ['roger'])
+            assert_equal(store.group_entity_get('g1')['packages'],
+                         ['pkg00', 'pkg02'])
+            assert_equal(store.stats(), {'packages': 3, 'groups': 1,
+                                         'tags': 4})
+            store.close()
+        finally:
+            os.remove(path)
+
+
+def test_upsert_from_search():
+    server = StubServer().start()
+    try:
+        server.route('/api/search/package',
+                     {'count': 3, 'results': PACKAGES})
+        client = CkanClient(base_location=server.url + '/api', api_key='x')
+        store = PackageStore()
+        res = client.package_search('', {'all_fields': 1})
+        assert_equal(store.upsert_packages(res['results']), 3)
+        assert_equal(store.find_packages(tag='rail', names_only=True),
+                     ['pkg02'])
+    finally:
+        server.stop()
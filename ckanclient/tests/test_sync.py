@@ -0,0 +1,181 @@
+import urlparse
+
+from nose.tools import assert_equal
+
+from ckanclient import CkanClient
+from ckanclient.sync import (CatalogSync, ModifiedFeed, RevisionFeed,
+                             CREATED, UPDATED, DELETED, deleted_since)
+from ckanclient.tests.stubserver import StubServer
+from ckanclient.tests.test_search import FakeKeysetSearch
+
+
+def package(i, created, modified, state='active'):
+    return {'id': 'id%02d' % i, 'name': 'pkg%02d' % i, 'state': state,
+            'metadata_created': created, 'metadata_modified': modified}
+
+
+def changes(sync):
+    return [(change.type, change.name) for change in sync.changes()]
+
+
+class FakeRegisterClient(object):
+    def __init__(self, register):
+        self.register = register
+
+    def package_register_get(self):
+        return self.register
+
+
+def test_deleted_since():
+    known = {'gone': 'id1', 'kept': 'id2', 'old-name': 'id3',
+             'new-name': 'id3', 'no-id': None, 'by-id': 'id4'}
+    # names (API v1)
+    client = FakeRegisterClient(['kept', 'new-name', 'no-id'])
+    assert_equal(deleted_since(client, known),
+                 [('by-id', 'id4'), ('gone', 'id1')])
+    # ids (API v2)
+    client = FakeRegisterClient(['id2', 'id3', 'id4'])
+    assert_equal(deleted_since(client, known),
+                 [('gone', 'id1'), ('no-id', None)])
+
+
+class TestModifiedFeed:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.packages = [package(i, '2013-06-01T10:00:00',
+                                 '2013-06-01T10:00:%02d' % i)
+                         for i in range(5)]
+        self.search = FakeKeysetSearch(self.packages)
+        self.server.route('/api/search/package', self.search)
+        self.server.route('/api/rest/package', lambda handler, body:
+                          [pkg['name'] for pkg in self.packages])
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_sync(self):
+        sync = CatalogSync(self.client, feed=ModifiedFeed(page_size=2))
+        assert_equal(changes(sync), [(CREATED, 'pkg%02d' % i)
+                                     for i in range(5)])
+        assert_equal(changes(sync), [])
+        self.packages[1] = package(1, '2013-06-01T10:00:00',
+                                   '2013-06-02T10:00:00')
+        self.packages.append(package(5, '2013-06-03T10:00:00',
+                                     '2013-06-03T10:00:00'))
+        del self.packages[3]
+        assert_equal(changes(sync), [(UPDATED, 'pkg01'), (CREATED, 'pkg05'),
+                                     (DELETED, 'pkg03')])
+        assert_equal(sync.stats(), {CREATED: 6, UPDATED: 1, DELETED: 1,
+                                    'syncs': 3})
+
+    def test_renamed_not_deleted(self):
+        sync = CatalogSync(self.client, feed=ModifiedFeed(page_size=2))
+        changes(sync)
+        self.packages[2] = dict(package(2, '2013-06-01T10:00:00',
+                                        '2013-06-02T10:00:00'),
+                                name='renamed')
+        # the register lists names (API v1), so pkg02 is missing from it
+        assert_equal(changes(sync), [(UPDATED, 'renamed')])
+        assert 'pkg02' not in sync.feed.known
+
+    def test_resume_from_mark(self):
+        sync = CatalogSync(self.client)
+        marks = [change.mark for change in sync.changes()]
+        assert_equal(marks[-1], sync.mark)
+        # resuming from the mark of the third change gives the rest
+        sync = CatalogSync(self.client, mark=marks[2],
+                           feed=ModifiedFeed(known=['pkg00']))
+        del self.packages[0]
+        assert_equal(changes(sync), [(UPDATED, 'pkg03'), (UPDATED, 'pkg04'),
+                                     (DELETED, 'pkg00')])
+
+
+class TestRevisionFeed:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.revisions = []
+        self.server.route('/api/search/revision', self._revision_search)
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def _revision_search(self, handler, body):
+        query = urlparse.parse_qs(handler.path.split('?')[1])
+        if 'since_id' in query:
+            since_time = [rev['timestamp'] for rev in self.revisions
+                          if rev['id'] == query['since_id'][0]][0]
+        else:
+            since_time = query['since_time'][0]
+        # a small batch size, as servers return 50 at most
+        return [rev['id'] for rev in self.revisions
+                if rev['timestamp'] > since_time][:2]
+
+    def _revise(self, packages, timestamp):
+        revision = {'id': 'rev%d' % len(self.revisions),
+                    'timestamp': timestamp,
+                    'packages': [pkg['name'] for pkg in packages]}
+        self.revisions.append(revision)
+        self.server.route('/api/rest/revision/' + revision['id'], revision)
+        for pkg in packages:
+            self.server.route('/api/rest/package/' + pkg['name'], pkg)
+
+    def test_sync(self):
+        self._revise([package(0, '2013-01-01', '2013-01-01')], '2013-01-01')
+        self._revise([package(1, '2013-01-02', '2013-01-02'),
+                      package(2, '2013-01-02', '2013-01-02')], '2013-01-02')
+        self._revise([package(0, '2013-01-01', '2013-01-03')], '2013-01-03')
+        sync = CatalogSync(self.client, feed=RevisionFeed())
+        assert_equal(changes(sync), [(CREATED, 'pkg00'), (CREATED, 'pkg01'),
+                                     (CREATED, 'pkg02'), (UPDATED, 'pkg00')])
+        assert_equal(sync.mark, 'rev2')
+        assert_equal(changes(sync), [])
+
+        self._revise([package(1, '2013-01-02', '2013-01-04'),
+                      package(3, '2013-01-04', '2013-01-04')], '2013-01-04')
+        self._revise([package(2, '2013-01-02', '2013-01-05', 'deleted')],
+                     '2013-01-05')
+        # purged
+        self.revisions.append({'id': 'rev5', 'timestamp': '2013-01-06',
+                               'packages': ['pkg00']})
+        self.server.route('/api/rest/revision/rev5', self.revisions[-1])
+        del self.server.routes['/api/rest/package/pkg00']
+        # revisions of groups only
+        for i in (6, 7):
+            self.revisions.append({'id': 'rev%d' % i,
+                                   'timestamp': '2013-01-%02d' % (i + 1),
+                                   'packages': []})
+            self.server.route('/api/rest/revision/rev%d' % i,
+                              self.revisions[-1])
+        marks = []
+        for change in sync.changes():
+            marks.append((change.type, change.name, change.mark))
+        # in batches of two revisions, with the mark moving on at the end of
+        # each batch
+        assert_equal(marks, [(UPDATED, 'pkg01', 'rev2'),
+                             (CREATED, 'pkg03', 'rev2'),
+                             (DELETED, 'pkg02', 'rev4'),
+                             (DELETED, 'pkg00', 'rev6')])
+        assert_equal(sync.mark, 'rev7')
+
+    def test_timestamp_mark(self):
+        self._revise([package(0, '2013-01-01', '2013-01-01')], '2013-01-01')
+        self._revise([package(1, '2013-01-02', '2013-01-02')], '2013-01-02')
+        sync = CatalogSync(self.client, mark='2013-01-01T12:00:00',
+                           feed=RevisionFeed())
+        assert_equal(changes(sync), [(CREATED, 'pkg01')])
+
+    def test_unauthorized_is_deleted(self):
+        self._revise([package(0, '2013-01-01', '2013-01-01'),
+                      package(1, '2013-01-01', '2013-01-01')], '2013-01-01')
+        # deleted since, and readable by sysadmins only
+        self.server.route('/api/rest/package/pkg00', (
+            403, {'Content-Type': 'application/json'}, '"Access denied"'))
+        sync = CatalogSync(self.client, feed=RevisionFeed())
+        assert_equal(changes(sync), [(DELETED, 'pkg00'), (CREATED, 'pkg01')])
+        assert_equal(sync.mark, 'rev0')
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanclient import CkanClient, CkanApiNotFoundError, CkanApiActionError
+from ckanclient.workers import imap
+from ckanclient.tests.stubserver import StubServer
+
+
+class TestImap:
+
+    def test_ordered(self):
+        def slow_square(x):
+            time.sleep(0.01 * (10 - x))
+            return x * x
+        results = list(imap(slow_square, range(10), 5, ordered=True))
+        assert_equal(results, [(x, x * x, None) for x in range(10)])
+
+    def test_errors_do_not_stop_batch(self):
+        def invert(x):
+            return 1.0 / x
+        results = sorted(imap(invert, [0, 1, 2], 2))
+        assert_equal([item for item, result, error in results], [0, 1, 2])
+        assert isinstance(results[0][2], ZeroDivisionError)
+        assert_equal(results[2][1], 0.5)
+
+    def test_concurrency(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+        def work(x):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+        list(imap(work, range(20), 4))
+        assert_equal(state['max'], 4)
+
+    def test_lazy_input(self):
+        consumed = []
+        def items():
+            for i in range(1000):
+                consumed.append(i)
+                yield i
+        results = imap(lambda x: x, items(), 2, window=4)
+        results.next()
+        results.close()
+        assert len(consumed) < 20, len(consumed)
+
+    def test_input_error(self):
+        def items():
+            yield 1
+            raise ValueError('bad input')
+        assert_raises(ValueError, list, imap(lambda x: x, items(), 2))
+
+
+class TestBulkFetch:
+
+    def setup(self):
+        self.server = StubServer().start()
+        self.names = ['pkg%s' % i for i in range(30)]
+        for name in self.names:
+            self.server.route('/api/rest/package/' + name, {'name': name})
+        self.client = CkanClient(base_location=self.server.url + '/api',
+                                 api_key='x')
+
+    def teardown(self):
+        self.server.stop()
+
+    def test_package_entity_get_many(self):
+        names = self.names + ['missing']
+        results = list(self.client.package_entity_get_many(names,
+                                                           ordered=True))
+        assert_equal([name for name, pkg in results], names)
+        for name, pkg in results[:-1]:
+            assert_equal(pkg, {'name': name})
+        assert isinstance(results[-1][1], CkanApiNotFoundError)
+        # connections are shared between the workers
+        assert self.server.connections <= 8, self.server.connections
+
+    def test_package_show_many(self):
+        self.server.route('/api/action/package_show',
+            {'help': '', 'success': True, 'result': {'name': 'pkg'}})
+        results = dict(self.client.package_show_many(['a', 'b']))
+        assert_equal(results, {'a': {'name': 'pkg'}, 'b': {'name': 'pkg'}})
+
+    def test_action_batch(self):
+        self.server.route('/api/action/package_show',
+            {'help': '', 'success': True, 'result': {'name': 'pkg'}})
+        self.server.route('/api/action/status_show',
+            {'help': '', 'success': True, 'result': {'ckan_version': '2'}})
+        self.server.route('/api/action/group_show',
+            {'help': '', 'success': False, 'error': {'message': 'bad'}})
+        results = self.client.action_batch([
+            ('package_show', {'id': 'pkg'}),
+            ('group_show', {'id': 'grp'}),
+            ('status_show', None),
+            ('missing_action', {}),
+            ])
+        assert_equal(results[0], {'name': 'pkg'})
+        assert isinstance(results[1], CkanApiActionError)
+        assert_equal(results[1].args[0], {'message': 'bad'})
+        assert_equal(results[2], {'ckan_version': '2'})
+        assert isinstance(results[3], CkanApiNotFoundError)
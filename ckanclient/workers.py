@@ -0,0 +1,169 @@
+'''Thread pool helpers for running many client calls at once.'''
+import sys
+import threading
+import Queue
+
+DEFAULT_WORKERS = 8
+
+# markers the feeder thread sends alongside results
+_FED = object()
+_FEED_ERROR = object()
+
+
+def _get(queue):
+    # Queue.get() without a timeout can't be interrupted by Ctrl-C
+    while True:
+        try:
+            return queue.get(True, 1)
+        except Queue.Empty:
+            pass
+
+
+def imap(func, iterable, workers=DEFAULT_WORKERS, ordered=False,
+         window=None):
+    '''Call `func(item)` for each item of `iterable` in a pool of threads and
+    yield (item, result, error) tuples as the calls complete. `error` is the
+    exception the call raised (and `result` is None) or None.
+
+    Items are taken from `iterable` lazily, so it can be a generator over a
+    very large number of items.
+
+    :param workers: number of threads. Default *8*
+    :param ordered: yield in the order of `iterable` rather than as calls
+        complete. Default *False*
+    :param window: most items in flight or waiting to be yielded at once.
+        Default *4 x workers*
+    '''
+    window = window or workers * 4
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    slots = threading.Semaphore(window)
+    stopping = threading.Event()
+
+    def feed():
+        count = 0
+        try:
+            for item in iterable:
+                slots.acquire()
+                if stopping.is_set():
+                    break
+                tasks.put((count, item))
+                count += 1
+        except Exception:
+            results.put((_FEED_ERROR, sys.exc_info()))
+        finally:
+            results.put((_FED, count))
+            for i in range(workers):
+                tasks.put(None)
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            if stopping.is_set():
+                continue
+            try:
+                result, error = func(item), None
+            except Exception, e:
+                result, error = None, e
+            results.put((index, item, result, error))
+
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    total = None
+    received = 0
+    next_index = 0
+    pending = {}
+    try:
+        while total is None or received < total:
+            message = _get(results)
+            if message[0] is _FED:
+                total = message[1]
+                continue
+            if message[0] is _FEED_ERROR:
+                exc_type, exc_value, exc_traceback = message[1]
+                raise exc_type, exc_value, exc_traceback
+            index, item, result, error = message
+            received += 1
+            if not ordered:
+                yield item, result, error
+                slots.release()
+                continue
+            pending[index] = (item, result, error)
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+                slots.release()
+    finally:
+        stopping.set()
+        # unblock the feeder if it is waiting for a slot
+        slots.release()
+
+
+class Prefetcher(object):
+    '''Iterator over `iterable` that takes its items in a background thread,
+    so that up to `ahead` items are being produced or are ready while the
+    caller works on the current one. Exceptions raised by `iterable` are
+    raised by next().
+
+    The thread starts straight away. Call close() to stop it if the items
+    aren't all going to be used.
+
+    :param ahead: most items taken from `iterable` but not yet by the
+        caller. Default *1*
+    '''
+    def __init__(self, iterable, ahead=1):
+        self._items = Queue.Queue()
+        self._slots = Queue.Queue()
+        for i in range(max(1, ahead)):
+            self._slots.put(None)
+        self._stopping = threading.Event()
+        self._done = False
+        thread = threading.Thread(target=self._run, args=(iter(iterable),))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, iterator):
+        while True:
+            # wait for the caller to take an item. No timeout, as Queue
+            # polls when given one - close() wakes the thread instead.
+            self._slots.get()
+            if self._stopping.is_set():
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._items.put((_FED, None))
+                return
+            except Exception:
+                self._items.put((_FEED_ERROR, sys.exc_info()))
+                return
+            self._items.put((None, item))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        marker, item = _get(self._items)
+        if marker is _FED:
+            self._done = True
+            raise StopIteration
+        if marker is _FEED_ERROR:
+            self._done = True
+            exc_type, exc_value, exc_traceback = item
+            raise exc_type, exc_value, exc_traceback
+        self._slots.put(None)
+        return item
+
+    def close(self):
+        self._done = True
+        self._stopping.set()
+        self._slots.put(None)